@@ -1,9 +1,26 @@
+import logging
+
 from django.apps import AppConfig
 
+logger = logging.getLogger("djangosaml2")
+
 
 class DjangoSaml2Config(AppConfig):
     name = "djangosaml2"
     verbose_name = "DjangoSAML2"
 
     def ready(self):
-        from . import signals  # noqa
+        from . import checks, signals  # noqa
+        from .cache import connect_user_fingerprint_receivers
+        from .utils import get_custom_setting
+
+        connect_user_fingerprint_receivers()
+
+        if get_custom_setting("SAML_WARMUP_ON_STARTUP", False):
+            from .warmup import warmup
+
+            try:
+                warmup()
+            except Exception:
+                # never prevent the application from starting
+                logger.exception("SAML warm-up failed")
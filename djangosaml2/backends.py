@@ -15,15 +15,26 @@
 
 import logging
 import warnings
-from typing import Any, Optional
+from copy import deepcopy
+from functools import lru_cache
+from typing import Any, Callable, Optional
 
 from django.apps import apps
 from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured, MultipleObjectsReturned
+from django.core.exceptions import (
+    ImproperlyConfigured,
+    MultipleObjectsReturned,
+    ObjectDoesNotExist,
+)
 
 from django.contrib import auth
 from django.contrib.auth.backends import ModelBackend
 
+from asgiref.sync import sync_to_async
+
+from .cache import UserFingerprintCache, get_user_fingerprint_cache
+from .timing import phase
+
 logger = logging.getLogger("djangosaml2")
 
 
@@ -40,6 +51,118 @@ def set_attribute(obj: Any, attr: str, new_value: Any) -> bool:
     return False
 
 
+_missing = object()
+
+
+class AttributeMappingPlan:
+    """An attribute mapping compiled for a user model, so that logging a user
+    in doesn't search the mapping nor inspect the model again.
+
+    sources maps each user attribute to the SAML attributes providing it.
+    steps lists, for each SAML attribute, the user attributes it updates,
+    but the lookup attribute, with how: set a FIELD of the model, SET another
+    attribute, CALL a method, or RESOLVE on the instance what the model class
+    doesn't have.
+    """
+
+    FIELD = "field"
+    SET = "set"
+    CALL = "call"
+    RESOLVE = "resolve"
+
+    def __init__(self, attribute_mapping: dict, user_model, lookup_attribute: str):
+        self.sources = {}
+        self.steps = []
+        self.fields = {
+            name
+            for field in user_model._meta.concrete_fields
+            for name in (field.name, field.attname)
+        }
+        for saml_attr, django_attrs in attribute_mapping.items():
+            targets = []
+            for attr in django_attrs:
+                self.sources.setdefault(attr, []).append(saml_attr)
+                if attr == lookup_attribute:
+                    # Don't update user_lookup_key (e.g. username) (issue #245)
+                    # It was just used to find/create this user and might have
+                    # been changed by `clean_user_main_attribute`
+                    continue
+                targets.append((attr, self._kind(user_model, attr)))
+            self.steps.append((saml_attr, django_attrs, targets))
+
+    def _kind(self, user_model, attr: str) -> str:
+        class_attr = getattr(user_model, attr, self)
+        if class_attr is self:
+            return self.RESOLVE
+        if callable(class_attr):
+            return self.CALL
+        return self.FIELD if attr in self.fields else self.SET
+
+    @property
+    def calls(self) -> bool:
+        """Whether user methods may be called, which may use the ORM."""
+        return any(
+            kind in (self.CALL, self.RESOLVE)
+            for _saml_attr, _django_attrs, targets in self.steps
+            for _attr, kind in targets
+        )
+
+    @property
+    def unresolved(self) -> list:
+        """The user attributes the model class doesn't have."""
+        return [
+            attr
+            for _saml_attr, _django_attrs, targets in self.steps
+            for attr, kind in targets
+            if kind == self.RESOLVE
+        ]
+
+    def value(self, django_attr: str, attributes: dict):
+        """Return the first value of the last SAML attribute received that
+        provides django_attr, or None.
+        """
+        for saml_attr in reversed(self.sources.get(django_attr, ())):
+            if saml_attr in attributes:
+                values = attributes[saml_attr]
+                return values[0] if values else None
+        return None
+
+
+@lru_cache(maxsize=64)
+def _compile_attribute_mapping(
+    frozen_mapping: tuple, user_model, lookup_attribute: str
+) -> AttributeMappingPlan:
+    return AttributeMappingPlan(dict(frozen_mapping), user_model, lookup_attribute)
+
+
+_mapping_plans = {}
+
+
+def compile_attribute_mapping(
+    attribute_mapping: dict, user_model, lookup_attribute: str
+) -> AttributeMappingPlan:
+    """Return the plan of attribute_mapping for user_model, compiled once.
+
+    The mapping of the settings being the same dict at every login, its plan
+    is found by identity, then checked against a copy of the mapping in case
+    it was changed since.
+    """
+    key = (id(attribute_mapping), user_model, lookup_attribute)
+    cached = _mapping_plans.get(key)
+    if cached is not None and cached[0] == attribute_mapping:
+        return cached[1]
+
+    frozen_mapping = tuple(
+        (saml_attr, tuple(django_attrs))
+        for saml_attr, django_attrs in attribute_mapping.items()
+    )
+    plan = _compile_attribute_mapping(frozen_mapping, user_model, lookup_attribute)
+    if len(_mapping_plans) >= 64:
+        _mapping_plans.clear()
+    _mapping_plans[key] = (deepcopy(attribute_mapping), plan)
+    return plan
+
+
 class Saml2Backend(ModelBackend):
 
     # ############################################
@@ -97,17 +220,25 @@ class Saml2Backend(ModelBackend):
 
         return user_lookup_key, self.clean_user_main_attribute(user_lookup_value)
 
+    def _attribute_mapping_plan(
+        self, attribute_mapping: dict, user_model=None
+    ) -> AttributeMappingPlan:
+        return compile_attribute_mapping(
+            attribute_mapping,
+            user_model or self._user_model,
+            self._user_lookup_attribute,
+        )
+
     def _get_attribute_value(
         self, django_field: str, attributes: dict, attribute_mapping: dict
     ):
-        saml_attribute = None
         logger.debug("attribute_mapping: %s", attribute_mapping)
-        for saml_attr, django_fields in attribute_mapping.items():
-            if django_field in django_fields and saml_attr in attributes:
-                saml_attribute = attributes.get(saml_attr, [None])
+        value = self._attribute_mapping_plan(attribute_mapping).value(
+            django_field, attributes
+        )
 
-        if saml_attribute:
-            return saml_attribute[0]
+        if value:
+            return value
         else:
             logger.error(
                 "attributes[saml_attr] attribute value is missing. "
@@ -153,46 +284,198 @@ class Saml2Backend(ModelBackend):
             logger.error("Could not determine user identifier")
             return None
 
-        user, created = self.get_or_create_user(
-            user_lookup_key,
-            user_lookup_value,
-            create_unknown_user,
-            idp_entityid=idp_entityid,
-            attributes=attributes,
-            attribute_mapping=attribute_mapping,
-            request=request,
-        )
+        fingerprints = self._user_fingerprint_cache()
+        if fingerprints is not None:
+            digest = fingerprints.get_digest(attributes, attribute_mapping)
+            with phase("lookup"):
+                user = self._get_fingerprinted_user(
+                    fingerprints.get(idp_entityid, user_lookup_key, user_lookup_value),
+                    digest,
+                )
+            if user is not None:
+                return user if self.user_can_authenticate(user) else None
+
+        with phase("lookup"):
+            user, created = self.get_or_create_user(
+                user_lookup_key,
+                user_lookup_value,
+                create_unknown_user,
+                idp_entityid=idp_entityid,
+                attributes=attributes,
+                attribute_mapping=attribute_mapping,
+                request=request,
+            )
 
         # Update user with new attributes from incoming request
         if user is not None:
-            user = self._update_user(
-                user, attributes, attribute_mapping, force_save=created
-            )
+            with phase("update"):
+                user = self._update_user(
+                    user, attributes, attribute_mapping, force_save=created
+                )
+            if fingerprints is not None and user.pk is not None:
+                fingerprints.set(
+                    idp_entityid, user_lookup_key, user_lookup_value, user, digest
+                )
 
         if self.user_can_authenticate(user):
             return user
 
-    def _update_user(
-        self, user, attributes: dict, attribute_mapping: dict, force_save: bool = False
+    async def aauthenticate(
+        self,
+        request,
+        session_info=None,
+        attribute_mapping=None,
+        create_unknown_user=True,
+        assertion_info=None,
+        **kwargs,
     ):
-        """Update a user with a set of attributes and returns the updated user.
+        """Async counterpart of authenticate, using the async ORM API.
 
-        By default it uses a mapping defined in the settings constant
-        SAML_ATTRIBUTE_MAPPING. For each attribute, if the user object has
-        that field defined it will be set.
+        Every step falls back to its sync counterpart, run in a thread, when
+        a subclass overrides that one and not the async one.
         """
+        if self._overrides("authenticate"):
+            return await sync_to_async(self.authenticate)(
+                request,
+                session_info=session_info,
+                attribute_mapping=attribute_mapping,
+                create_unknown_user=create_unknown_user,
+                assertion_info=assertion_info,
+                **kwargs,
+            )
 
-        # No attributes to set on the user instance, nothing to update
-        if not attribute_mapping:
-            # Always save a brand new user instance
-            if user.pk is None:
-                user = self.save_user(user)
+        if session_info is None or attribute_mapping is None:
+            logger.info("Session info or attribute mapping are None")
+            return None
+
+        if "ava" not in session_info:
+            logger.error('"ava" key not found in session_info')
+            return None
+
+        idp_entityid = session_info["issuer"]
+
+        attributes = await self._acall(
+            "clean_attributes", self.clean_attributes, session_info["ava"], idp_entityid
+        )
+
+        logger.debug(f"attributes: {attributes}")
+
+        if not await self.ais_authorized(
+            attributes, attribute_mapping, idp_entityid, assertion_info
+        ):
+            logger.error("Request not authorized")
+            return None
+
+        user_lookup_key, user_lookup_value = await self._acall(
+            "clean_user_main_attribute",
+            self._extract_user_identifier_params,
+            session_info,
+            attributes,
+            attribute_mapping,
+        )
+        if not user_lookup_value:
+            logger.error("Could not determine user identifier")
+            return None
+
+        fingerprints = self._user_fingerprint_cache()
+        if fingerprints is not None:
+            digest = fingerprints.get_digest(attributes, attribute_mapping)
+            with phase("lookup"):
+                user = await self._aget_fingerprinted_user(
+                    await fingerprints.aget(
+                        idp_entityid, user_lookup_key, user_lookup_value
+                    ),
+                    digest,
+                )
+            if user is not None:
+                return user if await self._auser_can_authenticate(user) else None
+
+        with phase("lookup"):
+            user, created = await self.aget_or_create_user(
+                user_lookup_key,
+                user_lookup_value,
+                create_unknown_user,
+                idp_entityid=idp_entityid,
+                attributes=attributes,
+                attribute_mapping=attribute_mapping,
+                request=request,
+            )
+
+        # Update user with new attributes from incoming request
+        if user is not None:
+            with phase("update"):
+                user = await self._aupdate_user(
+                    user, attributes, attribute_mapping, force_save=created
+                )
+            if fingerprints is not None and user.pk is not None:
+                await fingerprints.aset(
+                    idp_entityid, user_lookup_key, user_lookup_value, user, digest
+                )
+
+        if await self._auser_can_authenticate(user):
             return user
 
-        # Lookup key
-        user_lookup_key = self._user_lookup_attribute
-        has_updated_fields = False
-        for saml_attr, django_attrs in attribute_mapping.items():
+    def _overrides(self, name: str) -> bool:
+        """Whether a subclass overrides the method name of Saml2Backend."""
+        return getattr(type(self), name) is not getattr(Saml2Backend, name)
+
+    async def _acall(self, hook: str, func: Callable, *args, **kwargs):
+        """Call func, in a thread if a subclass overrides the hook it runs."""
+        if self._overrides(hook):
+            return await sync_to_async(func)(*args, **kwargs)
+        return func(*args, **kwargs)
+
+    async def _auser_can_authenticate(self, user) -> bool:
+        return await self._acall(
+            "user_can_authenticate", self.user_can_authenticate, user
+        )
+
+    def _user_fingerprint_cache(self) -> Optional[UserFingerprintCache]:
+        """The fingerprint cache of SAML_USER_FINGERPRINT_CACHE. Its hits skip
+        looking the user up, updating it and saving it, it's not used when a
+        subclass overrides those.
+        """
+        for name in (
+            "get_or_create_user",
+            "aget_or_create_user",
+            "_update_user",
+            "_aupdate_user",
+            "save_user",
+            "asave_user",
+        ):
+            if self._overrides(name):
+                return None
+        return get_user_fingerprint_cache()
+
+    def _get_fingerprinted_user(self, fingerprint: Optional[tuple], digest: str):
+        """Return the user of the fingerprint if it has the digest, or None."""
+        if fingerprint is None or fingerprint[1] != digest:
+            return None
+        try:
+            return self._user_model._default_manager.get(pk=fingerprint[0])
+        except ObjectDoesNotExist:
+            return None
+
+    async def _aget_fingerprinted_user(self, fingerprint: Optional[tuple], digest: str):
+        if fingerprint is None or fingerprint[1] != digest:
+            return None
+        try:
+            return await self._user_model._default_manager.aget(pk=fingerprint[0])
+        except ObjectDoesNotExist:
+            return None
+
+    def _apply_attributes(
+        self, user, attributes: dict, plan: AttributeMappingPlan
+    ) -> tuple[set, bool]:
+        """Set the attributes of the SAML response on the user, and call its
+        methods with them, in the order of the attribute mapping plan.
+
+        Return the fields set, and whether other attributes were set.
+        """
+        updated_fields = set()
+        # what methods and other attributes change is unknown, all is saved
+        has_updated_attributes = False
+        for saml_attr, django_attrs, targets in plan.steps:
             attr_value_list = attributes.get(saml_attr)
             if not attr_value_list:
                 logger.debug(
@@ -200,26 +483,108 @@ class Saml2Backend(ModelBackend):
                 )
                 continue
 
-            for attr in django_attrs:
-                if attr == user_lookup_key:
-                    # Don't update user_lookup_key (e.g. username) (issue #245)
-                    # It was just used to find/create this user and might have
-                    # been changed by `clean_user_main_attribute`
+            for attr, kind in targets:
+                if kind == plan.FIELD:
+                    # set_attribute, inlined for mappings of many attributes
+                    value = attr_value_list[0]
+                    if getattr(user, attr, _missing) != value:
+                        setattr(user, attr, value)
+                        updated_fields.add(attr)
                     continue
+                elif kind == plan.CALL:
+                    modified = getattr(user, attr)(attr_value_list)
+                elif kind == plan.SET:
+                    modified = set_attribute(user, attr, attr_value_list[0])
                 elif hasattr(user, attr):
                     user_attr = getattr(user, attr)
                     if callable(user_attr):
                         modified = user_attr(attr_value_list)
                     else:
                         modified = set_attribute(user, attr, attr_value_list[0])
-
-                    has_updated_fields = has_updated_fields or modified
                 else:
                     logger.debug(f'Could not find attribute "{attr}" on user "{user}"')
+                    continue
+
+                has_updated_attributes = has_updated_attributes or modified
+
+        return updated_fields, has_updated_attributes
+
+    @staticmethod
+    def _save_kwargs(
+        user, updated_fields: set, has_updated_attributes: bool, force_save: bool
+    ) -> Optional[dict]:
+        """The arguments of save_user() once the user is updated, or None if
+        it's left unchanged.
+        """
+        if has_updated_attributes or force_save:
+            return {}
+        if updated_fields:
+            # a new user is inserted whole
+            return {
+                "update_fields": None if user._state.adding else sorted(updated_fields)
+            }
+        return None
+
+    def _update_user(
+        self, user, attributes: dict, attribute_mapping: dict, force_save: bool = False
+    ):
+        """Update a user with a set of attributes and returns the updated user.
+
+        By default it uses a mapping defined in the settings constant
+        SAML_ATTRIBUTE_MAPPING. For each attribute, if the user object has
+        that field defined it will be set.
+        """
+
+        # No attributes to set on the user instance, nothing to update
+        if not attribute_mapping:
+            # Always save a brand new user instance
+            if user.pk is None:
+                user = self.save_user(user)
+            return user
 
-        if has_updated_fields or force_save:
-            user = self.save_user(user)
+        plan = self._attribute_mapping_plan(attribute_mapping, type(user))
+        updated_fields, has_updated_attributes = self._apply_attributes(
+            user, attributes, plan
+        )
 
+        save_kwargs = self._save_kwargs(
+            user, updated_fields, has_updated_attributes, force_save
+        )
+        if save_kwargs is not None:
+            user = self.save_user(user, **save_kwargs)
+        return user
+
+    async def _aupdate_user(
+        self, user, attributes: dict, attribute_mapping: dict, force_save: bool = False
+    ):
+        """Async counterpart of _update_user. The attributes are set in a
+        thread if the mapping targets methods of the user, that may use the ORM.
+        """
+        if self._overrides("_update_user"):
+            return await sync_to_async(self._update_user)(
+                user, attributes, attribute_mapping, force_save=force_save
+            )
+
+        if not attribute_mapping:
+            if user.pk is None:
+                user = await self.asave_user(user)
+            return user
+
+        plan = self._attribute_mapping_plan(attribute_mapping, type(user))
+        if plan.calls:
+            updated_fields, has_updated_attributes = await sync_to_async(
+                self._apply_attributes
+            )(user, attributes, plan)
+        else:
+            updated_fields, has_updated_attributes = self._apply_attributes(
+                user, attributes, plan
+            )
+
+        save_kwargs = self._save_kwargs(
+            user, updated_fields, has_updated_attributes, force_save
+        )
+        if save_kwargs is not None:
+            user = await self.asave_user(user, **save_kwargs)
         return user
 
     # ############################################
@@ -241,6 +606,23 @@ class Saml2Backend(ModelBackend):
         """Hook to allow custom authorization policies based on SAML attributes. True by default."""
         return True
 
+    async def ais_authorized(
+        self,
+        attributes: dict,
+        attribute_mapping: dict,
+        idp_entityid: str,
+        assertion_info: dict,
+        **kwargs,
+    ) -> bool:
+        """Async counterpart of is_authorized."""
+        if self._overrides("is_authorized"):
+            return await sync_to_async(self.is_authorized)(
+                attributes, attribute_mapping, idp_entityid, assertion_info, **kwargs
+            )
+        return self.is_authorized(
+            attributes, attribute_mapping, idp_entityid, assertion_info, **kwargs
+        )
+
     def user_can_authenticate(self, user) -> bool:
         """
         Reject users with is_active=False. Custom user models that don't have
@@ -268,43 +650,122 @@ class Saml2Backend(ModelBackend):
         e.g. customize this per IdP.
         """
         UserModel = self._user_model
+        user_query_args = self._user_query_args(user_lookup_key, user_lookup_value)
+
+        # Lookup existing user
+        try:
+            return UserModel.objects.get(**user_query_args), False
+        except (MultipleObjectsReturned, UserModel.DoesNotExist) as e:
+            return self._user_not_found(
+                e,
+                user_query_args,
+                user_lookup_key,
+                user_lookup_value,
+                create_unknown_user,
+            )
 
-        # Construct query parameters to query the userModel with. An additional lookup modifier could be specified in the settings.
-        user_query_args = {
+    async def aget_or_create_user(
+        self,
+        user_lookup_key: str,
+        user_lookup_value: Any,
+        create_unknown_user: bool,
+        idp_entityid: str,
+        attributes: dict,
+        attribute_mapping: dict,
+        request,
+    ) -> tuple[Optional[settings.AUTH_USER_MODEL], bool]:
+        """Async counterpart of get_or_create_user."""
+        if self._overrides("get_or_create_user"):
+            return await sync_to_async(self.get_or_create_user)(
+                user_lookup_key,
+                user_lookup_value,
+                create_unknown_user,
+                idp_entityid=idp_entityid,
+                attributes=attributes,
+                attribute_mapping=attribute_mapping,
+                request=request,
+            )
+
+        UserModel = self._user_model
+        user_query_args = self._user_query_args(user_lookup_key, user_lookup_value)
+
+        try:
+            return await UserModel.objects.aget(**user_query_args), False
+        except (MultipleObjectsReturned, UserModel.DoesNotExist) as e:
+            return self._user_not_found(
+                e,
+                user_query_args,
+                user_lookup_key,
+                user_lookup_value,
+                create_unknown_user,
+            )
+
+    @staticmethod
+    def _user_query_args(user_lookup_key: str, user_lookup_value: Any) -> dict:
+        """Construct query parameters to query the userModel with. An
+        additional lookup modifier could be specified in the settings.
+        """
+        return {
             user_lookup_key
             + getattr(
                 settings, "SAML_DJANGO_USER_MAIN_ATTRIBUTE_LOOKUP", ""
             ): user_lookup_value
         }
 
-        # Lookup existing user
-        user, created = None, False
-        try:
-            user = UserModel.objects.get(**user_query_args)
-        except MultipleObjectsReturned:
+    def _user_not_found(
+        self,
+        error: Exception,
+        user_query_args: dict,
+        user_lookup_key: str,
+        user_lookup_value: Any,
+        create_unknown_user: bool,
+    ) -> tuple[Optional[settings.AUTH_USER_MODEL], bool]:
+        """What get_or_create_user returns when the lookup raised error. To
+        be called while handling it.
+        """
+        UserModel = self._user_model
+        if isinstance(error, MultipleObjectsReturned):
             logger.exception(
                 f"Multiple users match, model: {UserModel._meta}, lookup: {user_query_args}",
             )
-        except UserModel.DoesNotExist:
-            # Create new one if desired by settings
-            if create_unknown_user:
-                user = UserModel(**{user_lookup_key: user_lookup_value})
-                user.set_unusable_password()
-                created = True
-                logger.debug(f"New user created: {user}", exc_info=True)
-            else:
-                logger.exception(
-                    f"The user does not exist, model: {UserModel._meta}, lookup: {user_query_args}"
-                )
-
-        return user, created
+        # Create new one if desired by settings
+        elif create_unknown_user:
+            user = UserModel(**{user_lookup_key: user_lookup_value})
+            user.set_unusable_password()
+            logger.debug(f"New user created: {user}", exc_info=True)
+            return user, True
+        else:
+            logger.exception(
+                f"The user does not exist, model: {UserModel._meta}, lookup: {user_query_args}"
+            )
+        return None, False
 
     def save_user(
         self, user: settings.AUTH_USER_MODEL, *args, **kwargs
     ) -> settings.AUTH_USER_MODEL:
-        """Hook to add custom logic around saving a user. Return the saved user instance."""
+        """Hook to add custom logic around saving a user. Return the saved user instance.
+
+        update_fields, if given, are the only fields that changed.
+        """
+        is_new_instance = user.pk is None
+        user.save(update_fields=kwargs.get("update_fields"))
+
+        if is_new_instance:
+            logger.debug("New user created")
+        else:
+            logger.debug(f"User {user} updated with incoming attributes")
+
+        return user
+
+    async def asave_user(
+        self, user: settings.AUTH_USER_MODEL, *args, **kwargs
+    ) -> settings.AUTH_USER_MODEL:
+        """Async counterpart of save_user."""
+        if self._overrides("save_user"):
+            return await sync_to_async(self.save_user)(user, *args, **kwargs)
+
         is_new_instance = user.pk is None
-        user.save()
+        await user.asave(update_fields=kwargs.get("update_fields"))
 
         if is_new_instance:
             logger.debug("New user created")
@@ -13,7 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import calendar
+import hashlib
+import math
+import time
+from typing import Optional
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
 from saml2.cache import Cache
+from saml2.time_util import str_to_time
+
+from .utils import get_custom_setting
 
 
 class DjangoSessionCacheAdapter(dict):
@@ -89,3 +105,266 @@ class StateCache(DjangoSessionCacheAdapter):
 
     def __init__(self, django_session):
         super().__init__(django_session, "_state")
+
+
+class AssertionReplayCache:
+    """Remembers the bearer assertions consumed, in a Django cache shared by
+    all the processes, so that each one is accepted once only.
+
+    An assertion is checked and recorded with a single atomic add(), and its
+    entry expires when the assertion does: at its NotOnOrAfter, plus the
+    clock skew accepted by pysaml2. Entries are kept max_ttl seconds at most,
+    and the number of entries is bounded by the cache backend (MAX_ENTRIES).
+    """
+
+    key_prefix = "djangosaml2:assertion:"
+
+    def __init__(self, alias: str = "default", max_ttl: int = 3600):
+        self.alias = alias
+        self.max_ttl = max_ttl
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_key(self, issuer: Optional[str], assertion_id: str) -> str:
+        # assertion IDs are unique per issuer and may not be valid cache keys
+        digest = hashlib.sha256(f"{issuer or ''}\0{assertion_id}".encode()).hexdigest()
+        return self.key_prefix + digest
+
+    def get_timeout(self, not_on_or_after: Optional[str], skew: int = 0) -> int:
+        if not not_on_or_after:
+            return self.max_ttl
+        try:
+            expires_at = calendar.timegm(str_to_time(not_on_or_after))
+        except (AttributeError, TypeError, ValueError):
+            return self.max_ttl
+        timeout = math.ceil(expires_at + skew - time.time())
+        return max(1, min(timeout, self.max_ttl))
+
+    def add(
+        self,
+        issuer: Optional[str],
+        assertion_id: str,
+        not_on_or_after: Optional[str] = None,
+        skew: int = 0,
+    ) -> bool:
+        """Record the assertion, return False if it was recorded already."""
+        return self.cache.add(
+            self.get_key(issuer, assertion_id),
+            1,
+            timeout=self.get_timeout(not_on_or_after, skew),
+        )
+
+    async def aadd(
+        self,
+        issuer: Optional[str],
+        assertion_id: str,
+        not_on_or_after: Optional[str] = None,
+        skew: int = 0,
+    ) -> bool:
+        return await self.cache.aadd(
+            self.get_key(issuer, assertion_id),
+            1,
+            timeout=self.get_timeout(not_on_or_after, skew),
+        )
+
+
+def get_assertion_replay_cache() -> Optional[AssertionReplayCache]:
+    """Return the replay cache configured by SAML_ASSERTION_REPLAY_CACHE,
+    the alias of the Django cache to use, or None if it's not set.
+    """
+    alias = get_custom_setting("SAML_ASSERTION_REPLAY_CACHE", None)
+    if not alias:
+        return None
+    return AssertionReplayCache(
+        alias, max_ttl=get_custom_setting("SAML_ASSERTION_REPLAY_MAX_TTL", 3600)
+    )
+
+
+class UserFingerprintCache:
+    """Remembers, for each user logged in by an IdP, the primary key of the
+    user and a digest of the mapped attributes it was last updated with, so
+    that a login bringing the same attributes skips looking the user up and
+    updating it: the user is fetched by its primary key.
+
+    The entries of a user hold the generation of the user they were set in,
+    which is bumped when the user is saved or deleted, unless the save is of
+    its last_login only, as logging in does. Entries of another generation are
+    ignored.
+    """
+
+    key_prefix = "djangosaml2:user:"
+
+    def __init__(self, alias: str = "default", timeout: int = 3600):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_key(self, idp_entityid: str, lookup_key: str, lookup_value) -> str:
+        digest = hashlib.sha256(
+            f"{idp_entityid}\0{lookup_key}\0{lookup_value}".encode()
+        ).hexdigest()
+        return self.key_prefix + digest
+
+    def get_user_key(self, model_label: str, pk) -> str:
+        """The key of the generation of a user."""
+        digest = hashlib.sha256(f"{model_label}\0{pk}".encode()).hexdigest()
+        return f"{self.key_prefix}pk:{digest}"
+
+    @staticmethod
+    def get_digest(attributes: dict, attribute_mapping: dict) -> str:
+        mapped = sorted(
+            (saml_attr, tuple(django_attrs), tuple(attributes.get(saml_attr) or ()))
+            for saml_attr, django_attrs in attribute_mapping.items()
+        )
+        return hashlib.sha256(repr(mapped).encode()).hexdigest()
+
+    @staticmethod
+    def _new_generation() -> int:
+        # a generation expired, or evicted, must not come back
+        return time.time_ns()
+
+    def get(self, idp_entityid: str, lookup_key: str, lookup_value):
+        """Return the (pk, digest) of the user, or None."""
+        entry = self.cache.get(self.get_key(idp_entityid, lookup_key, lookup_value))
+        if entry is None:
+            return None
+        pk, digest, user_key, generation = entry
+        if self.cache.get(user_key) != generation:
+            return None
+        return pk, digest
+
+    async def aget(self, idp_entityid: str, lookup_key: str, lookup_value):
+        entry = await self.cache.aget(
+            self.get_key(idp_entityid, lookup_key, lookup_value)
+        )
+        if entry is None:
+            return None
+        pk, digest, user_key, generation = entry
+        if await self.cache.aget(user_key) != generation:
+            return None
+        return pk, digest
+
+    def set(self, idp_entityid: str, lookup_key: str, lookup_value, user, digest: str):
+        user_key = self.get_user_key(user._meta.label_lower, user.pk)
+        generation = self.cache.get_or_set(
+            user_key, self._new_generation, timeout=self.timeout
+        )
+        self.cache.set(
+            self.get_key(idp_entityid, lookup_key, lookup_value),
+            (user.pk, digest, user_key, generation),
+            timeout=self.timeout,
+        )
+
+    async def aset(
+        self, idp_entityid: str, lookup_key: str, lookup_value, user, digest: str
+    ):
+        user_key = self.get_user_key(user._meta.label_lower, user.pk)
+        generation = await self.cache.aget_or_set(
+            user_key, self._new_generation, timeout=self.timeout
+        )
+        await self.cache.aset(
+            self.get_key(idp_entityid, lookup_key, lookup_value),
+            (user.pk, digest, user_key, generation),
+            timeout=self.timeout,
+        )
+
+    def invalidate(self, model_label: str, pk):
+        """Invalidate the entries of a user."""
+        try:
+            self.cache.incr(self.get_user_key(model_label, pk))
+        except ValueError:
+            # without a generation, the user has no valid entries
+            pass
+
+    def invalidate_many(self, model_label: str, pks):
+        """Invalidate the entries of the users of some primary keys."""
+        for pk in pks:
+            self.invalidate(model_label, pk)
+
+
+def get_user_fingerprint_cache() -> Optional[UserFingerprintCache]:
+    """Return the fingerprint cache configured by SAML_USER_FINGERPRINT_CACHE,
+    the alias of the Django cache to use, or None if it's not set.
+    """
+    alias = get_custom_setting("SAML_USER_FINGERPRINT_CACHE", None)
+    if not alias:
+        return None
+    return UserFingerprintCache(
+        alias, timeout=get_custom_setting("SAML_USER_FINGERPRINT_TIMEOUT", 3600)
+    )
+
+
+def invalidate_users_fingerprints(user_model, pks):
+    """Invalidate the fingerprints of the users of user_model with the primary
+    keys pks, if SAML_USER_FINGERPRINT_CACHE is set.
+
+    Saving and deleting users invalidates their fingerprints through signals,
+    code changing users without them, such as QuerySet.update() or
+    bulk_update(), calls this instead::
+
+        users.update(is_active=False)
+        invalidate_users_fingerprints(User, users.values_list("pk", flat=True))
+    """
+    fingerprints = get_user_fingerprint_cache()
+    if fingerprints is not None:
+        fingerprints.invalidate_many(user_model._meta.label_lower, pks)
+
+
+def invalidate_user_fingerprints(sender, instance, update_fields=None, **kwargs):
+    """post_save and post_delete receiver invalidating the fingerprints of
+    the user saved or deleted.
+    """
+    if update_fields is not None and set(update_fields) <= {"last_login"}:
+        return
+    fingerprints = get_user_fingerprint_cache()
+    if fingerprints is not None:
+        fingerprints.invalidate(sender._meta.label_lower, instance.pk)
+
+
+_fingerprinted_user_model = None
+
+
+def connect_user_fingerprint_receivers():
+    """Connect invalidate_user_fingerprints to the post_save and post_delete
+    signals of the SAML user model if SAML_USER_FINGERPRINT_CACHE is set.
+    """
+    global _fingerprinted_user_model
+
+    for signal in (post_save, post_delete):
+        signal.disconnect(
+            sender=_fingerprinted_user_model,
+            dispatch_uid="djangosaml2_user_fingerprints",
+        )
+    _fingerprinted_user_model = None
+    if not get_custom_setting("SAML_USER_FINGERPRINT_CACHE", None):
+        return
+
+    try:
+        user_model = apps.get_model(
+            getattr(settings, "SAML_USER_MODEL", settings.AUTH_USER_MODEL)
+        )
+    except (LookupError, ValueError):
+        # reported by the backend
+        return
+    for signal in (post_save, post_delete):
+        signal.connect(
+            invalidate_user_fingerprints,
+            sender=user_model,
+            dispatch_uid="djangosaml2_user_fingerprints",
+        )
+    _fingerprinted_user_model = user_model
+
+
+@receiver(setting_changed)
+def _connect_user_fingerprint_receivers(setting, **kwargs):
+    if setting in (
+        "SAML_USER_FINGERPRINT_CACHE",
+        "SAML_USER_MODEL",
+        "AUTH_USER_MODEL",
+    ):
+        connect_user_fingerprint_receivers()
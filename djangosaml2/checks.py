@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured
+
+from django.contrib import auth
+
+
+def _saml2_backend():
+    from .backends import Saml2Backend
+
+    for backend in auth.get_backends():
+        if isinstance(backend, Saml2Backend):
+            return backend
+    return None
+
+
+@checks.register()
+def check_attribute_mapping(app_configs, **kwargs):
+    """Validate SAML_ATTRIBUTE_MAPPING against the user model of the SAML
+    backend, compiling it ahead of the first login.
+    """
+    attribute_mapping = getattr(settings, "SAML_ATTRIBUTE_MAPPING", None)
+    if attribute_mapping is None:
+        return []
+    if not isinstance(attribute_mapping, dict):
+        return [
+            checks.Error(
+                "SAML_ATTRIBUTE_MAPPING must be a dict.",
+                id="djangosaml2.E001",
+            )
+        ]
+
+    errors = [
+        checks.Error(
+            f'SAML_ATTRIBUTE_MAPPING["{saml_attr}"] must be a list or a tuple of '
+            f"user attributes, not {type(django_attrs).__name__}.",
+            id="djangosaml2.E001",
+        )
+        for saml_attr, django_attrs in attribute_mapping.items()
+        if not isinstance(django_attrs, (list, tuple))
+    ]
+    backend = _saml2_backend()
+    if errors or backend is None:
+        return errors
+
+    try:
+        user_model = backend._user_model
+    except ImproperlyConfigured as e:
+        return [checks.Error(str(e), id="djangosaml2.E002")]
+
+    plan = backend._attribute_mapping_plan(attribute_mapping, user_model)
+    return [
+        checks.Warning(
+            f'SAML_ATTRIBUTE_MAPPING maps to "{attr}", which '
+            f"{user_model._meta.label} doesn't have.",
+            hint="It's only updated on users that have it as an instance attribute.",
+            id="djangosaml2.W001",
+        )
+        for attr in plan.unresolved
+    ]
@@ -14,15 +14,26 @@
 # limitations under the License.
 
 import copy
-from typing import Callable, Optional, Union
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from types import ModuleType
+from typing import Any, Callable, Hashable, Optional, Union
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.http import HttpRequest
 from django.utils.module_loading import import_string
 
-from saml2.config import SPConfig
-
+from .metadata import MetadataRefresher, mdq_entity_cache
+from .overrides import SPConfig
+from .singleflight import SingleFlight
 from .utils import get_custom_setting
 
 
@@ -39,16 +50,339 @@ def get_config_loader(path: str) -> Callable:
     return config_loader
 
 
+def config_fingerprint(saml_config: dict) -> str:
+    """Return a stable digest of a SAML_CONFIG-like dictionary.
+    Values that are not JSON serializable (callables, paths objects, ...)
+    are represented by their repr.
+    """
+    try:
+        payload = json.dumps(saml_config, sort_keys=True, default=repr)
+    except TypeError:
+        # mixed key types cannot be sorted
+        payload = repr(saml_config)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SPConfigCache:
+    """Process-wide cache of the SPConfig built from settings.SAML_CONFIG.
+
+    The loaded config is shared across requests and threads, so it must be
+    treated as read-only by its consumers. It is keyed by the fingerprint of
+    SAML_CONFIG, computed once per SAML_CONFIG object: in-place changes to
+    the setting are only picked up once the cache is cleared, as it is when
+    Django emits setting_changed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fingerprint = None
+        self._config = None
+        self._metadata_conf = None
+        # the last (SAML_CONFIG, fingerprint) computed, the setting is kept
+        # so that its id isn't reused
+        self._memo = None
+        self.hits = 0
+        self.misses = 0
+
+    def fingerprint(self, saml_config: dict) -> str:
+        """Return config_fingerprint(saml_config), memoized per object."""
+        memo = self._memo
+        if memo is not None and memo[0] is saml_config:
+            return memo[1]
+        fingerprint = config_fingerprint(saml_config)
+        self._memo = (saml_config, fingerprint)
+        return fingerprint
+
+    def get(self, saml_config: dict) -> SPConfig:
+        fingerprint = self.fingerprint(saml_config)
+        config = self._config
+        if config is not None and fingerprint == self._fingerprint:
+            with self._lock:
+                self.hits += 1
+            return config
+
+        with self._lock:
+            # another thread may have loaded it while we were waiting
+            if self._config is not None and fingerprint == self._fingerprint:
+                self.hits += 1
+                return self._config
+
+            self.misses += 1
+            config = SPConfig()
+            config.load(copy.deepcopy(saml_config))
+            self._config, self._fingerprint = config, fingerprint
+            self._metadata_conf = copy.deepcopy(saml_config.get("metadata", {}))
+        return config
+
+    def holds(self, saml_config: dict) -> bool:
+        """Whether the config of saml_config is cached."""
+        return (
+            self._config is not None
+            and self.fingerprint(saml_config) == self._fingerprint
+        )
+
+    def current(self) -> tuple:
+        """Return the cached config along with its metadata specification."""
+        with self._lock:
+            return self._config, self._metadata_conf
+
+    def swap_metadata(self, config: SPConfig, metadata) -> bool:
+        """Replace the metadata of the cached config, unless it has been
+        replaced in the meantime.
+        """
+        with self._lock:
+            if config is not self._config:
+                return False
+            config.setattr("", "metadata", metadata)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._config = None
+            self._fingerprint = None
+            self._metadata_conf = None
+            self._memo = None
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+sp_config_cache = SPConfigCache()
+metadata_refresher = MetadataRefresher(sp_config_cache)
+
+
+def approximate_size(obj: Any) -> int:
+    """Roughly estimate the memory held by an object graph, in bytes.
+    Only containers and instance attributes are followed, every object
+    is counted once.
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen or callable(item) or isinstance(item, ModuleType):
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item, 0)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif hasattr(item, "__dict__"):
+            stack.append(item.__dict__)
+    return size
+
+
+class SPConfigRegistry:
+    """Bounded registry of SPConfig instances for multi-tenant config loaders.
+
+    Entries are keyed by a loader-provided tenant key (host, entity ID, ...),
+    evicted by LRU once SAML_CONFIG_REGISTRY_MAX_ENTRIES or
+    SAML_CONFIG_REGISTRY_MAX_BYTES is exceeded and expire after
+    SAML_CONFIG_REGISTRY_TTL seconds. Concurrent requests for a cold tenant
+    are coalesced, so that its config is built only once.
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+    ):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._flight = SingleFlight("config")
+        # key -> (config, expires_at, size)
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_entries(self) -> Optional[int]:
+        if self._max_entries is not None:
+            return self._max_entries
+        return get_custom_setting("SAML_CONFIG_REGISTRY_MAX_ENTRIES", 128)
+
+    @property
+    def max_bytes(self) -> Optional[int]:
+        if self._max_bytes is not None:
+            return self._max_bytes
+        return get_custom_setting("SAML_CONFIG_REGISTRY_MAX_BYTES", None)
+
+    @property
+    def ttl(self) -> Optional[float]:
+        if self._ttl is not None:
+            return self._ttl
+        return get_custom_setting("SAML_CONFIG_REGISTRY_TTL", 3600)
+
+    def _lookup(self, key: Hashable) -> Optional[SPConfig]:
+        """Return a live entry and mark it as recently used. Holds self._lock."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        config, expires_at, size = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._discard(key)
+            return None
+        self._entries.move_to_end(key)
+        return config
+
+    def _discard(self, key: Hashable):
+        """Remove an entry. Holds self._lock."""
+        _config, _expires_at, size = self._entries.pop(key)
+        self._total_bytes -= size
+
+    def _evict(self):
+        """Drop least recently used entries until within bounds. Holds self._lock."""
+        max_entries, max_bytes = self.max_entries, self.max_bytes
+        while len(self._entries) > 1 and (
+            (max_entries is not None and len(self._entries) > max_entries)
+            or (max_bytes is not None and self._total_bytes > max_bytes)
+        ):
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    def get(self, key: Hashable, builder: Callable[[], SPConfig]) -> SPConfig:
+        """Return the config registered for key, calling builder to create it
+        if it's missing or expired.
+        """
+        with self._lock:
+            config = self._lookup(key)
+            if config is not None:
+                self.hits += 1
+                return config
+        return self._flight.do(key, lambda: self._build(key, builder))
+
+    def _build(self, key: Hashable, builder: Callable[[], SPConfig]) -> SPConfig:
+        with self._lock:
+            # built by a flight that completed while we were getting here
+            config = self._lookup(key)
+            if config is not None:
+                self.hits += 1
+                return config
+            self.misses += 1
+
+        config = builder()
+        size = approximate_size(config) if self.max_bytes is not None else 0
+        ttl = self.ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+            self._entries[key] = (config, expires_at, size)
+            self._total_bytes += size
+            self._evict()
+        return config
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """Forget the config of a tenant, or of all of them if key is None."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._total_bytes = 0
+            elif key in self._entries:
+                self._discard(key)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "coalesced": self._flight.coalesced,
+        }
+
+
+sp_config_registry = SPConfigRegistry()
+
+
+def registry_config_loader(
+    key_func: Callable[[Optional[HttpRequest]], Hashable],
+    registry: Optional[SPConfigRegistry] = None,
+) -> Callable:
+    """Decorator that makes a custom SAML_CONFIG_LOADER use the SPConfig registry.
+
+    key_func is called with the request and returns the tenant key, e.g.
+    ``lambda request: request.get_host()``.
+    """
+
+    def decorator(config_loader: Callable) -> Callable:
+        @wraps(config_loader)
+        def wrapper(request: Optional[HttpRequest] = None) -> SPConfig:
+            return (registry or sp_config_registry).get(
+                key_func(request), lambda: config_loader(request)
+            )
+
+        wrapper.uses_config_registry = True
+        return wrapper
+
+    return decorator
+
+
+@receiver(setting_changed)
+def _clear_sp_config_cache(setting, **kwargs):
+    # the shared clients, kept with the configs, depend on the timing settings
+    if setting in (
+        "SAML_CONFIG",
+        "SAML_CONFIG_CACHE_ENABLED",
+        "SAML_TIMING_SINKS",
+        "SAML_SERVER_TIMING",
+    ):
+        sp_config_cache.clear()
+    if setting == "SAML_CONFIG" or setting.startswith("SAML_CONFIG_REGISTRY_"):
+        sp_config_registry.invalidate()
+    if setting == "SAML_CONFIG" or setting.startswith("SAML_MDQ_"):
+        mdq_entity_cache.clear()
+
+
 def config_settings_loader(request: Optional[HttpRequest] = None) -> SPConfig:
     """Utility function to load the pysaml2 configuration.
     The configuration can be modified based on the request being passed.
     This is the default config loader, which just loads the config from the settings.
+
+    If SAML_CONFIG_CACHE_ENABLED is set, the loaded SPConfig is cached and
+    shared by all the requests served by this process. Its metadata is then
+    reloaded in background if SAML_METADATA_REFRESH_INTERVAL is set.
     """
+    if get_custom_setting("SAML_CONFIG_CACHE_ENABLED", False):
+        config = sp_config_cache.get(settings.SAML_CONFIG)
+        if get_custom_setting("SAML_METADATA_REFRESH_INTERVAL"):
+            metadata_refresher.ensure_running()
+        return config
+
     conf = SPConfig()
     conf.load(copy.deepcopy(settings.SAML_CONFIG))
     return conf
 
 
+def is_config_cached(
+    config_loader_path: Optional[Union[Callable, str]] = None,
+) -> bool:
+    """Whether the configs loaded by config_loader_path, SAML_CONFIG_LOADER by
+    default, are kept for the next requests: by the default loader when
+    SAML_CONFIG_CACHE_ENABLED is set, or by the loaders using the registry.
+    """
+    config_loader_path = config_loader_path or get_custom_setting(
+        "SAML_CONFIG_LOADER", "djangosaml2.conf.config_settings_loader"
+    )
+    if callable(config_loader_path):
+        config_loader = config_loader_path
+    else:
+        config_loader = get_config_loader(config_loader_path)
+
+    if config_loader is config_settings_loader:
+        return bool(get_custom_setting("SAML_CONFIG_CACHE_ENABLED", False))
+    return getattr(config_loader, "uses_config_registry", False)
+
+
 def get_config(
     config_loader_path: Optional[Union[Callable, str]] = None,
     request: Optional[HttpRequest] = None,
@@ -0,0 +1,216 @@
+import hashlib
+import logging
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+
+from saml2.sigver import (
+    CryptoBackend,
+    CryptoBackendXmlSec1,
+    DecryptError,
+    SignatureError,
+    XmlsecError,
+    get_xmlsec_binary,
+)
+
+try:
+    import xmlsec
+    from lxml import etree
+except ImportError:  # pragma: no cover
+    xmlsec = None
+
+logger = logging.getLogger("djangosaml2")
+
+
+class CryptoBackendXMLSecBinding(CryptoBackend):
+    """
+    CryptoBackend that signs, verifies and decrypts in process with the
+    xmlsec Python binding (https://pypi.org/project/xmlsec/), instead of
+    running the xmlsec1 binary on temporary files for every operation.
+
+    Keys are loaded once and kept by the digest of their content, since
+    pysaml2 hands the certificates it takes from the metadata over in new
+    temporary files every time. Encryption, only needed by IdPs, is left to
+    the fallback backend, the xmlsec1 one by default.
+    """
+
+    max_keys = 256
+
+    def __init__(self, fallback: CryptoBackend = None):
+        if xmlsec is None:
+            raise ImproperlyConfigured(
+                "The in-process crypto backend requires the xmlsec package: "
+                "pip install djangosaml2[xmlsec]"
+            )
+        super().__init__()
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self._keys = {}
+
+    def _fallback(self) -> CryptoBackend:
+        if self.fallback is None:
+            self.fallback = CryptoBackendXmlSec1(get_xmlsec_binary())
+        return self.fallback
+
+    @property
+    def version(self):
+        return ".".join(str(num) for num in xmlsec.get_libxmlsec_version())
+
+    def _key(self, key_file: str, key_format):
+        with open(key_file, "rb") as fp:
+            data = fp.read()
+        cache_key = (hashlib.sha256(data).digest(), key_format)
+        key = self._keys.get(cache_key)
+        if key is None:
+            key = xmlsec.Key.from_memory(data, key_format)
+            with self._lock:
+                if len(self._keys) >= self.max_keys:
+                    self._keys.clear()
+                self._keys[cache_key] = key
+        return key
+
+    @staticmethod
+    def _parse(text):
+        if not isinstance(text, bytes):
+            text = str(text).encode("utf-8")
+        parser = etree.XMLParser(
+            resolve_entities=False, no_network=True, remove_comments=False
+        )
+        root = etree.fromstring(text, parser)
+        if root.getroottree().docinfo.doctype:
+            raise XmlsecError("DTDs are not allowed")
+        return root
+
+    @staticmethod
+    def _start_node(root, node_name: str, node_id):
+        """Find the node the operation starts from, like xmlsec1 --node-id."""
+        if not node_id:
+            return root
+        namespace, tag = node_name.rsplit(":", 1)
+        for node in root.iter(f"{{{namespace}}}{tag}"):
+            if node.get("ID") == node_id:
+                return node
+        raise XmlsecError(f"Node {node_name} with ID {node_id} not found")
+
+    @staticmethod
+    def _register_ids(ctx, root, node_name: str):
+        """Register the ID attribute of the node_name elements only, like
+        xmlsec1 --id-attr:ID node_name does.
+        """
+        namespace, tag = node_name.rsplit(":", 1)
+        for node in root.iter(f"{{{namespace}}}{tag}"):
+            if node.get("ID") is not None:
+                ctx.register_id(node, "ID")
+
+    @staticmethod
+    def _check_references(root, signature):
+        """Allow same-document references to unique IDs only, like xmlsec1
+        --enabled-reference-uris empty,same-doc does.
+        """
+        for reference in signature.iter(f"{{{xmlsec.constants.DSigNs}}}Reference"):
+            uri = reference.get("URI", "")
+            if uri and not uri.startswith("#"):
+                raise XmlsecError(f"Reference to {uri} not allowed")
+            if uri and len(root.xpath("//*[@ID=$id]", id=uri[1:])) != 1:
+                raise XmlsecError(f"Reference to {uri} is ambiguous")
+
+    def sign_statement(self, statement, node_name, key_file, node_id):
+        """
+        Sign an XML statement.
+
+        :param statement: The statement to be signed
+        :param node_name: string like 'urn:oasis:names:...:Assertion'
+        :param key_file: The file where the key can be found
+        :param node_id:
+        :return: The signed statement
+        """
+        try:
+            root = self._parse(statement)
+            start = self._start_node(root, node_name, node_id)
+            signature = xmlsec.tree.find_node(start, xmlsec.constants.NodeSignature)
+            if signature is None:
+                raise XmlsecError("Signature template not found")
+            ctx = xmlsec.SignatureContext()
+            self._register_ids(ctx, root, node_name)
+            ctx.key = self._key(key_file, xmlsec.constants.KeyDataFormatPem)
+            ctx.sign(signature)
+        except (XmlsecError, xmlsec.Error, etree.LxmlError, OSError) as e:
+            raise SignatureError(f"Failed to sign {node_name} {node_id}: {e}") from e
+        return etree.tostring(root, encoding="unicode")
+
+    def validate_signature(self, signedtext, cert_file, cert_type, node_name, node_id):
+        """
+        Validate signature on XML document.
+
+        :param signedtext: The XML document as a string
+        :param cert_file: The public key that was used to sign the document
+        :param cert_type: The file type of the certificate
+        :param node_name: The name of the class that is signed
+        :param node_id: The identifier of the node
+        :return: Boolean True if the signature was correct otherwise False.
+        """
+        if cert_type != "pem":
+            raise SignatureError(f"Unsupported certificate type {cert_type}")
+        try:
+            root = self._parse(signedtext)
+            start = self._start_node(root, node_name, node_id)
+            signature = xmlsec.tree.find_node(start, xmlsec.constants.NodeSignature)
+            if signature is None:
+                raise XmlsecError("Signature not found")
+            self._check_references(root, signature)
+            ctx = xmlsec.SignatureContext()
+            self._register_ids(ctx, root, node_name)
+            ctx.key = self._key(cert_file, xmlsec.constants.KeyDataFormatCertPem)
+        except (XmlsecError, xmlsec.Error, etree.LxmlError, OSError) as e:
+            raise SignatureError(f"Failed to verify {node_name} {node_id}: {e}") from e
+
+        try:
+            ctx.verify(signature)
+        except xmlsec.Error as e:
+            # the same the xmlsec1 backend does when verification fails
+            raise XmlsecError(f"Verification failed: {e}") from e
+        return True
+
+    def decrypt(self, enctext, key_file):
+        """
+
+        :param enctext: XML document containing an encrypted part
+        :param key_file: The key to use for the decryption
+        :return: The decrypted document
+        """
+        try:
+            root = self._parse(enctext)
+            xmlsec.tree.add_ids(root, ["Id"])
+            enc_data = xmlsec.tree.find_node(
+                root, xmlsec.constants.NodeEncryptedData, xmlsec.constants.EncNs
+            )
+            if enc_data is None:
+                raise XmlsecError("EncryptedData not found")
+            manager = xmlsec.KeysManager()
+            manager.add_key(self._key(key_file, xmlsec.constants.KeyDataFormatPem))
+            ctx = xmlsec.EncryptionContext(manager)
+            decrypted = ctx.decrypt(enc_data)
+        except (XmlsecError, xmlsec.Error, etree.LxmlError, OSError) as e:
+            raise DecryptError(f"Failed to decrypt: {e}") from e
+
+        if enc_data is root:
+            root = decrypted
+        return etree.tostring(root, encoding="unicode")
+
+    def encrypt(self, text, recv_key, template, session_key_type, xpath=""):
+        return self._fallback().encrypt(
+            text, recv_key, template, session_key_type, xpath
+        )
+
+    def encrypt_assertion(
+        self,
+        statement,
+        enc_key,
+        template,
+        key_type="des-192",
+        node_xpath=None,
+        node_id=None,
+    ):
+        return self._fallback().encrypt_assertion(
+            statement, enc_key, template, key_type, node_xpath, node_id
+        )
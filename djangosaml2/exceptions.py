@@ -1,2 +1,10 @@
 class IdPConfigurationMissing(Exception):
     pass
+
+
+class ACSPoolUnavailable(Exception):
+    pass
+
+
+class SAMLResponseRejected(Exception):
+    pass
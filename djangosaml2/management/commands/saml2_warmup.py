@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from djangosaml2.conf import is_config_cached
+from djangosaml2.warmup import warmup
+
+
+class Command(BaseCommand):
+    help = "Load the SAML configuration, metadata and keys, reporting how long each phase took."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--config-loader",
+            default=None,
+            help="Dotted path to the SAML config loader, defaults to SAML_CONFIG_LOADER.",
+        )
+
+    def handle(self, *args, **options):
+        if not is_config_cached(options["config_loader"]):
+            raise CommandError(
+                "The SAML config isn't cached, nothing loaded would be kept: "
+                "set SAML_CONFIG_CACHE_ENABLED or use registry_config_loader."
+            )
+        timings = warmup(options["config_loader"])
+        for name, duration in timings.items():
+            self.stdout.write(f"{name}: {duration * 1000:.1f} ms")
@@ -0,0 +1,722 @@
+import calendar
+import copy
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+import saml2
+from saml2.extension import mdui
+from saml2.md import EntitiesDescriptor
+from saml2.mdstore import MetaDataExtern, MetaDataFile, MetaDataMDX, SourceNotFound
+from saml2.time_util import add_duration, str_to_time, valid
+
+from .singleflight import SingleFlight
+
+logger = logging.getLogger("djangosaml2")
+
+# bump it whenever the layout of the snapshot files changes
+SNAPSHOT_VERSION = 2
+
+
+def _local_metadata_files(paths: list) -> list:
+    """Expand the "local" metadata entries the same way pysaml2 does:
+    a directory stands for all the files it contains.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if os.path.isfile(os.path.join(path, name))
+            )
+        else:
+            files.append(path)
+    return files
+
+
+def _atomic_write(path: str, content: bytes):
+    """Write a file so that readers see either the old or the new content."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as fp:
+        fp.write(content)
+    os.replace(fp.name, path)
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _entities_descr_validity(entities_descr) -> Optional[dict]:
+    if entities_descr is None:
+        return None
+    return {
+        "valid_until": entities_descr.valid_until,
+        "cache_duration": entities_descr.cache_duration,
+    }
+
+
+class MetadataSnapshot:
+    """A versioned JSON snapshot of the entities parsed from local metadata files.
+
+    The snapshot records the digest of every source file, so that it's
+    discarded, and the XML parsed again, as soon as one of them changes.
+    """
+
+    def __init__(self, directory: str, files: list):
+        self.files = files
+        name = hashlib.sha256("\0".join(files).encode("utf-8")).hexdigest()
+        self.path = os.path.join(directory, f"metadata-{name[:32]}.json")
+
+    def header(self) -> dict:
+        return {
+            "version": SNAPSHOT_VERSION,
+            "pysaml2": saml2.__version__,
+            "sources": {path: _file_digest(path) for path in self.files},
+        }
+
+    def load(self, header: dict) -> Optional[dict]:
+        """Return the snapshot of each source file, its entities and the
+        validUntil and cacheDuration of its EntitiesDescriptor, or None if
+        the snapshot is missing, stale or holds expired metadata.
+        """
+        try:
+            with open(self.path, encoding="utf-8") as fp:
+                snapshot = json.load(fp)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logger.warning("Unreadable metadata snapshot %s", self.path, exc_info=True)
+            return None
+
+        if snapshot.get("header") != header:
+            logger.debug("Metadata snapshot %s is stale", self.path)
+            return None
+        if not all(valid(valid_until) for valid_until in snapshot["valid_until"]):
+            logger.debug("Metadata snapshot %s holds expired metadata", self.path)
+            return None
+        return snapshot["sources"]
+
+    def save(self, header: dict, sources: dict):
+        """Atomically write the entities parsed from each source file."""
+        valid_until = set()
+        for _md in sources.values():
+            if _md.entities_descr is not None and _md.entities_descr.valid_until:
+                valid_until.add(_md.entities_descr.valid_until)
+            for entity in _md.entity.values():
+                if entity.get("valid_until"):
+                    valid_until.add(entity["valid_until"])
+
+        snapshot = {
+            "header": header,
+            "valid_until": sorted(valid_until),
+            "sources": {
+                path: {
+                    "entities": _md.entity,
+                    "entities_descr": _entities_descr_validity(_md.entities_descr),
+                }
+                for path, _md in sources.items()
+            },
+        }
+        try:
+            _atomic_write(self.path, json.dumps(snapshot).encode("utf-8"))
+        except (OSError, TypeError, ValueError):
+            logger.warning(
+                "Could not write metadata snapshot %s", self.path, exc_info=True
+            )
+
+
+def load_local_metadata(mds, paths: list, snapshot_dir: str) -> dict:
+    """Return the MetaDataFile sources for the given "local" metadata entries,
+    restoring them from a snapshot in snapshot_dir when it's up to date.
+    """
+    files = _local_metadata_files(paths)
+    snapshot = MetadataSnapshot(snapshot_dir, files)
+    header = snapshot.header()
+
+    snapshots = snapshot.load(header)
+    if snapshots is not None:
+        sources = {}
+        for path in files:
+            _md = MetaDataFile(mds.attrc, path)
+            _md.entity = snapshots[path]["entities"]
+            validity = snapshots[path]["entities_descr"]
+            if validity is not None:
+                # what metadata_expiry needs of the EntitiesDescriptor
+                _md.entities_descr = EntitiesDescriptor(**validity)
+            sources[path] = _md
+        logger.debug("Metadata restored from snapshot %s", snapshot.path)
+        return sources
+
+    sources = {}
+    for path in files:
+        _md = MetaDataFile(mds.attrc, path)
+        _md.load()
+        sources[path] = _md
+    snapshot.save(header, sources)
+    return sources
+
+
+class CachedMetaDataExtern(MetaDataExtern):
+    """Remote metadata kept in an on-disk HTTP cache.
+
+    The document is revalidated with a conditional GET, using the ETag and
+    Last-Modified values of the cached copy, so that it's downloaded again
+    only when it changes. Its signature is not verified again as long as
+    the content, and the content of the certificate used to verify it, are
+    the same.
+    """
+
+    def __init__(self, attrc, url=None, security=None, cert=None, http=None, **kwargs):
+        self.cache_dir = kwargs.pop("cache_dir")
+        super().__init__(attrc, url, security, cert, http, **kwargs)
+        name = hashlib.sha256(self.url.encode("utf-8")).hexdigest()[:32]
+        self.cache_path = os.path.join(self.cache_dir, f"remote-{name}.xml")
+        self.cache_info_path = os.path.join(self.cache_dir, f"remote-{name}.json")
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_info_path, encoding="utf-8") as fp:
+                info = json.load(fp)
+            with open(self.cache_path, "rb") as fp:
+                content = fp.read()
+        except FileNotFoundError:
+            return {}, None
+        except (OSError, ValueError):
+            logger.warning("Unreadable metadata cache for %s", self.url, exc_info=True)
+            return {}, None
+        if hashlib.sha256(content).hexdigest() != info.get("sha256"):
+            logger.warning("Corrupted metadata cache for %s", self.url)
+            return {}, None
+        return info, content
+
+    def _write_cache(self, info: dict, content: Optional[bytes]):
+        try:
+            if content is not None:
+                _atomic_write(self.cache_path, content)
+            _atomic_write(self.cache_info_path, json.dumps(info).encode("utf-8"))
+        except OSError:
+            logger.warning(
+                "Could not write metadata cache for %s", self.url, exc_info=True
+            )
+
+    def _cert_digest(self) -> Optional[str]:
+        """The digest of the content of the certificate, so that a certificate
+        replaced at the same path is noticed. "" without a certificate, None
+        if it can't be read.
+        """
+        if not self.cert:
+            return ""
+        try:
+            return _file_digest(self.cert)
+        except OSError:
+            return None
+
+    def load(self, *args, **kwargs):
+        info, cached = self._read_cache()
+        headers = {}
+        if cached is not None:
+            if info.get("etag"):
+                headers["If-None-Match"] = info["etag"]
+            if info.get("last_modified"):
+                headers["If-Modified-Since"] = info["last_modified"]
+
+        response = self.http.send(self.url, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            logger.debug("Remote metadata %s not modified", self.url)
+            content = cached
+        elif response.status_code == 200:
+            content = response.content
+            digest = hashlib.sha256(content).hexdigest()
+            if digest != info.get("sha256"):
+                info = {"sha256": digest}
+            info["etag"] = response.headers.get("ETag")
+            info["last_modified"] = response.headers.get("Last-Modified")
+        else:
+            logger.error("Response status: %s", response.status_code)
+            raise SourceNotFound(self.url)
+
+        cert = self._cert_digest()
+        if cert is not None and info.get("cert_sha256") == cert:
+            # the very same document has been verified already with this cert
+            self.parse(content)
+            result = True
+        else:
+            result = self.parse_and_check_signature(content)
+            info["cert_sha256"] = cert
+
+        self._write_cache(info, None if content is cached else content)
+        return result
+
+
+def load_remote_metadata(mds, specs: list, cache_dir: str) -> dict:
+    """Return the CachedMetaDataExtern sources for the given "remote" metadata entries."""
+    sources = {}
+    for spec in specs:
+        if "url" not in spec:
+            raise ValueError(
+                "Remote metadata must be structured as a dict containing the key 'url'"
+            )
+        kwargs = {
+            key: spec[key] for key in ("node_name", "check_validity") if key in spec
+        }
+        _md = CachedMetaDataExtern(
+            mds.attrc,
+            spec["url"],
+            mds.security,
+            spec.get("cert", ""),
+            mds.http,
+            cache_dir=cache_dir,
+            **kwargs,
+        )
+        _md.load()
+        sources[spec["url"]] = _md
+    return sources
+
+
+def _expiry(valid_until: Optional[str], cache_duration: Optional[str], now: float):
+    """Return the timestamp after which a metadata element should be refreshed."""
+    expiries = []
+    if valid_until:
+        expiries.append(calendar.timegm(str_to_time(valid_until)))
+    if cache_duration:
+        expiries.append(calendar.timegm(add_duration(time.gmtime(now), cache_duration)))
+    return min(expiries, default=None)
+
+
+def metadata_expiry(mds, now: Optional[float] = None) -> Optional[float]:
+    """Return the earliest validUntil or cacheDuration deadline of the
+    metadata sources in a MetadataStore, None if they don't define any.
+    """
+    now = time.time() if now is None else now
+    expiries = []
+    for _md in mds.metadata.values():
+        descriptors = getattr(_md, "entities_descr", None)
+        if descriptors is not None:
+            expiries.append(
+                _expiry(descriptors.valid_until, descriptors.cache_duration, now)
+            )
+        for entity in getattr(_md, "entity", {}).values():
+            expiries.append(
+                _expiry(entity.get("valid_until"), entity.get("cache_duration"), now)
+            )
+    return min((expiry for expiry in expiries if expiry is not None), default=None)
+
+
+UI_INFO_CLASS = f"{mdui.NAMESPACE}&UIInfo"
+
+
+class IdPIndex:
+    """The SSO endpoints, by binding, and the display names, in every
+    language, of the IdPs found in a MetadataStore, so that looking them up
+    doesn't scan the whole store on every login.
+
+    MDQ sources are not indexed, since they hold only the entities looked
+    up so far: they are still searched on every lookup.
+    """
+
+    max_listings = 64
+
+    def __init__(self, mds):
+        self._metadata = mds.metadata
+        self._size = len(mds.metadata)
+        self.entries = {}
+        self.dynamic = []
+        self._listings = {}
+        for _md in mds.metadata.values():
+            if isinstance(_md, MetaDataMDX):
+                self.dynamic.append(_md)
+                continue
+            for entity_id, entity in _md.items():
+                if entity_id not in self.entries:
+                    entry = self._entry(entity)
+                    if entry is not None:
+                        self.entries[entity_id] = entry
+
+    @staticmethod
+    def _entry(entity: dict) -> Optional[dict]:
+        """Mirror what MetadataStore.service() returns for an entity."""
+        sso = {}
+        for descriptor in entity.get("idpsso_descriptor", []):
+            for srv in descriptor.get("single_sign_on_service", []):
+                sso.setdefault(srv["binding"], []).append(srv)
+        if not sso:
+            return None
+        return {"sso": sso, "names": IdPIndex._names(entity)}
+
+    @staticmethod
+    def _names(entity: dict) -> dict:
+        """Map each language to the display name of an entity: its
+        Organization names, in the order of pysaml2's MetadataStore.name(),
+        or else its mdui DisplayName. A name is also reachable by the primary
+        subtag of its language.
+        """
+        candidates = []
+        organization = entity.get("organization") or {}
+        for info in (
+            "organization_display_name",
+            "organization_name",
+            "organization_url",
+        ):
+            candidates.extend(organization.get(info, []))
+        # for the languages the Organization has no name in
+        for descriptor in entity.get("idpsso_descriptor", []):
+            extensions = descriptor.get("extensions") or {}
+            for element in extensions.get("extension_elements", []):
+                if element.get("__class__") == UI_INFO_CLASS:
+                    candidates.extend(element.get("display_name", []))
+
+        names = {}
+        for item in candidates:
+            if item.get("lang") and item.get("text"):
+                names.setdefault(item["lang"].lower(), item["text"])
+        for lang, text in list(names.items()):
+            names.setdefault(lang.split("-")[0], text)
+        return names
+
+    def is_current(self, mds) -> bool:
+        return mds.metadata is self._metadata and len(mds.metadata) == self._size
+
+    def get(self, entity_id: str) -> Optional[dict]:
+        entry = self.entries.get(entity_id)
+        if entry is None:
+            for _md in self.dynamic:
+                if entity_id in _md.entity:
+                    entry = self._entry(_md.entity[entity_id])
+                    if entry is not None:
+                        break
+        return entry
+
+    def display_name(self, entity_id: str, langprefs: list) -> Optional[str]:
+        """Return the name of an IdP in the first of langprefs it's got one for."""
+        entry = self.get(entity_id)
+        if entry is None:
+            return None
+        names = entry["names"]
+        for lang in langprefs:
+            lang = lang.lower()
+            name = names.get(lang) or names.get(lang.split("-")[0])
+            if name is not None:
+                return name
+        return None
+
+    def entity_ids(self) -> list:
+        entity_ids = list(self.entries)
+        for _md in self.dynamic:
+            entity_ids.extend(
+                entity_id
+                for entity_id, entity in list(_md.entity.items())
+                if entity_id not in self.entries and self._entry(entity) is not None
+            )
+        return entity_ids
+
+    def listing(self, langprefs: list) -> dict:
+        """Return the IdPs mapped to their display name in langprefs.
+        Without MDQ sources the listing is computed once per language
+        preferences, for as long as this version of the metadata lives.
+        """
+        if self.dynamic:
+            return {
+                entity_id: self.display_name(entity_id, langprefs)
+                for entity_id in self.entity_ids()
+            }
+
+        key = tuple(langprefs)
+        listing = self._listings.get(key)
+        if listing is None:
+            listing = {
+                entity_id: self.display_name(entity_id, langprefs)
+                for entity_id in self.entries
+            }
+            if len(self._listings) >= self.max_listings:
+                # Accept-Language values are client controlled, stay bounded
+                self._listings.clear()
+            self._listings[key] = listing
+        return listing
+
+
+def idp_index(mds) -> IdPIndex:
+    """Return the IdPIndex of a MetadataStore, building it once per version
+    of its metadata.
+    """
+    index = getattr(mds, "_djangosaml2_idp_index", None)
+    if index is None or not index.is_current(mds):
+        index = IdPIndex(mds)
+        mds._djangosaml2_idp_index = index
+    return index
+
+
+def _entity_not_found(error: KeyError) -> bool:
+    """Whether MetaDataMDX raised error because the server doesn't know the
+    entity, rather than for another status or an invalid signature.
+    """
+    return bool(error.args) and str(error.args[0]).endswith("status 404")
+
+
+class MDQEntityCache:
+    """A bounded cache of the entities looked up on MDQ servers.
+
+    Entities are kept in process and shared with the other processes through
+    the Django cache named by SAML_MDQ_CACHE_ALIAS, unless it's None.
+    Positive entries live until the validUntil or cacheDuration of the
+    entity, or the freshness_period of the MDQ source if it doesn't define
+    any. Entity IDs the server doesn't know, answering 404, are remembered
+    for SAML_MDQ_NEGATIVE_TTL seconds, so that random values can't make us
+    query it on every request. Other failures aren't cached. Concurrent misses of the same entity are coalesced
+    into a single fetch, across processes as well when
+    SAML_MDQ_FETCH_LOCK_TIMEOUT is set.
+    """
+
+    key_prefix = "djangosaml2:mdq:"
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._flight = SingleFlight("mdq")
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_entries(self) -> int:
+        if self._max_entries is not None:
+            return self._max_entries
+        return getattr(settings, "SAML_MDQ_CACHE_MAX_ENTRIES", 1000)
+
+    @property
+    def negative_ttl(self) -> float:
+        return getattr(settings, "SAML_MDQ_NEGATIVE_TTL", 60)
+
+    @property
+    def fetch_lock_timeout(self) -> Optional[float]:
+        return getattr(settings, "SAML_MDQ_FETCH_LOCK_TIMEOUT", None)
+
+    @property
+    def shared_cache(self):
+        alias = getattr(settings, "SAML_MDQ_CACHE_ALIAS", "default")
+        return caches[alias] if alias else None
+
+    def _key(self, mdx, entity_id: str) -> str:
+        digest = hashlib.sha256(f"{mdx.url}\0{entity_id}".encode("utf-8"))
+        return self.key_prefix + digest.hexdigest()
+
+    def _positive_expiry(self, mdx, entity: dict, now: float) -> float:
+        expiry = _expiry(entity.get("valid_until"), entity.get("cache_duration"), now)
+        if expiry is None:
+            expiry = calendar.timegm(
+                add_duration(time.gmtime(now), mdx.freshness_period)
+            )
+        return expiry
+
+    def _get(self, key: str, now: float):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    return entry
+                del self._entries[key]
+
+        shared = self.shared_cache
+        if shared is not None:
+            entry = shared.get(key)
+            if entry is not None and entry[1] > now:
+                self._set(key, entry, shared=False)
+                return entry
+        return None
+
+    def _set(self, key: str, entry: tuple, shared: bool = True):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        cache = self.shared_cache if shared else None
+        if cache is not None:
+            cache.set(key, entry, timeout=max(int(entry[1] - time.time()), 1))
+
+    def _fetch(self, mdx, entity_id: str, key: str) -> tuple:
+        self.misses += 1
+        now = time.time()
+        # drop whatever pysaml2 kept, the expiry is ours to decide
+        mdx.entity.pop(entity_id, None)
+        try:
+            entity = mdx[entity_id]
+        except KeyError as e:
+            if not _entity_not_found(e):
+                # an outage, or a bad signature, must not hide the entity
+                raise
+            entry = (None, now + self.negative_ttl)
+        else:
+            entry = (entity, self._positive_expiry(mdx, entity, now))
+        self._set(key, entry)
+        return entry
+
+    def lookup(self, mdx, entity_id: str) -> dict:
+        """Return the entity from an MDQ source, fetching it only on a cache miss.
+        Raise KeyError, as MetaDataMDX does, for the entities it doesn't know.
+        """
+        key = self._key(mdx, entity_id)
+        entry = self._get(key, time.time())
+        if entry is None:
+            lock_timeout = self.fetch_lock_timeout
+            entry = self._flight.do(
+                key,
+                lambda: self._fetch(mdx, entity_id, key),
+                shared=lambda: self._get(key, time.time()),
+                lock_cache=self.shared_cache if lock_timeout else None,
+                lock_timeout=lock_timeout or 0,
+            )
+        else:
+            self.hits += 1
+
+        entity, expires_at = entry
+        if entity is None:
+            raise KeyError(f"Fetching {entity_id}: unknown to the MDQ server")
+        mdx.entity[entity_id] = entity
+        mdx.expiration_date[entity_id] = time.gmtime(expires_at)
+
+        # the MDQ source must not grow beyond the cache either
+        if len(mdx.entity) > self.max_entries:
+            with self._lock:
+                known = set(self._entries)
+            for cached_id in list(mdx.entity):
+                if cached_id != entity_id and self._key(mdx, cached_id) not in known:
+                    mdx.entity.pop(cached_id, None)
+                    mdx.expiration_date.pop(cached_id, None)
+        return entity
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self._flight = SingleFlight("mdq")
+        self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = len(self._entries)
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            **self._flight.stats(),
+        }
+
+
+mdq_entity_cache = MDQEntityCache()
+
+
+class MetadataRefresher:
+    """Periodically reload the metadata of a shared SPConfig in a background thread.
+
+    The new MetadataStore is built off the request path and swapped in
+    atomically. The refresh happens every SAML_METADATA_REFRESH_INTERVAL
+    seconds, or earlier if validUntil or cacheDuration require so. When a
+    refresh fails the last good copy is kept for SAML_METADATA_STALE_WINDOW
+    seconds, after which the shared config is dropped so that the next
+    request loads it again.
+
+    source must provide ``current()``, returning the shared config and its
+    metadata specification, ``swap_metadata(config, mds)`` and ``clear()``.
+    """
+
+    # don't hammer metadata sources, whatever their cacheDuration says
+    min_delay = 30
+
+    def __init__(self, source):
+        self.source = source
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._failing_since = None
+        self.refreshes = 0
+        self.failures = 0
+
+    @property
+    def interval(self) -> Optional[float]:
+        return getattr(settings, "SAML_METADATA_REFRESH_INTERVAL", None)
+
+    @property
+    def stale_window(self) -> float:
+        return getattr(settings, "SAML_METADATA_STALE_WINDOW", 86400)
+
+    def next_delay(self, mds) -> float:
+        interval = self.interval or 3600
+        expiry = metadata_expiry(mds)
+        if expiry is not None:
+            interval = min(interval, expiry - time.time())
+        return max(interval, self.min_delay)
+
+    def refresh(self) -> float:
+        """Reload the metadata once and return the delay before the next refresh."""
+        config, metadata_conf = self.source.current()
+        if config is None:
+            return self.interval or 3600
+
+        try:
+            mds = config.load_metadata(copy.deepcopy(metadata_conf))
+        except Exception:
+            self.failures += 1
+            now = time.monotonic()
+            if self._failing_since is None:
+                self._failing_since = now
+            if now - self._failing_since >= self.stale_window:
+                logger.exception(
+                    "Metadata refresh failed, the stale window is over: "
+                    "dropping the SAML configuration"
+                )
+                self.source.clear()
+                self._failing_since = None
+            else:
+                logger.exception("Metadata refresh failed, keeping the last good copy")
+            return self.min_delay
+
+        self.source.swap_metadata(config, mds)
+        self._failing_since = None
+        self.refreshes += 1
+        logger.debug("Metadata refreshed")
+        return self.next_delay(mds)
+
+    def _run(self):
+        config, _metadata_conf = self.source.current()
+        delay = self.next_delay(config.metadata) if config is not None else 0
+        while not self._stop.wait(delay):
+            delay = self.refresh()
+
+    def ensure_running(self):
+        """Start the refresher thread if it isn't running in this process.
+        Threads don't survive a fork, so forked workers start their own.
+        """
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="djangosaml2-metadata-refresher", daemon=True
+            )
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        self._thread = self._pid = None
@@ -0,0 +1,281 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Iterable, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    labels = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return f"{{{labels}}}" if labels else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    @abstractmethod
+    def samples(self) -> list:
+        """Return the samples as (name, labels, value), labels being pairs."""
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            (self.name, tuple(zip(self.labelnames, key)), value)
+            for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        # the last slot counts the values above the largest bucket
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels) -> int:
+        counts, _total = self._values.get(self._key(labels), ((), 0))
+        return sum(counts)
+
+    def samples(self) -> list:
+        with self._lock:
+            values = [
+                (key, list(counts), total)
+                for key, (counts, total) in self._values.items()
+            ]
+        samples = []
+        for key, counts, total in values:
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                samples.append(
+                    (
+                        f"{self.name}_bucket",
+                        (*labels, ("le", _format_value(bound))),
+                        cumulative,
+                    )
+                )
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """In-process registry of the metrics of djangosaml2, exposed in the
+    Prometheus text format.
+
+    Besides its metrics, collectors are called on exposition to report the
+    counters other components keep anyway, as (name, type, documentation,
+    value) tuples.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def _register(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is registered as a {metric.type}")
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def register_collector(self, collector: Callable[[], Iterable[tuple]]):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def clear(self):
+        """Reset the values of the metrics."""
+        for metric in list(self._metrics.values()):
+            metric.clear()
+
+    def expose(self) -> str:
+        lines = []
+        for metric in sorted(self._metrics.values(), key=lambda metric: metric.name):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for collector in self._collectors:
+            for name, metric_type, documentation, value in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+logins_started = registry.counter(
+    "djangosaml2_logins_started_total",
+    "Authentication requests sent to an IdP.",
+    ("idp",),
+)
+acs_successes = registry.counter(
+    "djangosaml2_acs_successes_total",
+    "Users logged in by the ACS, by IdP.",
+    ("idp",),
+)
+acs_failures = registry.counter(
+    "djangosaml2_acs_failures_total",
+    "SAML responses refused by the ACS, by the class of the error.",
+    ("reason",),
+)
+acs_duration = registry.histogram(
+    "djangosaml2_acs_duration_seconds",
+    "Time taken by the ACS to log a user in, by IdP.",
+    ("idp",),
+)
+logouts = registry.counter(
+    "djangosaml2_logouts_total",
+    "Logouts, by who started them and their result.",
+    ("initiator", "result"),
+)
+
+
+def _collect_stats() -> list:
+    """Report the counters of the config and MDQ caches and of the ACS pool."""
+    from . import pool
+    from .conf import sp_config_cache, sp_config_registry
+    from .metadata import mdq_entity_cache
+
+    samples = []
+    for prefix, what, stats in (
+        ("djangosaml2_config_cache", "SAML_CONFIG", sp_config_cache.stats()),
+        ("djangosaml2_config_registry", "registry", sp_config_registry.stats()),
+    ):
+        samples += [
+            (
+                f"{prefix}_hits_total",
+                "counter",
+                f"{what} configs served from memory.",
+                stats["hits"],
+            ),
+            (
+                f"{prefix}_misses_total",
+                "counter",
+                f"{what} configs loaded.",
+                stats["misses"],
+            ),
+        ]
+
+    mdq = mdq_entity_cache.stats()
+    samples += [
+        (
+            "djangosaml2_mdq_cache_hits_total",
+            "counter",
+            "MDQ lookups served from the cache.",
+            mdq["hits"],
+        ),
+        (
+            "djangosaml2_mdq_fetches_total",
+            "counter",
+            "Entities fetched from MDQ servers.",
+            mdq["misses"],
+        ),
+        (
+            "djangosaml2_mdq_cache_entries",
+            "gauge",
+            "Entities in the MDQ cache.",
+            mdq["entries"],
+        ),
+    ]
+
+    acs_pool = pool._pool
+    if acs_pool is not None and pool._pool_pid == os.getpid():
+        stats = acs_pool.stats()
+        samples += [
+            (
+                "djangosaml2_acs_pool_verified_total",
+                "counter",
+                "SAML responses verified by the ACS pool.",
+                stats["verified"],
+            ),
+            (
+                "djangosaml2_acs_pool_rejected_total",
+                "counter",
+                "SAML responses refused by the full ACS pool.",
+                stats["rejected"],
+            ),
+            (
+                "djangosaml2_acs_pool_timeouts_total",
+                "counter",
+                "SAML responses not verified in time by the ACS pool.",
+                stats["timeouts"],
+            ),
+        ]
+    return samples
+
+
+registry.register_collector(_collect_stats)
@@ -9,17 +9,34 @@ from django.utils.http import http_date
 from django.contrib.sessions.backends.base import UpdateError
 from django.contrib.sessions.middleware import SessionMiddleware
 
+from asgiref.sync import sync_to_async
+
 django_version = float("{}.{}".format(*VERSION[:2]))
 SAMESITE_NONE = None if django_version < 3.1 else "None"
 
 
 class SamlSessionMiddleware(SessionMiddleware):
+    """Keep the SAML state in its own session, request.saml_session.
+
+    In an async stack the session is saved with the async API of the session
+    backend, so that the request doesn't leave the event loop.
+    """
+
     cookie_name = getattr(settings, "SAML_SESSION_COOKIE_NAME", "saml_session")
 
     def process_request(self, request):
         session_key = request.COOKIES.get(self.cookie_name, None)
         request.saml_session = self.SessionStore(session_key)
 
+    async def __acall__(self, request):
+        # the SessionStore is lazy, creating it doesn't hit the store
+        self.process_request(request)
+        response = await self.get_response(request)
+        if not hasattr(request.saml_session, "asave"):
+            # sessions have no async API before Django 5.0
+            return await sync_to_async(self.process_response)(request, response)
+        return await self.aprocess_response(request, response)
+
     def process_response(self, request, response):
         """
         If request.saml_session was modified, or if the configuration is to save the
@@ -37,13 +54,7 @@ class SamlSessionMiddleware(SessionMiddleware):
         # First check if we need to delete this cookie.
         # The session should be deleted only if the session is entirely empty.
         if self.cookie_name in request.COOKIES and empty:
-            response.delete_cookie(
-                self.cookie_name,
-                path=settings.SESSION_COOKIE_PATH,
-                domain=settings.SESSION_COOKIE_DOMAIN,
-                samesite=SAMESITE,
-            )
-            patch_vary_headers(response, ("Cookie",))
+            self._delete_cookie(response, SAMESITE)
         else:
             if accessed:
                 patch_vary_headers(response, ("Cookie",))
@@ -51,11 +62,8 @@ class SamlSessionMiddleware(SessionMiddleware):
             if (modified or settings.SESSION_SAVE_EVERY_REQUEST) and not empty:
                 if request.saml_session.get_expire_at_browser_close():
                     max_age = None
-                    expires = None
                 else:
                     max_age = request.saml_session.get_expiry_age()
-                    expires_time = time.time() + max_age
-                    expires = http_date(expires_time)
                 # Save the session data and refresh the client cookie.
                 # Skip session save for 500 responses, refs #3881.
                 if response.status_code != 500:
@@ -67,15 +75,59 @@ class SamlSessionMiddleware(SessionMiddleware):
                             "request completed. The user may have logged "
                             "out in a concurrent request, for example."
                         )
-                    response.set_cookie(
-                        self.cookie_name,
-                        request.saml_session.session_key,
-                        max_age=max_age,
-                        expires=expires,
-                        domain=settings.SESSION_COOKIE_DOMAIN,
-                        path=settings.SESSION_COOKIE_PATH,
-                        secure=settings.SESSION_COOKIE_SECURE or None,
-                        httponly=settings.SESSION_COOKIE_HTTPONLY or None,
-                        samesite=SAMESITE,
-                    )
+                    self._set_cookie(request, response, max_age, SAMESITE)
         return response
+
+    async def aprocess_response(self, request, response):
+        """Async counterpart of process_response."""
+        SAMESITE = getattr(settings, "SAML_SESSION_COOKIE_SAMESITE", SAMESITE_NONE)
+
+        try:
+            accessed = request.saml_session.accessed
+            modified = request.saml_session.modified
+            empty = request.saml_session.is_empty()
+        except AttributeError:
+            return response
+        if self.cookie_name in request.COOKIES and empty:
+            self._delete_cookie(response, SAMESITE)
+        else:
+            if accessed:
+                patch_vary_headers(response, ("Cookie",))
+            if (modified or settings.SESSION_SAVE_EVERY_REQUEST) and not empty:
+                if await request.saml_session.aget_expire_at_browser_close():
+                    max_age = None
+                else:
+                    max_age = await request.saml_session.aget_expiry_age()
+                if response.status_code != 500:
+                    try:
+                        await request.saml_session.asave()
+                    except UpdateError:
+                        raise SuspiciousOperation(
+                            "The request's session was deleted before the "
+                            "request completed. The user may have logged "
+                            "out in a concurrent request, for example."
+                        )
+                    self._set_cookie(request, response, max_age, SAMESITE)
+        return response
+
+    def _delete_cookie(self, response, samesite):
+        response.delete_cookie(
+            self.cookie_name,
+            path=settings.SESSION_COOKIE_PATH,
+            domain=settings.SESSION_COOKIE_DOMAIN,
+            samesite=samesite,
+        )
+        patch_vary_headers(response, ("Cookie",))
+
+    def _set_cookie(self, request, response, max_age, samesite):
+        response.set_cookie(
+            self.cookie_name,
+            request.saml_session.session_key,
+            max_age=max_age,
+            expires=None if max_age is None else http_date(time.time() + max_age),
+            domain=settings.SESSION_COOKIE_DOMAIN,
+            path=settings.SESSION_COOKIE_PATH,
+            secure=settings.SESSION_COOKIE_SECURE or None,
+            httponly=settings.SESSION_COOKIE_HTTPONLY or None,
+            samesite=samesite,
+        )
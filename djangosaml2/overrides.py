@@ -1,8 +1,18 @@
+import copy
 import logging
+import threading
+from http.cookiejar import CookieJar
 
 from django.conf import settings
+from django.utils.module_loading import import_string
 
 import saml2.client
+import saml2.config
+from saml2.population import Population
+
+from .crypto import CryptoBackendXMLSecBinding
+from .metadata import load_local_metadata, load_remote_metadata
+from .timing import TimedCryptoBackend, timing_enabled
 
 logger = logging.getLogger("djangosaml2")
 
@@ -14,8 +24,66 @@ class Saml2Client(saml2.client.Saml2Client):
     SAML_LOGOUT_REQUEST_PREFERRED_BINDING settings variable.
     (Original Saml2Client always prefers SOAP, so it is always used if declared
     in remote metadata); but doesn't actually work and causes crashes.
+
+    SAML_CRYPTO_BACKEND, the dotted path of a pysaml2 CryptoBackend class,
+    replaces the crypto backend used to sign, verify and decrypt messages.
+    When timing is enabled the time it takes is recorded.
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        crypto_backend = getattr(settings, "SAML_CRYPTO_BACKEND", None)
+        if crypto_backend:
+            crypto = import_string(crypto_backend)()
+            if isinstance(crypto, CryptoBackendXMLSecBinding):
+                # the backend of the config encrypts
+                crypto.fallback = self.sec.crypto
+            self.sec.crypto = crypto
+        if timing_enabled():
+            self.sec.crypto = TimedCryptoBackend(self.sec.crypto)
+
+    @classmethod
+    def from_config(cls, config, identity_cache=None, state_cache=None):
+        """Return a client for config, built only once per config version.
+
+        Building a client sets up its security context and reads the whole
+        config, so a single one is shared by all the requests using the same
+        config and metadata. Each call gets a shallow copy of it with its own
+        identity and state caches, and the other attributes pysaml2 changes
+        while handling a request. Set SAML_SHARED_CLIENT to False to build a
+        new client every time.
+        """
+        if not getattr(settings, "SAML_SHARED_CLIENT", True):
+            return cls(config, identity_cache=identity_cache, state_cache=state_cache)
+
+        clients = config.__dict__.setdefault("_djangosaml2_clients", {})
+        metadata, shared = clients.get(cls, (None, None))
+        if shared is None or metadata is not config.metadata:
+            # a concurrent build is harmless, one of them is kept
+            metadata, shared = config.metadata, cls(config)
+            clients[cls] = (metadata, shared)
+
+        client = copy.copy(shared)
+        client.users = Population(identity_cache)
+        client.state = {} if state_cache is None else state_cache
+        client.lock = threading.Lock()
+        client.artifact = {}
+        client.artifact2response = {}
+        client.cookiejar = CookieJar()
+        return client
+
+    @classmethod
+    def has_shared_client(cls, config) -> bool:
+        """Whether from_config() has a client built for config, so that it
+        returns without loading keys or reading the config.
+        """
+        if not getattr(settings, "SAML_SHARED_CLIENT", True):
+            return False
+        metadata, shared = config.__dict__.get("_djangosaml2_clients", {}).get(
+            cls, (None, None)
+        )
+        return shared is not None and metadata is config.metadata
+
     def do_logout(self, *args, **kwargs):
         if not kwargs.get("expected_binding"):
             try:
@@ -28,3 +96,50 @@ class Saml2Client(saml2.client.Saml2Client):
                     " not defined. Default binding will be used."
                 )
         return super().do_logout(*args, **kwargs)
+
+
+class SPConfig(saml2.config.SPConfig):
+    """
+    Custom SPConfig that restores the "local" metadata files from an on-disk
+    snapshot of their parsed entities, when SAML_METADATA_SNAPSHOT_DIR is set,
+    instead of parsing the XML on every load, and that keeps the "remote"
+    metadata in an HTTP cache revalidated with conditional requests, when
+    SAML_METADATA_HTTP_CACHE_DIR is set.
+    """
+
+    def load_metadata(self, metadata_conf):
+        if not isinstance(metadata_conf, dict):
+            return super().load_metadata(metadata_conf)
+
+        snapshot_dir = getattr(settings, "SAML_METADATA_SNAPSHOT_DIR", None)
+        http_cache_dir = getattr(settings, "SAML_METADATA_HTTP_CACHE_DIR", None)
+        handled = set()
+        if snapshot_dir and all(
+            isinstance(path, str) for path in metadata_conf.get("local", [])
+        ):
+            handled.add("local")
+        if http_cache_dir and all(
+            isinstance(spec, dict) for spec in metadata_conf.get("remote", [])
+        ):
+            handled.add("remote")
+        if not handled & set(metadata_conf):
+            return super().load_metadata(metadata_conf)
+
+        other_conf = {
+            typ: val for typ, val in metadata_conf.items() if typ not in handled
+        }
+        mds = super().load_metadata(other_conf)
+        sources = {}
+        if "local" in handled:
+            sources.update(
+                load_local_metadata(mds, metadata_conf.get("local", []), snapshot_dir)
+            )
+        if "remote" in handled:
+            sources.update(
+                load_remote_metadata(
+                    mds, metadata_conf.get("remote", []), http_cache_dir
+                )
+            )
+        # keep the local and remote sources first, like pysaml2 usually does
+        mds.metadata = {**sources, **mds.metadata}
+        return mds
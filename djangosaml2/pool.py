@@ -0,0 +1,228 @@
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional, Union
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from saml2.response import AuthnResponse
+
+from .exceptions import ACSPoolUnavailable
+from .utils import get_custom_setting
+
+logger = logging.getLogger("djangosaml2")
+
+
+class VerifiedResponse:
+    """What a worker sends back of the AuthnResponse it verified.
+
+    The AuthnResponse itself holds the security context of the worker, so it
+    can't leave it. This keeps the rest of its state, from which
+    authn_response() rebuilds it for the client of the request.
+    """
+
+    # bound to the client that verified the response
+    client_attributes = ("sec", "signature_check", "attribute_converters")
+
+    def __init__(self, response: AuthnResponse):
+        self.state = {
+            name: value
+            for name, value in vars(response).items()
+            if name not in self.client_attributes
+        }
+        # the condition on which pysaml2 stores the identity of the subject
+        self.remember_identity = bool(
+            response.assertion
+            and len(response.response.encrypted_assertion) == 0
+            and response.name_id
+        )
+
+    def authn_response(self, client) -> AuthnResponse:
+        """Return the verified AuthnResponse, bound to the given client."""
+        response = AuthnResponse.__new__(AuthnResponse)
+        vars(response).update(self.state)
+        response.sec = client.sec
+        response.signature_check = client.sec.correctly_signed_response
+        response.attribute_converters = client.config.attribute_converters
+        return response
+
+
+_worker_config_loader_path = None
+
+
+_worker_config = None
+
+
+def _load_worker_config():
+    """Load the config of the worker, with its metadata and keys, once."""
+    global _worker_config
+
+    from .conf import get_config
+    from .overrides import Saml2Client
+
+    if _worker_config is None:
+        config = get_config(_worker_config_loader_path)
+        # sets up the security context, kept with the config
+        Saml2Client.from_config(config)
+        _worker_config = config
+    return _worker_config
+
+
+def _init_worker(config_loader_path):
+    global _worker_config_loader_path, _worker_config
+
+    import django
+    from django.apps import apps
+
+    # spawned and forkserver workers start from scratch
+    if not apps.ready:
+        django.setup()
+
+    _worker_config_loader_path = config_loader_path
+    # forked workers may inherit the config of the parent
+    _worker_config = None
+    try:
+        _load_worker_config()
+    except Exception:
+        # the first verification will load what's missing
+        logger.exception("SAML warm-up of the ACS worker %s failed", os.getpid())
+
+
+def _verify(xmlstr: str, binding: str, outstanding: dict):
+    from .overrides import Saml2Client
+
+    client = Saml2Client.from_config(_load_worker_config())
+    response = client.parse_authn_request_response(xmlstr, binding, outstanding)
+    return None if response is None else VerifiedResponse(response)
+
+
+class ACSVerifierPool:
+    """Bounded pool of processes parsing and verifying the SAML responses
+    received by the ACS, so that the work spreads across cores whatever the
+    number of request threads.
+
+    At most max_workers responses are verified at once and queue_size more
+    wait for a worker, further ones are refused. A request gives up after
+    timeout seconds. In both cases ACSPoolUnavailable is raised.
+
+    The workers call config_loader_path without a request, once, when they
+    start: the config, its metadata and keys are then kept for as long as
+    they live.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        queue_size: int = 0,
+        timeout: Optional[float] = None,
+        config_loader_path: Optional[Union[Callable, str]] = None,
+        mp_context=None,
+    ):
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_workers + queue_size)
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=(config_loader_path,),
+        )
+        self.verified = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def verify(self, xmlstr: str, binding: str, outstanding: dict):
+        """Run Saml2Client.parse_authn_request_response in a worker.
+
+        Return a VerifiedResponse, or None if pysaml2 returned None. The
+        exceptions raised by pysaml2 are raised here as well.
+        """
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise ACSPoolUnavailable("The ACS verification queue is full")
+
+        try:
+            future = self._executor.submit(_verify, xmlstr, binding, outstanding)
+        except (BrokenProcessPool, RuntimeError) as e:
+            self._slots.release()
+            raise ACSPoolUnavailable(f"The ACS verification pool is down: {e}") from e
+        # the slot is held until the worker is done, even if we stop waiting
+        future.add_done_callback(lambda _future: self._slots.release())
+
+        try:
+            response = future.result(timeout=self.timeout)
+        except FutureTimeoutError as e:
+            future.cancel()
+            self.timeouts += 1
+            raise ACSPoolUnavailable(
+                f"SAML response not verified within {self.timeout}s"
+            ) from e
+        except BrokenProcessPool as e:
+            raise ACSPoolUnavailable(f"The ACS verification pool is down: {e}") from e
+        self.verified += 1
+        return response
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "verified": self.verified,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
+
+
+_pool_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+
+
+def get_acs_pool() -> Optional[ACSVerifierPool]:
+    """Return the pool of this process configured by the SAML_ACS_POOL_*
+    settings, or None unless SAML_ACS_POOL_WORKERS is set.
+
+    The workers load the config without a request, so there's no pool either
+    with a SAML_CONFIG_LOADER, which may need one.
+    """
+    global _pool, _pool_pid
+
+    max_workers = get_custom_setting("SAML_ACS_POOL_WORKERS", None)
+    if not max_workers or get_custom_setting("SAML_CONFIG_LOADER", None):
+        return None
+    # a pool is not inherited by forked processes, e.g. preloaded app servers
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ACSVerifierPool(
+                max_workers,
+                queue_size=get_custom_setting("SAML_ACS_POOL_QUEUE_SIZE", 16),
+                timeout=get_custom_setting("SAML_ACS_POOL_TIMEOUT", 10),
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def shutdown_acs_pool(wait: bool = True):
+    global _pool
+
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None and _pool_pid == os.getpid():
+        pool.shutdown(wait=wait)
+
+
+@receiver(setting_changed)
+def _shutdown_acs_pool(setting, **kwargs):
+    if setting.startswith("SAML_ACS_POOL_") or setting in (
+        "SAML_CONFIG",
+        "SAML_CONFIG_LOADER",
+    ):
+        shutdown_acs_pool(wait=False)
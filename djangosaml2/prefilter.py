@@ -0,0 +1,124 @@
+import base64
+import binascii
+from typing import Optional, Tuple
+from xml.etree.ElementTree import ParseError
+
+from defusedxml import DefusedXmlException
+from defusedxml.ElementTree import DefusedXMLParser
+
+from saml2.response import UnsolicitedResponse
+from saml2.saml import NAMESPACE as SAML_NAMESPACE
+from saml2.samlp import NAMESPACE as SAMLP_NAMESPACE
+
+from .exceptions import SAMLResponseRejected
+from .metadata import idp_index
+
+RESPONSE_TAG = f"{{{SAMLP_NAMESPACE}}}Response"
+ISSUER_TAG = f"{{{SAML_NAMESPACE}}}Issuer"
+
+
+def decode_saml_response(saml_response: str, max_size: Optional[int]) -> bytes:
+    """Decode the SAMLResponse posted, if it's at most max_size characters of
+    valid base64. Line breaks, which some IdPs add, are allowed.
+    """
+    if max_size is not None and len(saml_response) > max_size:
+        raise SAMLResponseRejected(
+            f"SAMLResponse larger than {max_size} characters: {len(saml_response)}"
+        )
+    try:
+        return base64.b64decode("".join(saml_response.split()), validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise SAMLResponseRejected("SAMLResponse is not valid base64") from e
+
+
+class _ResponseHeader:
+    """Parser target reading a samlp:Response up to the end of its Issuer."""
+
+    def __init__(self):
+        self.done = False
+        self.root = False
+        self.issuer = None
+        self.in_response_to = None
+        self._issuer_text = None
+
+    def start(self, tag, attrib):
+        if self.done:
+            return
+        if not self.root:
+            if tag != RESPONSE_TAG:
+                raise SAMLResponseRejected(f"Not a SAML Response: {tag}")
+            self.root = True
+            self.in_response_to = attrib.get("InResponseTo")
+        elif tag == ISSUER_TAG and self._issuer_text is None:
+            self._issuer_text = []
+        else:
+            # the Issuer, if any, is the first child
+            self.done = True
+
+    def data(self, data):
+        if not self.done and self._issuer_text is not None:
+            self._issuer_text.append(data)
+
+    def end(self, tag):
+        if self.done:
+            return
+        if self._issuer_text is not None:
+            self.issuer = "".join(self._issuer_text).strip()
+        self.done = True
+
+    def close(self):
+        return None
+
+
+def peek_response(
+    xml: bytes, peek_size: int = 16384, chunk_size: int = 2048
+) -> Tuple[Optional[str], Optional[str]]:
+    """Return the Issuer and the InResponseTo of a samlp:Response, parsing
+    no more than its first peek_size bytes, without verifying anything.
+    The Issuer of a Response is optional, None is returned without one.
+    """
+    window = xml[:peek_size]
+    header = _ResponseHeader()
+    # pysaml2 refuses DTDs, don't let them be expanded here, whatever the
+    # encoding of the document
+    parser = DefusedXMLParser(target=header, forbid_dtd=True, forbid_entities=True)
+    try:
+        for offset in range(0, len(window), chunk_size):
+            parser.feed(window[offset : offset + chunk_size])
+            if header.done:
+                return header.issuer, header.in_response_to
+    except DefusedXmlException as e:
+        raise SAMLResponseRejected(f"DTDs are not allowed: {e}") from e
+    except ParseError as e:
+        raise SAMLResponseRejected(f"SAMLResponse is not well-formed: {e}") from e
+    raise SAMLResponseRejected(f"No Response header in the first {peek_size} bytes")
+
+
+def prefilter_saml_response(
+    saml_response: str,
+    conf,
+    outstanding_queries: dict,
+    max_size: Optional[int] = None,
+):
+    """Refuse, at a fraction of the cost of verifying it, a SAMLResponse that
+    is too large, not base64, not a SAML Response, issued by an IdP missing
+    from the metadata, or in response to no query of this session unless
+    unsolicited responses are allowed.
+
+    Raise UnsolicitedResponse, as pysaml2 does, for the latter and
+    SAMLResponseRejected otherwise.
+    """
+    issuer, in_response_to = peek_response(
+        decode_saml_response(saml_response, max_size)
+    )
+
+    if issuer is not None:
+        index = idp_index(conf.metadata)
+        # MDQ sources hold the IdPs looked up so far only
+        if index.get(issuer) is None and not index.dynamic:
+            raise SAMLResponseRejected(f"Unknown issuer: {issuer}")
+
+    if in_response_to not in outstanding_queries and not conf.getattr(
+        "allow_unsolicited", "sp"
+    ):
+        raise UnsolicitedResponse(f"Unsolicited response: {in_response_to}")
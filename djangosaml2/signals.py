@@ -16,3 +16,4 @@ import django.dispatch
 
 pre_user_save = django.dispatch.Signal()
 post_authenticated = django.dispatch.Signal()
+phases_timed = django.dispatch.Signal()
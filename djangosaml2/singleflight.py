@@ -0,0 +1,113 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Hashable, Optional
+
+logger = logging.getLogger("djangosaml2")
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesce concurrent computations of the same key.
+
+    The first caller of ``do()`` for a key runs the function, the callers
+    arriving while it's in flight wait for it and get its result, or its
+    exception. Across processes the same can be obtained through a lock in a
+    shared Django cache: the callers that don't get the lock poll ``shared``
+    until the holder publishes the result there.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.coalesced_remote = 0
+
+    def do(
+        self,
+        key: Hashable,
+        fn: Callable[[], Any],
+        shared: Optional[Callable[[], Any]] = None,
+        lock_cache=None,
+        lock_timeout: float = 10,
+    ) -> Any:
+        """Return fn(), unless a computation of key is already in flight.
+
+        When lock_cache is given, shared must return the result published by
+        another process, or None if it isn't available yet.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run(key, fn, shared, lock_cache, lock_timeout)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _run(self, key, fn, shared, lock_cache, lock_timeout):
+        if lock_cache is None or shared is None:
+            return fn()
+
+        lock_key = f"djangosaml2:singleflight:{self.name}:{key}"
+        deadline = time.monotonic() + lock_timeout
+        while not lock_cache.add(
+            lock_key, os.getpid(), timeout=max(int(lock_timeout), 1)
+        ):
+            result = shared()
+            if result is not None:
+                self.coalesced_remote += 1
+                return result
+            if time.monotonic() >= deadline:
+                # the holder may have died, don't wait for it any longer
+                logger.warning("Gave up waiting for the %s lock on %s", self.name, key)
+                return fn()
+            time.sleep(self.poll_interval)
+
+        try:
+            # published by the previous holder right before we got the lock
+            result = shared()
+            if result is not None:
+                self.coalesced_remote += 1
+                return result
+            return fn()
+        finally:
+            lock_cache.delete(lock_key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            in_flight = len(self._calls)
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "coalesced_remote": self.coalesced_remote,
+            "in_flight": in_flight,
+        }
@@ -12,35 +12,116 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+
 from django import template
+from django.conf import settings
+from django.core.cache import cache
+from django.template.base import token_kwargs
 
-from djangosaml2.conf import config_settings_loader
-from djangosaml2.utils import available_idps
+from djangosaml2.conf import get_config, sp_config_cache
+from djangosaml2.metadata import idp_index
+from djangosaml2.utils import get_language_preferences
 
 register = template.Library()
 
+DEFAULT_CONFIG_LOADER = "djangosaml2.conf.config_settings_loader"
+
+# languages of a request that make a listing, the first one found wins
+MAX_LANGUAGES = 3
+
+
+def _languages(request) -> list:
+    """Return the languages of the request found in settings.LANGUAGES, or
+    their primary subtag, most preferred first, so that the client can't
+    make up any number of listings.
+    """
+    supported = {code.lower() for code, _name in settings.LANGUAGES}
+    langprefs = []
+    for lang in get_language_preferences(request):
+        lang = lang.lower()
+        if lang not in supported:
+            lang = lang.split("-")[0]
+        if lang in supported and lang not in langprefs:
+            langprefs.append(lang)
+            if len(langprefs) == MAX_LANGUAGES:
+                break
+    return [*langprefs, "en"]
+
+
+def idp_listing(request, config_loader_path=None, timeout=None) -> dict:
+    """Return the IdPs mapped to their display name in the languages of the
+    request. The listing is shared by all the renders of the same metadata
+    version and languages and, with a timeout, stored in the Django cache as
+    well. With the default loader, the config isn't even looked at then
+    until it expires; custom loaders, that may build a config per tenant,
+    are called to tell the configs apart.
+    """
+    config_loader_path = config_loader_path or DEFAULT_CONFIG_LOADER
+    langprefs = _languages(request)
+
+    conf = None
+    if timeout:
+        if config_loader_path == DEFAULT_CONFIG_LOADER:
+            identity = sp_config_cache.fingerprint(settings.SAML_CONFIG)
+        else:
+            conf = get_config(config_loader_path, request)
+            identity = conf.entityid
+        key = hashlib.sha256(
+            "\0".join([str(config_loader_path), identity, *langprefs]).encode("utf-8")
+        ).hexdigest()
+        key = f"djangosaml2:idplist:{key}"
+        listing = cache.get(key)
+        if listing is None:
+            if conf is None:
+                conf = get_config(config_loader_path, request)
+            listing = dict(idp_index(conf.metadata).listing(langprefs))
+            cache.set(key, listing, timeout)
+        return listing
+
+    conf = get_config(config_loader_path, request)
+    # the listing of the index is shared by all the renders
+    return dict(idp_index(conf.metadata).listing(langprefs))
+
 
 class IdPListNode(template.Node):
-    def __init__(self, variable_name):
+    def __init__(self, variable_name, config_loader=None, timeout=None):
         self.variable_name = variable_name
+        self.config_loader = config_loader
+        self.timeout = timeout
 
     def render(self, context):
-        conf = config_settings_loader()
-        context[self.variable_name] = available_idps(conf)
+        context[self.variable_name] = idp_listing(
+            context.get("request"),
+            self.config_loader.resolve(context) if self.config_loader else None,
+            int(self.timeout.resolve(context)) if self.timeout else None,
+        )
         return ""
 
 
 @register.tag
 def idplist(parser, token):
-    try:
-        tag_name, as_part, variable = token.split_contents()
-    except ValueError:
+    """Store the IdPs and their display names in a context variable::
+
+    {% idplist as idps %}
+    {% idplist as idps timeout=300 config_loader="myapp.loaders.saml_config" %}
+    """
+    bits = token.split_contents()
+    tag_name = bits[0]
+    if len(bits) < 3:
         raise template.TemplateSyntaxError(
             "%r tag requires two arguments" % token.contents.split()[0]
         )
-    if not as_part == "as":
+    if not bits[1] == "as":
         raise template.TemplateSyntaxError(
             '%r tag first argument must be the literal "as"' % tag_name
         )
 
-    return IdPListNode(variable)
+    remaining = bits[3:]
+    options = token_kwargs(remaining, parser)
+    if remaining or not set(options) <= {"config_loader", "timeout"}:
+        raise template.TemplateSyntaxError(
+            "%r tag only accepts the config_loader and timeout options" % tag_name
+        )
+
+    return IdPListNode(bits[2], **options)
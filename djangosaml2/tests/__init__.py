@@ -14,16 +14,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import base64
+import copy
 import datetime
+import multiprocessing
+import os
 import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from importlib import import_module
-from unittest import mock
+from io import StringIO
+from unittest import mock, skipUnless
 from urllib.parse import parse_qs, urlparse
 
 from django import http
+from django.apps import apps
 from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.core.management import CommandError, call_command
+from django.template import RequestContext, Template, TemplateSyntaxError
 from django.test import Client, TestCase, override_settings
 from django.test.client import RequestFactory
 from django.urls import reverse, reverse_lazy
@@ -31,26 +44,68 @@ from django.urls import reverse, reverse_lazy
 from django.contrib.auth import SESSION_KEY, get_user_model
 from django.contrib.auth.models import AnonymousUser
 
+import saml2.entity
+from saml2 import BINDING_HTTP_REDIRECT
 from saml2.config import SPConfig
+from saml2.response import AuthnResponse, UnsolicitedResponse
 from saml2.s_utils import (
     UnknownSystemEntity,
     decode_base64_and_inflate,
     deflate_and_base64_encode,
 )
+from saml2.samlp import AuthnRequest
+from saml2.sigver import (
+    CryptoBackendXmlSec1,
+    DecryptError,
+    SignatureError,
+    XmlsecError,
+    class_name,
+    get_xmlsec_binary,
+)
 
-from djangosaml2 import views
-from djangosaml2.cache import OutstandingQueriesCache
-from djangosaml2.conf import get_config
+from djangosaml2 import crypto, metrics, pool, signals, timing, views
+from djangosaml2.cache import (
+    AssertionReplayCache,
+    IdentityCache,
+    OutstandingQueriesCache,
+    StateCache,
+)
+from djangosaml2.conf import (
+    SPConfigRegistry,
+    config_fingerprint,
+    config_settings_loader,
+    get_config,
+    registry_config_loader,
+    sp_config_cache,
+)
+from djangosaml2.exceptions import SAMLResponseRejected
+from djangosaml2.metadata import (
+    MetadataRefresher,
+    idp_index,
+    mdq_entity_cache,
+    metadata_expiry,
+)
+from djangosaml2.metrics import MetricsRegistry
 from djangosaml2.middleware import SamlSessionMiddleware
+from djangosaml2.overrides import Saml2Client
+from djangosaml2.overrides import SPConfig as OverriddenSPConfig
+from djangosaml2.pool import ACSVerifierPool
+from djangosaml2.prefilter import decode_saml_response, peek_response
+from djangosaml2.singleflight import SingleFlight
+from djangosaml2.templatetags.idplist import MAX_LANGUAGES, _languages
 from djangosaml2.tests import conf
+from djangosaml2.timing import log_timings
 from djangosaml2.utils import (
+    available_idps,
     get_fallback_login_redirect_url,
     get_idp_sso_supported_bindings,
+    get_language_preferences,
     get_session_id_from_saml2,
     get_subject_id_from_saml2,
     saml2_from_httpredirect_request,
 )
 from djangosaml2.views import EchoAttributesView, finish_logout
+from djangosaml2.warmup import warmup
 
 from .auth_response import auth_response
 from .utils import SAMLPostFormParser
@@ -77,6 +132,14 @@ non_callable = "just a string"
 
 
 class UtilsTests(TestCase):
+    def test_get_language_preferences(self):
+        request = RequestFactory().get(
+            "/", HTTP_ACCEPT_LANGUAGE="it;q=0.5, en-US, *;q=0.1, de;q=0.8"
+        )
+        self.assertEqual(get_language_preferences(request), ["en-us", "de", "it"])
+        self.assertEqual(get_language_preferences(RequestFactory().get("/")), [])
+        self.assertEqual(get_language_preferences(None), [])
+
     def test_get_config_valid_path(self):
         self.assertEqual(get_config("djangosaml2.tests.dummy_loader"), "dummy_loader")
 
@@ -431,6 +494,19 @@ class SAML2Tests(TestCase):
             decode_base64_and_inflate(saml_request).decode("utf-8"),
         )
 
+    def test_login_several_idps_localized_names(self):
+        settings.SAML_CONFIG = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp1.example.com", "idp2.example.com"],
+            metadata_file="remote_metadata_multilang.xml",
+        )
+        response = self.client.get(
+            reverse("saml2_login"), HTTP_ACCEPT_LANGUAGE="it-IT,it;q=0.9"
+        )
+        self.assertContains(response, "Università Uno")
+        # no Italian name, English is the last resort
+        self.assertContains(response, "University Two")
+
     @override_settings(ACS_DEFAULT_REDIRECT_URL="testprofiles:dashboard")
     def test_assertion_consumer_service(self):
         # Get initial number of users
@@ -526,6 +602,393 @@ class SAML2Tests(TestCase):
         self.assertRedirects(response, "/dashboard/")
         self.assertEqual(str(new_user.id), self.client.session[SESSION_KEY])
 
+    def post_through_pool(self, pool, solicited=True):
+        response = self.client.get(reverse("saml2_login"))
+        session_id = get_session_id_from_saml2(
+            saml2_from_httpredirect_request(response.url)
+        )
+        self.add_outstanding_query(session_id, "/another-view/")
+        if not solicited:
+            session_id = "id-unknown"
+
+        with mock.patch("djangosaml2.views.get_acs_pool", return_value=pool):
+            return self.client.post(
+                reverse("saml2_acs"),
+                {
+                    "SAMLResponse": self.b64_for_post(
+                        auth_response(session_id, "student")
+                    ),
+                    "RelayState": "/another-view/",
+                },
+            )
+
+    def acs_pool(self, **kwargs):
+        settings.SAML_CONFIG = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+            metadata_file="remote_metadata_one_idp.xml",
+        )
+        # forked, the workers see the SAML_CONFIG set by the test
+        pool = ACSVerifierPool(
+            1, mp_context=multiprocessing.get_context("fork"), **kwargs
+        )
+        self.addCleanup(pool.shutdown)
+        return pool
+
+    def test_assertion_consumer_service_verifier_pool(self):
+        pool = self.acs_pool(timeout=30)
+        with (
+            mock.patch(
+                "saml2.population.Population.add_information_about_person"
+            ) as add_identity,
+            mock.patch.object(
+                views.AssertionConsumerServiceView, "custom_validation"
+            ) as custom_validation,
+        ):
+            response = self.post_through_pool(pool)
+
+        self.assertRedirects(response, "/another-view/", fetch_redirect_response=False)
+        user = User.objects.get(id=self.client.session[SESSION_KEY])
+        self.assertEqual(user.username, "student")
+        self.assertEqual(pool.stats()["verified"], 1)
+        # the identity is stored in the session by the request process
+        add_identity.assert_called_once()
+        self.assertEqual(add_identity.call_args[0][0]["ava"]["uid"], ["student"])
+        # the hooks get the AuthnResponse, as without a pool
+        (authn_response,) = custom_validation.call_args[0]
+        self.assertIsInstance(authn_response, AuthnResponse)
+        self.assertIs(authn_response.sec.crypto.__class__, CryptoBackendXmlSec1)
+        self.assertEqual(authn_response.session_info()["ava"]["uid"], ["student"])
+        self.assertEqual(
+            authn_response.issuer(),
+            "https://idp.example.com/simplesaml/saml2/idp/metadata.php",
+        )
+
+    def test_verifier_pool_worker_config_loaded_once(self):
+        settings.SAML_CONFIG = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+            metadata_file="remote_metadata_one_idp.xml",
+        )
+        self.addCleanup(setattr, pool, "_worker_config", None)
+        with mock.patch("djangosaml2.conf.get_config", wraps=get_config) as load_config:
+            # what a worker does when it starts, then for each response
+            pool._init_worker(None)
+            for i in range(3):
+                response = pool._verify(
+                    self.b64_for_post(auth_response(f"id-{i}", "student")),
+                    saml2.BINDING_HTTP_POST,
+                    {f"id-{i}": "/"},
+                )
+                self.assertEqual(response.state["in_response_to"], f"id-{i}")
+        load_config.assert_called_once_with(None)
+
+    def test_assertion_consumer_service_verifier_pool_errors(self):
+        pool = self.acs_pool(timeout=30)
+
+        # the exceptions raised by pysaml2 in the worker reach the view
+        response = self.post_through_pool(pool, solicited=False)
+        self.assertEqual(response.status_code, 403)
+        self.assertIn(
+            "UnsolicitedResponse", response.context["exception"].__class__.__name__
+        )
+
+        with mock.patch.object(pool, "_slots", threading.Semaphore(0)):
+            response = self.post_through_pool(pool)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(pool.stats()["rejected"], 1)
+
+    @override_settings(
+        SAML_ACS_POOL_WORKERS=1,
+        SAML_CONFIG_LOADER="djangosaml2.tests.host_config_loader",
+    )
+    def test_assertion_consumer_service_no_pool_with_config_loader(self):
+        with mock.patch("djangosaml2.pool.ACSVerifierPool") as pool_class:
+            response = self.post_assertion()
+
+        # the workers couldn't call the loader without the request
+        pool_class.assert_not_called()
+        self.assertRedirects(response, "/another-view/", fetch_redirect_response=False)
+
+    def test_assertion_consumer_service_verifier_pool_timeout(self):
+        response = self.post_through_pool(self.acs_pool(timeout=0))
+        self.assertEqual(response.status_code, 503)
+
+    def post_assertion(self, namespace=""):
+        response = self.client.get(reverse(f"{namespace}saml2_login"))
+        session_id = get_session_id_from_saml2(
+            saml2_from_httpredirect_request(response.url)
+        )
+        self.add_outstanding_query(session_id, "/another-view/")
+        return self.client.post(
+            reverse(f"{namespace}saml2_acs"),
+            {
+                "SAMLResponse": self.b64_for_post(auth_response(session_id, "student")),
+                "RelayState": "/another-view/",
+            },
+        )
+
+    @override_settings(SAML_ASSERTION_REPLAY_CACHE="default")
+    def test_assertion_consumer_service_replay(self):
+        settings.SAML_CONFIG = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+            metadata_file="remote_metadata_one_idp.xml",
+        )
+        self.addCleanup(caches["default"].clear)
+
+        for namespace in ("", "async:"):
+            with self.subTest(namespace=namespace):
+                caches["default"].clear()
+                response = self.post_assertion(namespace)
+                self.assertEqual(response.status_code, 302)
+
+                # a new request, answered with the assertion already consumed
+                self.client.logout()
+                with mock.patch.object(
+                    views.AssertionConsumerServiceView, "authenticate_user"
+                ) as authenticate_user:
+                    response = self.post_assertion(namespace)
+                self.assertEqual(response.status_code, 403)
+                self.assertIsInstance(response.context["exception"], PermissionDenied)
+                authenticate_user.assert_not_called()
+
+    def test_assertion_replay_cache(self):
+        replay_cache = AssertionReplayCache("default", max_ttl=600)
+        self.addCleanup(replay_cache.cache.clear)
+        in_a_minute = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            seconds=60
+        )
+        not_on_or_after = in_a_minute.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        self.assertTrue(replay_cache.add("idp", "id-1", not_on_or_after))
+        self.assertFalse(replay_cache.add("idp", "id-1", not_on_or_after))
+        # IDs are unique per issuer only
+        self.assertTrue(replay_cache.add("other-idp", "id-1", not_on_or_after))
+
+        # entries expire with the assertion, plus the clock skew, within bounds
+        self.assertAlmostEqual(replay_cache.get_timeout(not_on_or_after), 60, delta=2)
+        self.assertAlmostEqual(
+            replay_cache.get_timeout(not_on_or_after, skew=30), 90, delta=2
+        )
+        self.assertEqual(replay_cache.get_timeout("2100-01-01T00:00:00Z"), 600)
+        self.assertEqual(replay_cache.get_timeout("2000-01-01T00:00:00Z"), 1)
+        self.assertEqual(replay_cache.get_timeout(None), 600)
+        self.assertEqual(replay_cache.get_timeout("not a date"), 600)
+
+    @override_settings(SAML_ACS_PREFILTER=True)
+    def test_assertion_consumer_service_prefilter(self):
+        settings.SAML_CONFIG = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+            metadata_file="remote_metadata_one_idp.xml",
+        )
+        response = self.client.get(reverse("saml2_login"))
+        session_id = get_session_id_from_saml2(
+            saml2_from_httpredirect_request(response.url)
+        )
+        self.add_outstanding_query(session_id, "/another-view/")
+        saml_response = auth_response(session_id, "student")
+
+        rejected = {
+            "too large": self.b64_for_post(saml_response + " " * 1024),
+            "not base64": "PHNhbWxwOlJlc3BvbnNl*",
+            "not a response": self.b64_for_post(
+                saml_response.replace("samlp:Response", "samlp:ArtifactResponse")
+            ),
+            "unknown issuer": self.b64_for_post(
+                saml_response.replace(
+                    "https://idp.example.com/", "https://unknown.example.com/", 1
+                )
+            ),
+        }
+        with (
+            override_settings(
+                SAML_ACS_MAX_RESPONSE_SIZE=len(self.b64_for_post(saml_response)) + 100
+            ),
+            mock.patch.object(
+                Saml2Client, "parse_authn_request_response"
+            ) as parse_response,
+        ):
+            for case, data in rejected.items():
+                with self.subTest(case):
+                    response = self.client.post(
+                        reverse("saml2_acs"), {"SAMLResponse": data}
+                    )
+                    self.assertEqual(response.status_code, 400)
+                    self.assertIsInstance(
+                        response.context["exception"], SAMLResponseRejected
+                    )
+            # refused as pysaml2 does
+            response = self.client.post(
+                reverse("saml2_acs"),
+                {"SAMLResponse": self.b64_for_post(auth_response("id-unknown", "x"))},
+            )
+            self.assertEqual(response.status_code, 403)
+            self.assertIsInstance(response.context["exception"], UnsolicitedResponse)
+        parse_response.assert_not_called()
+
+        # base64 wrapped at 76 columns is fine
+        data = base64.encodebytes(saml_response.encode()).decode()
+        response = self.client.post(
+            reverse("saml2_acs"),
+            {"SAMLResponse": data, "RelayState": "/another-view/"},
+        )
+        self.assertRedirects(response, "/another-view/", fetch_redirect_response=False)
+
+    def test_timing(self):
+        settings.SAML_CONFIG = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+            metadata_file="remote_metadata_one_idp.xml",
+        )
+        sink = mock.Mock()
+        with override_settings(
+            SAML_TIMING_SINKS=[sink, "djangosaml2.timing.send_timings"]
+        ):
+            received = []
+            signals.phases_timed.connect(
+                lambda sender, timings, **kwargs: received.append(sender),
+                weak=False,
+                dispatch_uid="test_timing",
+            )
+            self.addCleanup(signals.phases_timed.disconnect, dispatch_uid="test_timing")
+            response = self.post_assertion()
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(received, ["login", "acs"])
+
+        (login, login_timings), kwargs = sink.call_args_list[0]
+        self.assertEqual(login, "login")
+        self.assertTrue({"config", "metadata", "total"} <= set(login_timings))
+        (acs, acs_timings), kwargs = sink.call_args_list[1]
+        self.assertEqual(acs, "acs")
+        self.assertEqual(
+            set(acs_timings),
+            {
+                "config",
+                "verify",
+                "lookup",
+                "update",
+                "session",
+                "total",
+            },
+        )
+        self.assertLessEqual(acs_timings["verify"], acs_timings["total"])
+        self.assertIs(kwargs["response"], response)
+
+        # the test responses aren't signed, the crypto phase is timed apart
+        with override_settings(SAML_TIMING_SINKS=[sink]):
+            config = get_config()
+            client = Saml2Client.from_config(config)
+            self.assertIsInstance(client.sec.crypto, timing.TimedCryptoBackend)
+            timer = timing.PhaseTimer("acs")
+            token = timing._current_timer.set(timer)
+            try:
+                with mock.patch.object(client.sec.crypto.backend, "validate_signature"):
+                    client.sec.crypto.validate_signature(
+                        "<xml/>", "cert", "pem", "", ""
+                    )
+            finally:
+                timing._current_timer.reset(token)
+            self.assertIn("crypto", timer.phases)
+
+        with self.assertLogs("djangosaml2", level="INFO") as logs:
+            log_timings("acs", {"verify": 0.0123, "total": 0.05})
+        self.assertIn("SAML acs timings: verify=12.3ms total=50.0ms", logs.output[0])
+
+        # disabled, nothing is timed
+        self.assertIs(timing.phase("verify"), timing.phase("lookup"))
+        sink.reset_mock()
+        self.client.logout()
+        self.post_assertion()
+        sink.assert_not_called()
+
+    @override_settings(SAML_SERVER_TIMING=True)
+    def test_server_timing(self):
+        settings.SAML_CONFIG = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+            metadata_file="remote_metadata_one_idp.xml",
+        )
+
+        def phases(response):
+            return {
+                metric.split(";")[0] for metric in response["Server-Timing"].split(", ")
+            }
+
+        response = self.client.get(reverse("saml2_login"))
+        self.assertTrue({"config", "metadata", "total"} <= phases(response))
+        session_id = get_session_id_from_saml2(
+            saml2_from_httpredirect_request(response.url)
+        )
+        self.add_outstanding_query(session_id, "/another-view/")
+        response = self.client.post(
+            reverse("saml2_acs"),
+            {
+                "SAMLResponse": self.b64_for_post(auth_response(session_id, "student")),
+                "RelayState": "/another-view/",
+            },
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(
+            {"config", "verify", "lookup", "update", "session"} <= phases(response)
+        )
+        self.assertRegex(response["Server-Timing"], r"total;dur=\d+\.\d$")
+
+        response = self.client.get(reverse("saml2_logout"))
+        self.assertTrue({"config", "session", "total"} <= phases(response))
+        with mock.patch.object(views, "entity_descriptor", return_value="<md/>"):
+            response = self.client.get(reverse("saml2_metadata"))
+        self.assertEqual(phases(response), {"config", "render", "total"})
+
+        # a header set by the view is kept
+        response = http.HttpResponse(headers={"Server-Timing": "app;dur=1.0"})
+        timing.server_timing("login", {"total": 0.0021}, response=response)
+        self.assertEqual(response["Server-Timing"], "app;dur=1.0, total;dur=2.1")
+
+    def test_metrics(self):
+        settings.SAML_CONFIG = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+            metadata_file="remote_metadata_one_idp.xml",
+        )
+        metrics.registry.clear()
+        self.addCleanup(metrics.registry.clear)
+        idp = "https://idp.example.com/simplesaml/saml2/idp/metadata.php"
+
+        response = self.post_assertion()
+        self.assertEqual(response.status_code, 302)
+        self.client.logout()
+        with override_settings(SAML_ACS_PREFILTER=True):
+            response = self.client.post(
+                reverse("saml2_acs"), {"SAMLResponse": "not base64!"}
+            )
+        self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(metrics.logins_started.value(idp=idp), 1)
+        self.assertEqual(metrics.acs_successes.value(idp=idp), 1)
+        self.assertEqual(metrics.acs_duration.count(idp=idp), 1)
+        self.assertEqual(metrics.acs_failures.value(reason="SAMLResponseRejected"), 1)
+
+        response = self.client.get(reverse("saml2_metrics"))
+        self.assertEqual(response.status_code, 404)
+        with override_settings(SAML_METRICS_ENABLED=True):
+            response = self.client.get(reverse("saml2_metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        content = response.content.decode()
+        self.assertIn(f'djangosaml2_acs_successes_total{{idp="{idp}"}} 1\n', content)
+        self.assertIn(
+            'djangosaml2_acs_failures_total{reason="SAMLResponseRejected"} 1\n',
+            content,
+        )
+        self.assertIn(
+            f'djangosaml2_acs_duration_seconds_bucket{{idp="{idp}",le="+Inf"}} 1\n',
+            content,
+        )
+        self.assertIn("# TYPE djangosaml2_config_cache_hits_total counter\n", content)
+        self.assertIn("djangosaml2_mdq_fetches_total ", content)
+
     def test_assertion_consumer_service_already_logged_in_allowed(self):
         self.client.force_login(User.objects.create(username="user", password="pass"))
 
@@ -627,6 +1090,96 @@ class SAML2Tests(TestCase):
         self.assertEqual(response.status_code, 302)
         return subject_id
 
+    def test_async_views(self):
+        settings.SAML_CONFIG = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+            metadata_file="remote_metadata_one_idp.xml",
+        )
+        self.assertTrue(views.AsyncLoginView.view_is_async)
+
+        response = self.client.get(reverse("async:saml2_login"))
+        self.assertEqual(response.status_code, 302)
+        session_id = get_session_id_from_saml2(
+            saml2_from_httpredirect_request(response.url)
+        )
+        self.add_outstanding_query(session_id, "/another-view/")
+
+        with mock.patch.object(
+            views.AsyncAssertionConsumerServiceView, "post_login_hook"
+        ) as post_login_hook:
+            response = self.client.post(
+                reverse("async:saml2_acs"),
+                {
+                    "SAMLResponse": self.b64_for_post(
+                        auth_response(session_id, "student")
+                    ),
+                    "RelayState": "/another-view/",
+                },
+            )
+        self.assertRedirects(response, "/another-view/", fetch_redirect_response=False)
+        user = User.objects.get(id=self.client.session[SESSION_KEY])
+        self.assertEqual(user.username, "student")
+        # the sync hooks overridden are still called
+        post_login_hook.assert_called_once()
+
+        # a global logout started by the IdP
+        subject_id = views._get_subject_id(self.saml_session)
+        instant = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+        saml_request = (
+            '<samlp:LogoutRequest xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" '
+            'xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" ID="_9961abbaae6d06d2" '
+            f'Version="2.0" IssueInstant="{instant}" '
+            'Destination="http://sp.example.com/saml2/ls/">'
+            "<saml:Issuer>https://idp.example.com/simplesaml/saml2/idp/metadata.php"
+            '</saml:Issuer><saml:NameID SPNameQualifier="http://sp.example.com/saml2/metadata/" '
+            'Format="urn:oasis:names:tc:SAML:2.0:nameid-format:transient">'
+            f"{subject_id}</saml:NameID><samlp:SessionIndex>_1837687b7bc9faad8"
+            "</samlp:SessionIndex></samlp:LogoutRequest>"
+        )
+        response = self.client.get(
+            reverse("async:saml2_ls"),
+            {"SAMLRequest": deflate_and_base64_encode(saml_request)},
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            urlparse(response["Location"]).path,
+            "/simplesaml/saml2/idp/SingleLogoutService.php",
+        )
+        self.assertNotIn(SESSION_KEY, self.client.session)
+
+        response = self.client.get(reverse("async:saml2_ls"))
+        self.assertEqual(response.status_code, 400)
+
+    async def test_async_sp_config(self):
+        view = views.AsyncLoginView()
+        request = RequestFactory().get("/login/")
+        with mock.patch.object(
+            views, "sync_to_async", wraps=views.sync_to_async
+        ) as in_thread:
+            await view.aget_sp_config(request)
+            self.assertEqual(in_thread.call_count, 1)
+
+            with override_settings(SAML_CONFIG_CACHE_ENABLED=True):
+                # loaded in a thread, then served from memory
+                config = await view.aget_sp_config(request)
+                self.assertEqual(in_thread.call_count, 2)
+                self.assertIs(await view.aget_sp_config(request), config)
+                self.assertEqual(in_thread.call_count, 2)
+
+    async def test_async_client(self):
+        view = views.AsyncAssertionConsumerServiceView()
+        config = test_config_loader_with_real_conf(None)
+        with mock.patch.object(
+            views, "sync_to_async", wraps=views.sync_to_async
+        ) as in_thread:
+            # built in a thread, then shared
+            await view.aget_client(config)
+            self.assertEqual(in_thread.call_count, 1)
+            self.assertTrue(Saml2Client.has_shared_client(config))
+            await view.aget_client(config)
+            self.assertEqual(in_thread.call_count, 1)
+
     def test_echo_view_no_saml_session(self):
         settings.SAML_CONFIG = conf.create_conf(
             sp_host="sp.example.com",
@@ -924,6 +1477,16 @@ def test_config_loader_with_real_conf(request):
     return config
 
 
+registry_config_loader_with_real_conf = registry_config_loader(
+    lambda request: "sp.example.com", SPConfigRegistry()
+)(test_config_loader_with_real_conf)
+
+
+@registry_config_loader(lambda request: request.get_host(), SPConfigRegistry())
+def host_config_loader(request):
+    return test_config_loader_with_real_conf(request)
+
+
 class ConfTests(TestCase):
     def test_custom_conf_loader(self):
         config_loader_path = "djangosaml2.tests.test_config_loader"
@@ -962,6 +1525,1283 @@ class ConfTests(TestCase):
         self.assertEqual(url.path, "/simplesaml/saml2/idp/SSOService.php")
 
 
+@override_settings(SAML_CONFIG_CACHE_ENABLED=True)
+class ConfigCacheTests(TestCase):
+    def setUp(self):
+        sp_config_cache.clear()
+        self.saml_config = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+            metadata_file="remote_metadata_one_idp.xml",
+        )
+
+    def test_config_is_shared(self):
+        with override_settings(SAML_CONFIG=self.saml_config):
+            hits = sp_config_cache.hits
+            first = config_settings_loader()
+            second = config_settings_loader()
+
+        self.assertIs(first, second)
+        self.assertEqual(sp_config_cache.hits, hits + 1)
+
+    def test_config_fingerprinted_once(self):
+        with override_settings(SAML_CONFIG=self.saml_config):
+            with mock.patch(
+                "djangosaml2.conf.config_fingerprint",
+                wraps=config_fingerprint,
+            ) as fingerprint:
+                first = config_settings_loader()
+                second = config_settings_loader()
+            fingerprint.assert_called_once()
+            self.assertIs(first, second)
+
+            # in-place changes are seen once the cache is cleared
+            settings.SAML_CONFIG["entityid"] = "http://other.example.com/metadata/"
+            self.assertIs(config_settings_loader(), first)
+            sp_config_cache.clear()
+            third = config_settings_loader()
+
+        self.assertIsNot(first, third)
+        self.assertEqual(third.entityid, "http://other.example.com/metadata/")
+
+    def test_config_cache_cleared_on_setting_changed(self):
+        with override_settings(SAML_CONFIG=self.saml_config):
+            config_settings_loader()
+            misses = sp_config_cache.stats()["misses"]
+        with override_settings(SAML_CONFIG=self.saml_config):
+            config_settings_loader()
+        self.assertEqual(sp_config_cache.stats()["misses"], misses + 1)
+
+    @override_settings(SAML_CONFIG_CACHE_ENABLED=False)
+    def test_config_cache_disabled(self):
+        with override_settings(SAML_CONFIG=self.saml_config):
+            misses = sp_config_cache.misses
+            self.assertIsNot(config_settings_loader(), config_settings_loader())
+        self.assertEqual(sp_config_cache.misses, misses)
+
+
+class ConfigRegistryTests(TestCase):
+    def build(self, name):
+        config = SPConfig()
+        config.load({"entityid": name})
+        return config
+
+    def test_registry_reuses_tenant_config(self):
+        registry = SPConfigRegistry(max_entries=2, ttl=60)
+        first = registry.get("a.example.com", lambda: self.build("a"))
+        second = registry.get("a.example.com", lambda: self.build("other"))
+
+        self.assertIs(first, second)
+        self.assertEqual(registry.stats()["hits"], 1)
+        self.assertEqual(registry.stats()["misses"], 1)
+
+    def test_registry_lru_eviction(self):
+        registry = SPConfigRegistry(max_entries=2, ttl=60)
+        registry.get("a", lambda: self.build("a"))
+        registry.get("b", lambda: self.build("b"))
+        # touch a, so that b becomes the least recently used
+        registry.get("a", lambda: self.build("a"))
+        registry.get("c", lambda: self.build("c"))
+
+        self.assertEqual(list(registry._entries), ["a", "c"])
+        self.assertEqual(registry.stats()["evictions"], 1)
+
+    def test_registry_memory_bound(self):
+        registry = SPConfigRegistry(max_entries=10, max_bytes=1, ttl=60)
+        registry.get("a", lambda: self.build("a"))
+        registry.get("b", lambda: self.build("b"))
+
+        # the most recent entry is always kept
+        self.assertEqual(list(registry._entries), ["b"])
+        self.assertGreater(registry.stats()["bytes"], 0)
+
+    def test_registry_ttl(self):
+        registry = SPConfigRegistry(ttl=60)
+        first = registry.get("a", lambda: self.build("a"))
+        with mock.patch("djangosaml2.conf.time.monotonic", return_value=1e12):
+            second = registry.get("a", lambda: self.build("a"))
+
+        self.assertIsNot(first, second)
+        self.assertEqual(registry.stats()["misses"], 2)
+
+    def test_registry_builds_cold_tenant_once(self):
+        registry = SPConfigRegistry(ttl=60)
+        builds = []
+        release = threading.Event()
+
+        def builder():
+            builds.append(1)
+            release.wait(5)
+            return self.build("a")
+
+        threads = [
+            threading.Thread(target=registry.get, args=("a", builder)) for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(builds), 1)
+
+    @override_settings(ALLOWED_HOSTS=["tenant.example.com"])
+    def test_registry_config_loader(self):
+        registry = SPConfigRegistry(ttl=60)
+
+        @registry_config_loader(lambda request: request.get_host(), registry)
+        def loader(request):
+            return self.build(request.get_host())
+
+        request = RequestFactory().get("/login/", HTTP_HOST="tenant.example.com")
+        self.assertIs(get_config(loader, request), get_config(loader, request))
+        self.assertEqual(get_config(loader, request).entityid, "tenant.example.com")
+
+
+class SingleFlightTests(TestCase):
+    def run_concurrently(self, target, count=5):
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def wait_for(self, predicate):
+        deadline = time.monotonic() + 5
+        while not predicate() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_concurrent_calls_coalesced(self):
+        flight = SingleFlight("test")
+        release = threading.Event()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return "result"
+
+        threads = self.run_concurrently(
+            lambda: results.append(flight.do("key", compute))
+        )
+        self.wait_for(lambda: flight.stats()["coalesced"] == 4)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["result"] * 5)
+        self.assertEqual(
+            flight.stats(),
+            {"calls": 1, "coalesced": 4, "coalesced_remote": 0, "in_flight": 0},
+        )
+
+    def test_error_shared_with_waiters(self):
+        flight = SingleFlight("test")
+        release = threading.Event()
+        errors = []
+
+        def compute():
+            release.wait(5)
+            raise ValueError("boom")
+
+        def call():
+            try:
+                flight.do("key", compute)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = self.run_concurrently(call, count=3)
+        self.wait_for(lambda: flight.stats()["coalesced"] == 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 3)
+        # nothing is remembered once the flight is over
+        self.assertEqual(flight.do("key", lambda: "again"), "again")
+
+    def test_coalesced_across_processes(self):
+        flight = SingleFlight("test")
+        lock_cache = caches["default"]
+        self.addCleanup(lock_cache.clear)
+        # the lock held by another process, which publishes the result
+        lock_cache.add("djangosaml2:singleflight:test:key", 1)
+        published = iter([None, None, "published"])
+        compute = mock.Mock(return_value="computed")
+
+        result = flight.do(
+            "key", compute, shared=lambda: next(published), lock_cache=lock_cache
+        )
+
+        self.assertEqual(result, "published")
+        compute.assert_not_called()
+        self.assertEqual(flight.stats()["coalesced_remote"], 1)
+
+    def test_lock_holder_given_up(self):
+        flight = SingleFlight("test")
+        flight.poll_interval = 0.01
+        lock_cache = caches["default"]
+        self.addCleanup(lock_cache.clear)
+        lock_cache.add("djangosaml2:singleflight:test:key", 1)
+
+        result = flight.do(
+            "key",
+            lambda: "computed",
+            shared=lambda: None,
+            lock_cache=lock_cache,
+            lock_timeout=0.05,
+        )
+        self.assertEqual(result, "computed")
+
+
+class SharedClientTests(TestCase):
+    def setUp(self):
+        self.config = OverriddenSPConfig()
+        self.config.load(conf.create_conf(sp_host="sp.example.com"))
+
+    def test_client_built_once_per_config(self):
+        with mock.patch(
+            "saml2.entity.security_context", wraps=saml2.entity.security_context
+        ) as security_context_mock:
+            first = Saml2Client.from_config(self.config)
+            second = Saml2Client.from_config(self.config)
+
+        security_context_mock.assert_called_once()
+        self.assertIsNot(first, second)
+        self.assertIs(first.sec, second.sec)
+        self.assertIs(first.metadata, self.config.metadata)
+
+    def test_per_request_caches(self):
+        session = {}
+        state = StateCache(session)
+        identity_cache = IdentityCache(session)
+        client = Saml2Client.from_config(
+            self.config, identity_cache=identity_cache, state_cache=state
+        )
+        other = Saml2Client.from_config(self.config)
+
+        self.assertIs(client.state, state)
+        self.assertIs(client.users.cache._db, identity_cache._db)
+        self.assertEqual(other.state, {})
+        self.assertIsNot(client.users, other.users)
+        self.assertIsNot(client.lock, other.lock)
+        self.assertIsNot(client.cookiejar, other.cookiejar)
+
+    def test_client_rebuilt_on_metadata_change(self):
+        first = Saml2Client.from_config(self.config)
+        other = OverriddenSPConfig()
+        other.load(conf.create_conf(metadata_file="remote_metadata_three_idps.xml"))
+        self.config.setattr("", "metadata", other.metadata)
+
+        second = Saml2Client.from_config(self.config)
+        self.assertIsNot(first.sec, second.sec)
+        self.assertIs(second.metadata, other.metadata)
+
+    @override_settings(SAML_SHARED_CLIENT=False)
+    def test_shared_client_disabled(self):
+        first = Saml2Client.from_config(self.config)
+        second = Saml2Client.from_config(self.config)
+        self.assertIsNot(first.sec, second.sec)
+
+
+def _xmlsec1_backend():
+    """Return the xmlsec1 subprocess backend if a working binary is around."""
+    try:
+        backend = CryptoBackendXmlSec1(get_xmlsec_binary())
+        config = OverriddenSPConfig()
+        config.load(conf.create_conf(authn_requests_signed=True))
+        _req_id, request = Saml2Client(config).create_authn_request(
+            "https://idp.example.com/simplesaml/saml2/idp/SSOService.php"
+        )
+        signed = backend.sign_statement(
+            str(request), class_name(request), config.key_file, request.id
+        )
+        return backend if "SignatureValue>" in signed else None
+    except Exception:
+        return None
+
+
+@skipUnless(crypto.xmlsec is not None, "the xmlsec package is not installed")
+@override_settings(SAML_CRYPTO_BACKEND="djangosaml2.crypto.CryptoBackendXMLSecBinding")
+class CryptoBackendTests(TestCase):
+    def setUp(self):
+        self.config = OverriddenSPConfig()
+        self.config.load(conf.create_conf(authn_requests_signed=True))
+        self.client = Saml2Client(self.config)
+
+    def signed_request(self):
+        req_id, request = self.client.create_authn_request(
+            "https://idp.example.com/simplesaml/saml2/idp/SSOService.php", sign=True
+        )
+        return req_id, str(request)
+
+    def verify(self, signed, req_id, sec=None):
+        return (sec or self.client.sec).verify_signature(
+            signed,
+            self.config.cert_file,
+            node_name=class_name(AuthnRequest()),
+            node_id=req_id,
+        )
+
+    def test_backend_selected(self):
+        self.assertIsInstance(self.client.sec.crypto, crypto.CryptoBackendXMLSecBinding)
+
+    def test_sign_and_verify(self):
+        req_id, signed = self.signed_request()
+        self.assertIn("SignatureValue>", signed)
+        self.assertTrue(self.verify(signed, req_id))
+
+        with self.assertRaises(XmlsecError):
+            self.verify(signed.replace("sp.example.com", "sp.evil.com"), req_id)
+
+    def test_keys_loaded_once(self):
+        req_id, signed = self.signed_request()
+        keys = self.client.sec.crypto._keys
+        # the signing key
+        self.assertEqual(len(keys), 1)
+        for _ in range(3):
+            # pysaml2 writes the certs in a new temporary file every time
+            with tempfile.NamedTemporaryFile(suffix=".pem") as cert:
+                with open(self.config.cert_file, "rb") as fp:
+                    cert.write(fp.read())
+                cert.flush()
+                self.client.sec.verify_signature(
+                    signed,
+                    cert.name,
+                    node_name=class_name(AuthnRequest()),
+                    node_id=req_id,
+                )
+        self.assertEqual(len(keys), 2)
+
+    def test_external_references_rejected(self):
+        req_id, signed = self.signed_request()
+        with self.assertRaises(SignatureError):
+            self.verify(
+                signed.replace(f'URI="#{req_id}"', 'URI="http://evil.com/doc"'), req_id
+            )
+
+    def test_duplicate_ids_rejected(self):
+        req_id, signed = self.signed_request()
+        # other tests may have registered a prefix for the protocol namespace
+        wrapped = re.sub(
+            r"</(\w+):AuthnRequest>$",
+            rf'<\1:Extensions ID="{req_id}" /></\1:AuthnRequest>',
+            signed,
+        )
+        self.assertNotEqual(wrapped, signed)
+        with self.assertRaises(SignatureError):
+            self.verify(wrapped, req_id)
+
+    def test_encryption_delegated(self):
+        backend = self.client.sec.crypto
+        # the xmlsec1 backend pysaml2 configured
+        self.assertIsInstance(backend.fallback, CryptoBackendXmlSec1)
+
+        backend.fallback = mock.Mock()
+        backend.encrypt("text", "key.pem", "template", "des-192")
+        backend.fallback.encrypt.assert_called_once_with(
+            "text", "key.pem", "template", "des-192", ""
+        )
+        backend.encrypt_assertion("statement", "key.pem", "template", node_id="id-1")
+        backend.fallback.encrypt_assertion.assert_called_once_with(
+            "statement", "key.pem", "template", "des-192", None, "id-1"
+        )
+
+    def test_dtd_rejected(self):
+        req_id, signed = self.signed_request()
+        with self.assertRaises(SignatureError):
+            self.verify('<!DOCTYPE foo [<!ENTITY x "y">]>' + signed, req_id)
+
+    def test_decrypt(self):
+        assertion = (
+            '<saml:Assertion xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" '
+            'ID="id-1" Version="2.0" IssueInstant="2024-01-01T00:00:00Z">'
+            "<saml:Issuer>https://idp.example.com</saml:Issuer></saml:Assertion>"
+        )
+        etree, xmlsec = crypto.etree, crypto.xmlsec
+        root = etree.fromstring(
+            '<saml:EncryptedAssertion xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion">'
+            + assertion
+            + "</saml:EncryptedAssertion>"
+        )
+        enc_data = xmlsec.template.encrypted_data_create(
+            root,
+            xmlsec.constants.TransformAes128Cbc,
+            type=xmlsec.constants.TypeEncElement,
+            ns="xenc",
+        )
+        xmlsec.template.encrypted_data_ensure_cipher_value(enc_data)
+        key_info = xmlsec.template.encrypted_data_ensure_key_info(enc_data, ns="dsig")
+        enc_key = xmlsec.template.add_encrypted_key(
+            key_info, xmlsec.constants.TransformRsaOaep
+        )
+        xmlsec.template.encrypted_data_ensure_cipher_value(enc_key)
+        manager = xmlsec.KeysManager()
+        manager.add_key(
+            xmlsec.Key.from_file(
+                self.config.cert_file, xmlsec.constants.KeyDataFormatCertPem
+            )
+        )
+        ctx = xmlsec.EncryptionContext(manager)
+        ctx.key = xmlsec.Key.generate(
+            xmlsec.constants.KeyDataAes, 128, xmlsec.constants.KeyDataTypeSession
+        )
+        ctx.encrypt_xml(enc_data, root[0])
+        encrypted = etree.tostring(root, encoding="unicode")
+        self.assertNotIn("https://idp.example.com", encrypted)
+
+        decrypted = self.client.sec.decrypt(encrypted, self.config.key_file)
+        self.assertIn("<saml:Issuer>https://idp.example.com</saml:Issuer>", decrypted)
+
+        with self.assertRaises(DecryptError):
+            self.client.sec.decrypt(encrypted.replace("CipherValue>", "Foo>"))
+
+    def test_equivalent_to_xmlsec1(self):
+        xmlsec1 = _xmlsec1_backend()
+        if xmlsec1 is None:
+            self.skipTest("a working xmlsec1 binary is not available")
+        subprocess_sec = copy.copy(self.client.sec)
+        subprocess_sec.crypto = xmlsec1
+
+        _req_id, request = self.client.create_authn_request(
+            "https://idp.example.com/simplesaml/saml2/idp/SSOService.php"
+        )
+        signed_in_process = self.client.sec.sign_statement(
+            str(request), class_name(request), node_id=request.id
+        )
+        signed_by_xmlsec1 = subprocess_sec.sign_statement(
+            str(request), class_name(request), node_id=request.id
+        )
+        for signed in (signed_in_process, signed_by_xmlsec1):
+            self.assertTrue(self.verify(signed, request.id))
+            self.assertTrue(self.verify(signed, request.id, sec=subprocess_sec))
+            tampered = signed.replace("sp.example.com", "sp.evil.com")
+            for sec in (self.client.sec, subprocess_sec):
+                with self.assertRaises(XmlsecError):
+                    self.verify(tampered, request.id, sec=sec)
+
+    def test_xmlsec_required(self):
+        with mock.patch("djangosaml2.crypto.xmlsec", None):
+            with self.assertRaises(ImproperlyConfigured):
+                Saml2Client(self.config)
+
+
+@override_settings(SAML_CONFIG_CACHE_ENABLED=True)
+class WarmupTests(TestCase):
+    def setUp(self):
+        sp_config_cache.clear()
+
+    def test_warmup(self):
+        with override_settings(
+            SAML_CONFIG=conf.create_conf(
+                sp_host="sp.example.com",
+                idp_hosts=["idp.example.com"],
+                metadata_file="remote_metadata_one_idp.xml",
+            )
+        ):
+            timings = warmup()
+            hits = sp_config_cache.hits
+            config_settings_loader()
+
+        self.assertEqual(list(timings), ["config", "metadata", "client"])
+        self.assertEqual(sp_config_cache.hits, hits + 1)
+
+    @override_settings(SAML_CONFIG_CACHE_ENABLED=False)
+    def test_warmup_config_not_cached(self):
+        with mock.patch("djangosaml2.warmup.get_config") as load_config:
+            with self.assertLogs("djangosaml2", "WARNING"):
+                self.assertEqual(warmup(), {})
+        load_config.assert_not_called()
+
+        with self.assertRaisesMessage(CommandError, "isn't cached"):
+            call_command(
+                "saml2_warmup",
+                config_loader="djangosaml2.tests.test_config_loader_with_real_conf",
+                stdout=StringIO(),
+            )
+
+    def test_warmup_command(self):
+        out = StringIO()
+        call_command(
+            "saml2_warmup",
+            config_loader="djangosaml2.tests.registry_config_loader_with_real_conf",
+            stdout=out,
+        )
+        self.assertIn("config: ", out.getvalue())
+        self.assertIn("client: ", out.getvalue())
+
+    @override_settings(SAML_WARMUP_ON_STARTUP=True)
+    def test_warmup_on_ready(self):
+        app_config = apps.get_app_config("djangosaml2")
+        with mock.patch("djangosaml2.warmup.warmup") as warmup_mock:
+            app_config.ready()
+        warmup_mock.assert_called_once_with()
+
+        # a broken configuration must not prevent the app from starting
+        with mock.patch("djangosaml2.warmup.warmup", side_effect=ValueError):
+            app_config.ready()
+
+
+class MetadataSnapshotTests(TestCase):
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.snapshot_dir)
+        self.metadata_file = os.path.join(self.snapshot_dir, "metadata.xml")
+        shutil.copy(
+            os.path.join(os.path.dirname(__file__), "remote_metadata_three_idps.xml"),
+            self.metadata_file,
+        )
+        self.saml_config = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+        )
+        self.saml_config["metadata"] = {"local": [self.metadata_file]}
+
+    def load(self):
+        config = OverriddenSPConfig()
+        config.load(copy.deepcopy(self.saml_config))
+        return config
+
+    def test_snapshot_is_used(self):
+        with override_settings(SAML_METADATA_SNAPSHOT_DIR=self.snapshot_dir):
+            parsed = self.load()
+            with mock.patch(
+                "djangosaml2.metadata.MetaDataFile.load"
+            ) as metadata_load_mock:
+                restored = self.load()
+
+        metadata_load_mock.assert_not_called()
+        self.assertEqual(dict(parsed.metadata.items()), dict(restored.metadata.items()))
+        self.assertEqual(
+            parsed.metadata.service(
+                "https://idp2.example.com/simplesaml/saml2/idp/metadata.php",
+                "idpsso_descriptor",
+                "single_sign_on_service",
+            ),
+            restored.metadata.service(
+                "https://idp2.example.com/simplesaml/saml2/idp/metadata.php",
+                "idpsso_descriptor",
+                "single_sign_on_service",
+            ),
+        )
+
+    def test_snapshot_discarded_on_source_change(self):
+        with override_settings(SAML_METADATA_SNAPSHOT_DIR=self.snapshot_dir):
+            self.load()
+            shutil.copy(
+                os.path.join(os.path.dirname(__file__), "remote_metadata_one_idp.xml"),
+                self.metadata_file,
+            )
+            config = self.load()
+
+        self.assertEqual(len(available_idps(config)), 1)
+
+    def test_snapshot_keeps_validity(self):
+        with open(self.metadata_file, encoding="utf-8") as fp:
+            xml = fp.read()
+        with open(self.metadata_file, "w", encoding="utf-8") as fp:
+            fp.write(
+                xml.replace(
+                    "<md:EntitiesDescriptor ",
+                    '<md:EntitiesDescriptor validUntil="2100-01-01T00:00:00Z" '
+                    'cacheDuration="PT1H" ',
+                    1,
+                )
+            )
+
+        now = time.time()
+        with override_settings(SAML_METADATA_SNAPSHOT_DIR=self.snapshot_dir):
+            parsed = self.load()
+            with mock.patch("djangosaml2.metadata.MetaDataFile.load"):
+                restored = self.load()
+
+        self.assertEqual(
+            metadata_expiry(restored.metadata, now),
+            metadata_expiry(parsed.metadata, now),
+        )
+        self.assertAlmostEqual(
+            metadata_expiry(restored.metadata, now), now + 3600, delta=1
+        )
+
+    def test_no_snapshot_by_default(self):
+        self.load()
+        self.assertEqual(os.listdir(self.snapshot_dir), ["metadata.xml"])
+
+
+class _MetadataHandler(BaseHTTPRequestHandler):
+    """Serve a metadata document honouring If-None-Match, counting the responses."""
+
+    def do_GET(self):
+        server = self.server
+        etag = '"%s"' % server.version
+        if self.headers.get("If-None-Match") == etag:
+            server.statuses.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        server.statuses.append(200)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/samlmetadata+xml")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(server.body)))
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetadataHTTPCacheTests(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+        self.server = HTTPServer(("127.0.0.1", 0), _MetadataHandler)
+        self.server.statuses = []
+        self.set_metadata("remote_metadata_three_idps.xml", version=1)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.saml_config = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+        )
+        self.saml_config["metadata"] = {
+            "remote": [
+                {"url": "http://127.0.0.1:%s/metadata" % self.server.server_port}
+            ]
+        }
+
+    def set_metadata(self, filename, version):
+        with open(os.path.join(os.path.dirname(__file__), filename), "rb") as fp:
+            self.server.body = fp.read()
+        self.server.version = version
+
+    def load(self):
+        config = OverriddenSPConfig()
+        config.load(copy.deepcopy(self.saml_config))
+        return config
+
+    def test_revalidated_with_conditional_requests(self):
+        with override_settings(SAML_METADATA_HTTP_CACHE_DIR=self.cache_dir):
+            first = self.load()
+            second = self.load()
+            third = self.load()
+
+        self.assertEqual(self.server.statuses, [200, 304, 304])
+        self.assertEqual(len(available_idps(first)), 3)
+        self.assertEqual(available_idps(first), available_idps(second))
+        self.assertEqual(available_idps(first), available_idps(third))
+
+    def test_signature_not_verified_again_when_unchanged(self):
+        with override_settings(SAML_METADATA_HTTP_CACHE_DIR=self.cache_dir):
+            self.load()
+            with mock.patch(
+                "djangosaml2.metadata.CachedMetaDataExtern.parse_and_check_signature"
+            ) as check_mock:
+                self.load()
+                # a new ETag, but the very same content
+                self.server.version = 2
+                self.load()
+
+        check_mock.assert_not_called()
+        self.assertEqual(self.server.statuses, [200, 304, 200])
+
+    def test_changed_metadata_downloaded_and_verified(self):
+        with override_settings(SAML_METADATA_HTTP_CACHE_DIR=self.cache_dir):
+            self.load()
+            self.set_metadata("remote_metadata_one_idp.xml", version=2)
+            with mock.patch(
+                "djangosaml2.metadata.CachedMetaDataExtern.parse_and_check_signature",
+                autospec=True,
+                side_effect=lambda md, txt: md.parse(txt) or True,
+            ) as check_mock:
+                config = self.load()
+
+        check_mock.assert_called_once()
+        self.assertEqual(self.server.statuses, [200, 200])
+        self.assertEqual(len(available_idps(config)), 1)
+
+    def test_signature_verified_again_when_cert_changes(self):
+        cert = os.path.join(self.cache_dir, "idp.pem")
+        shutil.copy(os.path.join(os.path.dirname(__file__), "mycert.pem"), cert)
+        self.saml_config["metadata"]["remote"][0]["cert"] = cert
+
+        with override_settings(SAML_METADATA_HTTP_CACHE_DIR=self.cache_dir):
+            with mock.patch(
+                "djangosaml2.metadata.CachedMetaDataExtern.parse_and_check_signature",
+                autospec=True,
+                side_effect=lambda md, txt: md.parse(txt) or True,
+            ) as check_mock:
+                self.load()
+                self.load()
+                self.assertEqual(check_mock.call_count, 1)
+
+                # rotated in place
+                with open(cert, "ab") as fp:
+                    fp.write(b"\n")
+                self.load()
+
+        self.assertEqual(check_mock.call_count, 2)
+        self.assertEqual(self.server.statuses, [200, 304, 304])
+
+    def test_no_http_cache_by_default(self):
+        self.load()
+        self.load()
+        self.assertEqual(self.server.statuses, [200, 200])
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+class IdPIndexTests(TestCase):
+    def load(self, metadata_file="remote_metadata_three_idps.xml"):
+        config = SPConfig()
+        config.load(
+            conf.create_conf(
+                sp_host="sp.example.com",
+                idp_hosts=["idp.example.com"],
+                metadata_file=metadata_file,
+            )
+        )
+        return config
+
+    def test_index_matches_metadata_store(self):
+        mds = self.load().metadata
+        index = idp_index(mds)
+
+        self.assertEqual(
+            sorted(index.entity_ids()),
+            sorted(mds.any("idpsso_descriptor", "single_sign_on_service")),
+        )
+        for entity_id in index.entity_ids():
+            entry = index.get(entity_id)
+            self.assertEqual(
+                entry["sso"],
+                mds.service(entity_id, "idpsso_descriptor", "single_sign_on_service"),
+            )
+        self.assertIsNone(index.get("https://unknown.org"))
+
+    def test_index_built_once_per_metadata_version(self):
+        config = self.load()
+        index = idp_index(config.metadata)
+        self.assertIs(idp_index(config.metadata), index)
+
+        config.setattr(
+            "", "metadata", self.load("remote_metadata_one_idp.xml").metadata
+        )
+        self.assertIsNot(idp_index(config.metadata), index)
+        self.assertEqual(len(idp_index(config.metadata).entity_ids()), 1)
+
+    def test_lookups_dont_scan_metadata(self):
+        config = self.load()
+        idp_index(config.metadata)
+        with (
+            mock.patch("saml2.mdstore.InMemoryMetaData.any") as any_mock,
+            mock.patch("saml2.mdstore.MetadataStore.service") as service_mock,
+        ):
+            idps = available_idps(config)
+            bindings = get_idp_sso_supported_bindings(
+                "https://idp2.example.com/simplesaml/saml2/idp/metadata.php",
+                config=config,
+            )
+
+        any_mock.assert_not_called()
+        service_mock.assert_not_called()
+        self.assertEqual(len(idps), 3)
+        self.assertEqual(bindings, [BINDING_HTTP_REDIRECT])
+
+    def test_display_names(self):
+        index = idp_index(self.load("remote_metadata_multilang.xml").metadata)
+        idp1 = "https://idp1.example.com/simplesaml/saml2/idp/metadata.php"
+        idp2 = "https://idp2.example.com/simplesaml/saml2/idp/metadata.php"
+
+        # the Organization names first, as pysaml2, then the mdui DisplayName
+        self.assertEqual(index.display_name(idp1, ["it"]), "Università Uno")
+        self.assertEqual(index.display_name(idp1, ["en"]), "University One Org")
+        self.assertEqual(index.display_name(idp1, ["de-CH"]), "Universität Eins")
+        self.assertEqual(index.display_name(idp1, ["fr", "it"]), "Università Uno")
+        self.assertIsNone(index.display_name(idp1, ["fr"]))
+        # the exact language wins over a regional variant
+        self.assertEqual(index.display_name(idp2, ["en"]), "University Two")
+        self.assertEqual(index.display_name(idp2, ["en-US"]), "University Two (US)")
+
+    def test_display_names_as_pysaml2(self):
+        for metadata_file in (
+            "remote_metadata_three_idps.xml",
+            "remote_metadata_multilang.xml",
+        ):
+            config = self.load(metadata_file)
+            for idp, name in available_idps(config).items():
+                self.assertEqual(name, config.metadata.name(idp, "en"))
+
+    def test_available_idps_languages(self):
+        config = self.load("remote_metadata_multilang.xml")
+        idp1 = "https://idp1.example.com/simplesaml/saml2/idp/metadata.php"
+
+        self.assertEqual(available_idps(config)[idp1], "University One Org")
+        self.assertEqual(available_idps(config, "it")[idp1], "Università Uno")
+        self.assertEqual(available_idps(config, ["fr"])[idp1], "University One Org")
+        self.assertIsNone(available_idps(config, "fr")[idp1])
+
+    def test_idplist_tag_uses_accept_language(self):
+        settings.SAML_CONFIG = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp1.example.com", "idp2.example.com"],
+            metadata_file="remote_metadata_multilang.xml",
+        )
+        request = RequestFactory().get("/", HTTP_ACCEPT_LANGUAGE="it")
+        template = Template(
+            "{% load idplist %}{% idplist as idps %}"
+            "{% for url, name in idps.items %}{{ name }};{% endfor %}"
+        )
+        rendered = template.render(RequestContext(request, {}))
+        self.assertIn("Università Uno;", rendered)
+
+    def test_unknown_idp_still_raises(self):
+        with self.assertRaises(UnknownSystemEntity):
+            get_idp_sso_supported_bindings("https://unknown.org", config=self.load())
+
+
+@override_settings(SAML_CONFIG_CACHE_ENABLED=True)
+class IdPListTagTests(TestCase):
+    def setUp(self):
+        settings.SAML_CONFIG = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp1.example.com", "idp2.example.com"],
+            metadata_file="remote_metadata_multilang.xml",
+        )
+        self.addCleanup(caches["default"].clear)
+
+    def render(self, options="", accept_language="en"):
+        request = RequestFactory().get("/", HTTP_ACCEPT_LANGUAGE=accept_language)
+        context = RequestContext(request, {})
+        Template("{% load idplist %}{% idplist as idps " + options + " %}").render(
+            context
+        )
+        return context["idps"]
+
+    def test_listing_copied(self):
+        listing = self.render()
+        self.assertEqual(
+            listing["https://idp1.example.com/simplesaml/saml2/idp/metadata.php"],
+            "University One Org",
+        )
+        listing.clear()
+        self.assertEqual(len(self.render()), 2)
+        # on a miss of the Django cache too
+        self.render("timeout=60").clear()
+        self.assertEqual(len(self.render()), 2)
+        self.assertEqual(
+            self.render(accept_language="it")[
+                "https://idp1.example.com/simplesaml/saml2/idp/metadata.php"
+            ],
+            "Università Uno",
+        )
+
+    def test_languages(self):
+        def languages(accept_language):
+            return _languages(
+                RequestFactory().get("/", HTTP_ACCEPT_LANGUAGE=accept_language)
+            )
+
+        with override_settings(LANGUAGES=[("en", "English"), ("it", "Italian")]):
+            self.assertEqual(languages("it-IT,xx;q=0.9,it;q=0.8"), ["it", "en"])
+            self.assertEqual(languages("x-made-up"), ["en"])
+        with override_settings(LANGUAGES=[("en-us", "English"), ("fr", "French")]):
+            self.assertEqual(languages("en-US,fr-CA"), ["en-us", "fr", "en"])
+        self.assertEqual(len(languages("en,fr,de,it,es")), MAX_LANGUAGES + 1)
+
+    @override_settings(ALLOWED_HOSTS=["*"])
+    def test_timeout_per_config(self):
+        tenants = {}
+
+        def tenant_config_loader(request):
+            config = SPConfig()
+            config.load(
+                conf.create_conf(
+                    sp_host=request.get_host(),
+                    idp_hosts=["idp.example.com"],
+                    metadata_file=tenants[request.get_host()],
+                )
+            )
+            return config
+
+        tenant_config_loader.do_not_call_in_templates = True
+        tenants["one.example.com"] = "remote_metadata_one_idp.xml"
+        tenants["three.example.com"] = "remote_metadata_three_idps.xml"
+        template = Template(
+            "{% load idplist %}"
+            "{% idplist as idps timeout=60 config_loader=loader %}"
+            "{{ idps|length }}"
+        )
+        for host, count in (("one.example.com", "1"), ("three.example.com", "3")):
+            request = RequestFactory().get("/", HTTP_HOST=host)
+            context = RequestContext(request, {"loader": tenant_config_loader})
+            self.assertEqual(template.render(context), count)
+
+    def test_timeout(self):
+        listing = self.render("timeout=60")
+        with mock.patch(
+            "djangosaml2.templatetags.idplist.get_config", return_value=get_config()
+        ) as config_mock:
+            self.assertEqual(self.render("timeout=60"), listing)
+            self.render("timeout=60", accept_language="it")
+
+        # only the new language needed the config
+        self.assertEqual(config_mock.call_count, 1)
+
+    def test_config_loader(self):
+        with mock.patch(
+            "djangosaml2.templatetags.idplist.get_config",
+            return_value=get_config(),
+        ) as config_mock:
+            self.render('config_loader="djangosaml2.conf.config_settings_loader"')
+        self.assertEqual(
+            config_mock.call_args[0][0], "djangosaml2.conf.config_settings_loader"
+        )
+
+    def test_invalid_options(self):
+        for options in ("", "idps wrong=1", "idps timeout=1 extra"):
+            with self.assertRaises(TemplateSyntaxError):
+                Template("{% load idplist %}{% idplist as " + options + " %}")
+        with self.assertRaises(TemplateSyntaxError):
+            Template("{% load idplist %}{% idplist on idps %}")
+
+
+class MDQEntityCacheTests(TestCase):
+    entity_id = "https://idp.example.com/simplesaml/saml2/idp/metadata.php"
+
+    def setUp(self):
+        mdq_entity_cache.clear()
+        self.addCleanup(mdq_entity_cache.clear)
+        self.addCleanup(caches["default"].clear)
+        with open(
+            os.path.join(os.path.dirname(__file__), "remote_metadata_one_idp.xml"),
+            "rb",
+        ) as fp:
+            self.metadata = fp.read()
+
+    def load(self):
+        saml_config = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+        )
+        saml_config["metadata"] = {"mdq": [{"url": "https://mdq.example.com"}]}
+        config = SPConfig()
+        config.load(saml_config)
+        return config
+
+    def mock_mdq(self, status_code=200):
+        response = mock.Mock(status_code=status_code, content=self.metadata)
+        return mock.patch("saml2.mdstore.requests.get", return_value=response)
+
+    def test_positive_entry_cached(self):
+        config = self.load()
+        with self.mock_mdq() as get_mock:
+            first = available_idps(config, idp_to_check=self.entity_id)
+            second = available_idps(config, idp_to_check=self.entity_id)
+
+        self.assertEqual(get_mock.call_count, 1)
+        self.assertEqual(list(first), [self.entity_id])
+        self.assertEqual(first, second)
+        self.assertEqual(mdq_entity_cache.stats()["hits"], 1)
+
+    def test_positive_entry_shared_across_processes(self):
+        with self.mock_mdq() as get_mock:
+            available_idps(self.load(), idp_to_check=self.entity_id)
+            # what another process would see: an empty in-process cache
+            mdq_entity_cache._entries.clear()
+            idps = available_idps(self.load(), idp_to_check=self.entity_id)
+
+        self.assertEqual(get_mock.call_count, 1)
+        self.assertEqual(list(idps), [self.entity_id])
+
+    def test_positive_entry_honours_cache_duration(self):
+        mdx = self.load().metadata.metadata["https://mdq.example.com"]
+        now = time.time()
+        self.assertEqual(
+            mdq_entity_cache._positive_expiry(mdx, {"cache_duration": "PT5M"}, now),
+            int(now) + 300,
+        )
+        # the freshness_period of the source, PT12H by default, otherwise
+        self.assertEqual(
+            mdq_entity_cache._positive_expiry(mdx, {}, now), int(now) + 12 * 3600
+        )
+
+    def test_negative_entry_cached(self):
+        config = self.load()
+        with self.mock_mdq(status_code=404) as get_mock:
+            for _ in range(3):
+                with self.assertRaises(KeyError):
+                    available_idps(config, idp_to_check="https://unknown.org")
+        self.assertEqual(get_mock.call_count, 1)
+
+    def test_concurrent_misses_fetched_once(self):
+        config = self.load()
+        release = threading.Event()
+        response = mock.Mock(status_code=200, content=self.metadata)
+
+        def get(*args, **kwargs):
+            release.wait(5)
+            return response
+
+        with mock.patch("saml2.mdstore.requests.get", side_effect=get) as get_mock:
+            threads = [
+                threading.Thread(
+                    target=available_idps,
+                    args=(config,),
+                    kwargs={"idp_to_check": self.entity_id},
+                )
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            deadline = time.monotonic() + 5
+            while (
+                mdq_entity_cache.stats()["coalesced"] < 4
+                and time.monotonic() < deadline
+            ):
+                time.sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(get_mock.call_count, 1)
+        self.assertEqual(mdq_entity_cache.stats()["coalesced"], 4)
+
+    def test_failures_not_cached(self):
+        config = self.load()
+        # a server error or an invalid signature
+        for status_code in (503, 200):
+            with self.subTest(status_code), self.mock_mdq(status_code) as get_mock:
+                with mock.patch(
+                    "saml2.mdstore.MetaDataMDX.parse_and_check_signature",
+                    return_value=False,
+                ):
+                    for _ in range(2):
+                        with self.assertRaises(KeyError):
+                            available_idps(config, idp_to_check=self.entity_id)
+                self.assertEqual(get_mock.call_count, 2)
+
+        with self.mock_mdq():
+            self.assertEqual(
+                list(available_idps(config, idp_to_check=self.entity_id)),
+                [self.entity_id],
+            )
+
+    def test_login_unknown_idp(self):
+        saml_config = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+        )
+        saml_config["metadata"] = {"mdq": [{"url": "https://mdq.example.com"}]}
+        with override_settings(SAML_CONFIG=saml_config), self.mock_mdq(404):
+            response = self.client.get(
+                reverse("saml2_login"), {"idp": "https://unknown.org"}
+            )
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(SAML_MDQ_NEGATIVE_TTL=0)
+    def test_negative_entry_expires(self):
+        config = self.load()
+        with self.mock_mdq(status_code=404) as get_mock:
+            for _ in range(2):
+                with self.assertRaises(KeyError):
+                    available_idps(config, idp_to_check="https://unknown.org")
+        self.assertEqual(get_mock.call_count, 2)
+
+    @override_settings(SAML_MDQ_CACHE_ALIAS=None, SAML_MDQ_CACHE_MAX_ENTRIES=2)
+    def test_entries_capped(self):
+        config = self.load()
+        mdx = config.metadata.metadata["https://mdq.example.com"]
+        with self.mock_mdq(status_code=404):
+            for i in range(5):
+                with self.assertRaises(KeyError):
+                    available_idps(config, idp_to_check=f"https://unknown{i}.org")
+        with self.mock_mdq():
+            available_idps(config, idp_to_check=self.entity_id)
+
+        self.assertEqual(mdq_entity_cache.stats()["entries"], 2)
+        self.assertEqual(list(mdx.entity), [self.entity_id])
+
+
+@override_settings(SAML_CONFIG_CACHE_ENABLED=True)
+class MetadataRefresherTests(TestCase):
+    def setUp(self):
+        sp_config_cache.clear()
+        self.addCleanup(sp_config_cache.clear)
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.metadata_file = os.path.join(self.workdir, "metadata.xml")
+        self.use_metadata("remote_metadata_one_idp.xml")
+        self.saml_config = conf.create_conf(
+            sp_host="sp.example.com",
+            idp_hosts=["idp.example.com"],
+        )
+        self.saml_config["metadata"] = {"local": [self.metadata_file]}
+
+    def use_metadata(self, name, valid_until=None):
+        with open(os.path.join(os.path.dirname(__file__), name)) as fp:
+            content = fp.read()
+        if valid_until:
+            content = content.replace(
+                "<md:EntitiesDescriptor ",
+                f'<md:EntitiesDescriptor validUntil="{valid_until}" ',
+            )
+        with open(self.metadata_file, "w") as fp:
+            fp.write(content)
+
+    def test_refresh_swaps_metadata(self):
+        refresher = MetadataRefresher(sp_config_cache)
+        with override_settings(SAML_CONFIG=self.saml_config):
+            config = config_settings_loader()
+            self.assertEqual(len(available_idps(config)), 1)
+
+            self.use_metadata("remote_metadata_three_idps.xml")
+            refresher.refresh()
+
+            self.assertIs(config_settings_loader(), config)
+            self.assertEqual(len(available_idps(config)), 3)
+        self.assertEqual(refresher.refreshes, 1)
+
+    @override_settings(SAML_METADATA_STALE_WINDOW=60)
+    def test_refresh_failure_keeps_last_good_copy(self):
+        refresher = MetadataRefresher(sp_config_cache)
+        with override_settings(SAML_CONFIG=self.saml_config):
+            config = config_settings_loader()
+            metadata = config.metadata
+
+            os.remove(self.metadata_file)
+            refresher.refresh()
+            self.assertIs(config.metadata, metadata)
+            self.assertIs(sp_config_cache.current()[0], config)
+
+            # once the stale window is over the config is dropped
+            with mock.patch(
+                "djangosaml2.metadata.time.monotonic",
+                return_value=time.monotonic() + 61,
+            ):
+                refresher.refresh()
+            self.assertIsNone(sp_config_cache.current()[0])
+        self.assertEqual(refresher.failures, 2)
+
+    @override_settings(SAML_METADATA_REFRESH_INTERVAL=3600)
+    def test_refresh_honours_valid_until(self):
+        self.use_metadata(
+            "remote_metadata_one_idp.xml",
+            valid_until=time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 600)
+            ),
+        )
+        refresher = MetadataRefresher(sp_config_cache)
+        with override_settings(SAML_CONFIG=self.saml_config):
+            config = config_settings_loader()
+
+        self.assertLessEqual(refresher.next_delay(config.metadata), 600)
+        self.assertGreater(refresher.next_delay(config.metadata), 500)
+
+    def test_refresher_thread(self):
+        refresher = MetadataRefresher(sp_config_cache)
+        with mock.patch.object(refresher, "refresh", return_value=3600):
+            refresher.ensure_running()
+            thread = refresher._thread
+            refresher.ensure_running()
+            self.assertIs(refresher._thread, thread)
+            self.assertTrue(thread.is_alive())
+            refresher.stop()
+        self.assertFalse(thread.is_alive())
+
+
+class PrefilterTests(TestCase):
+    def test_decode_saml_response(self):
+        self.assertEqual(decode_saml_response("PFJlc3BvbnNlLz4=\n", 20), b"<Response/>")
+        with self.assertRaisesMessage(SAMLResponseRejected, "larger than 8"):
+            decode_saml_response("PFJlc3BvbnNlLz4=", 8)
+        with self.assertRaisesMessage(SAMLResponseRejected, "not valid base64"):
+            decode_saml_response("PFJlc3BvbnNlLz4", None)
+        with self.assertRaisesMessage(SAMLResponseRejected, "not valid base64"):
+            decode_saml_response("PFJlc3BvbnNlLz4=é", None)
+
+    def test_peek_response(self):
+        head = (
+            '<samlp:Response xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+            'xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" InResponseTo="id-1">'
+        )
+        self.assertEqual(
+            peek_response(
+                f"{head}<saml:Issuer> https://idp </saml:Issuer>".encode()
+                + b"<unclosed>" * 10000
+            ),
+            ("https://idp", "id-1"),
+        )
+        # the Issuer of a Response is optional
+        self.assertEqual(
+            peek_response(f"{head}<samlp:Status/></samlp:Response>".encode()),
+            (None, "id-1"),
+        )
+
+        rejected = {
+            b"<Response/>": "Not a SAML Response",
+            f"{head}<saml:Issuer>".encode(): "No Response header",
+            f"{head}<saml:Issuer>{'x' * 20000}".encode(): "No Response header",
+            b'<!DOCTYPE r [<!ENTITY e "e">]>' + head.encode(): "DTDs",
+            (
+                '<?xml version="1.0" encoding="UTF-16"?><!DOCTYPE r [<!ENTITY e "e">]>'
+                + head
+            ).encode("utf-16"): "DTDs",
+            f"{head}<<".encode(): "not well-formed",
+        }
+        for xml, message in rejected.items():
+            with (
+                self.subTest(message),
+                self.assertRaisesMessage(SAMLResponseRejected, message),
+            ):
+                peek_response(xml)
+
+
+class MetricsRegistryTests(TestCase):
+    def test_exposition(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("test_requests_total", "Requests.", ("path",))
+        counter.inc(path="/a")
+        counter.inc(2, path='/"b"\n')
+        self.assertIs(registry.counter("test_requests_total", "Requests."), counter)
+        with self.assertRaises(ValueError):
+            counter.inc(method="GET")
+        with self.assertRaises(ValueError):
+            registry.histogram("test_requests_total", "Requests.")
+
+        histogram = registry.histogram(
+            "test_duration_seconds", "Duration.", buckets=(0.1, 1.0)
+        )
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        registry.register_collector(lambda: [("test_entries", "gauge", "Entries.", 3)])
+
+        self.assertEqual(
+            registry.expose(),
+            "# HELP test_duration_seconds Duration.\n"
+            "# TYPE test_duration_seconds histogram\n"
+            'test_duration_seconds_bucket{le="0.1"} 2\n'
+            'test_duration_seconds_bucket{le="1.0"} 3\n'
+            'test_duration_seconds_bucket{le="+Inf"} 4\n'
+            "test_duration_seconds_sum 3.65\n"
+            "test_duration_seconds_count 4\n"
+            "# HELP test_requests_total Requests.\n"
+            "# TYPE test_requests_total counter\n"
+            'test_requests_total{path="/a"} 1\n'
+            'test_requests_total{path="/\\"b\\"\\n"} 2\n'
+            "# HELP test_entries Entries.\n"
+            "# TYPE test_entries gauge\n"
+            "test_entries 3\n",
+        )
+
+        registry.clear()
+        self.assertEqual(counter.value(path="/a"), 0)
+        self.assertEqual(histogram.count(), 0)
+
+
 class SessionEnabledTestCase(TestCase):
     def get_session(self):
         engine = import_module(settings.SESSION_ENGINE)
@@ -1069,3 +2909,34 @@ class MiddlewareTests(SessionEnabledTestCase):
             cookie = response.cookies[saml_session_name]
 
             self.assertEqual(cookie["samesite"], "Lax")
+
+    async def test_middleware_async(self):
+        async def get_response(request):
+            request.saml_session["_saml2_subject_id"] = "subject"
+            return http.HttpResponse()
+
+        middleware = SamlSessionMiddleware(get_response)
+        request = RequestFactory().get("/login/")
+        with mock.patch("djangosaml2.middleware.sync_to_async") as sync_to_async:
+            response = await middleware(request)
+        # the session is saved without leaving the event loop
+        sync_to_async.assert_not_called()
+
+        saml_session_name = getattr(
+            settings, "SAML_SESSION_COOKIE_NAME", "saml_session"
+        )
+        session_key = response.cookies[saml_session_name].value
+        engine = import_module(settings.SESSION_ENGINE)
+        session = engine.SessionStore(session_key)
+        self.assertEqual(await session.aget("_saml2_subject_id"), "subject")
+
+        # an emptied session is deleted
+        async def flush_session(request):
+            await request.saml_session.aflush()
+            return http.HttpResponse()
+
+        request = RequestFactory().get("/login/")
+        request.COOKIES[saml_session_name] = session_key
+        response = await SamlSessionMiddleware(flush_session)(request)
+        self.assertEqual(response.cookies[saml_session_name].value, "")
+        self.assertFalse(await session.aexists(session_key))
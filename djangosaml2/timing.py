@@ -0,0 +1,173 @@
+import inspect
+import logging
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import wraps
+
+from django.utils.module_loading import import_string
+
+from .signals import phases_timed
+from .utils import get_custom_setting
+
+logger = logging.getLogger("djangosaml2")
+
+_current_timer = ContextVar("djangosaml2_timer", default=None)
+_untimed = nullcontext()
+
+
+class PhaseTimer:
+    """The durations, in seconds, of the named phases of a request. The time
+    spent in a phase entered more than once adds up, phases may be nested.
+    """
+
+    def __init__(self, view: str):
+        self.view = view
+        self.phases = {}
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def timings(self) -> dict:
+        return {**self.phases, "total": time.perf_counter() - self.started}
+
+
+def phase(name: str):
+    """Time the block as the phase name of the request being timed, if any."""
+    timer = _current_timer.get()
+    if timer is None:
+        return _untimed
+    return timer.phase(name)
+
+
+def get_timing_sinks() -> list:
+    """Return the callables of SAML_TIMING_SINKS, given as such or by their
+    dotted path, and server_timing if SAML_SERVER_TIMING is set. Timing is
+    disabled without any.
+    """
+    sinks = [
+        import_string(sink) if isinstance(sink, str) else sink
+        for sink in get_custom_setting("SAML_TIMING_SINKS", None) or ()
+    ]
+    if get_custom_setting("SAML_SERVER_TIMING", False):
+        sinks.append(server_timing)
+    return sinks
+
+
+def timing_enabled() -> bool:
+    return bool(
+        get_custom_setting("SAML_TIMING_SINKS", None)
+        or get_custom_setting("SAML_SERVER_TIMING", False)
+    )
+
+
+def _report(timer, sinks, request, response):
+    timings = timer.timings()
+    for sink in sinks:
+        try:
+            sink(timer.view, timings, request=request, response=response)
+        except Exception:
+            logger.exception("SAML timing sink %r failed", sink)
+
+
+def timed(view: str):
+    """Decorate a view method to time the phases of its requests, when there
+    are timing sinks, and hand them over to the sinks as
+    sink(view, timings, request=request, response=response).
+    """
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapper(self, request, *args, **kwargs):
+                sinks = get_timing_sinks()
+                if not sinks:
+                    return await func(self, request, *args, **kwargs)
+                timer = PhaseTimer(view)
+                token = _current_timer.set(timer)
+                try:
+                    response = await func(self, request, *args, **kwargs)
+                finally:
+                    _current_timer.reset(token)
+                _report(timer, sinks, request, response)
+                return response
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(self, request, *args, **kwargs):
+            sinks = get_timing_sinks()
+            if not sinks:
+                return func(self, request, *args, **kwargs)
+            timer = PhaseTimer(view)
+            token = _current_timer.set(timer)
+            try:
+                response = func(self, request, *args, **kwargs)
+            finally:
+                _current_timer.reset(token)
+            _report(timer, sinks, request, response)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def log_timings(view: str, timings: dict, **kwargs):
+    """Timing sink logging the timings of each request."""
+    logger.info(
+        "SAML %s timings: %s",
+        view,
+        " ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in timings.items()),
+    )
+
+
+def send_timings(view: str, timings: dict, request=None, response=None, **kwargs):
+    """Timing sink sending the phases_timed signal, with the view as sender."""
+    phases_timed.send(sender=view, timings=timings, request=request, response=response)
+
+
+def server_timing(view: str, timings: dict, response=None, **kwargs):
+    """Timing sink adding the timings to the Server-Timing header of the
+    response, in milliseconds.
+    """
+    if response is None:
+        return
+    metrics = ", ".join(
+        f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()
+    )
+    if response.has_header("Server-Timing"):
+        metrics = f"{response['Server-Timing']}, {metrics}"
+    response["Server-Timing"] = metrics
+
+
+class TimedCryptoBackend:
+    """Wraps a pysaml2 CryptoBackend to time what it does as the crypto phase
+    of the request being timed.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def sign_statement(self, *args, **kwargs):
+        with phase("crypto"):
+            return self.backend.sign_statement(*args, **kwargs)
+
+    def validate_signature(self, *args, **kwargs):
+        with phase("crypto"):
+            return self.backend.validate_signature(*args, **kwargs)
+
+    def decrypt(self, *args, **kwargs):
+        with phase("crypto"):
+            return self.backend.decrypt(*args, **kwargs)
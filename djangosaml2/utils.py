@@ -27,11 +27,14 @@ from django.shortcuts import resolve_url
 from django.urls import NoReverseMatch
 from django.utils.http import url_has_allowed_host_and_scheme
 from django.utils.module_loading import import_string
+from django.utils.translation.trans_real import parse_accept_lang_header
 
 from saml2.config import SPConfig
-from saml2.mdstore import MetaDataMDX
+from saml2.mdstore import MetadataStore, MetaDataMDX
 from saml2.s_utils import UnknownSystemEntity
 
+from .metadata import idp_index, mdq_entity_cache
+
 logger = logging.getLogger(__name__)
 
 
@@ -39,21 +42,27 @@ def get_custom_setting(name: str, default=None):
     return getattr(settings, name, default)
 
 
+def get_language_preferences(request) -> list:
+    """Return the languages accepted by the client, most preferred first."""
+    header = request.META.get("HTTP_ACCEPT_LANGUAGE", "") if request else ""
+    return [lang for lang, _q in parse_accept_lang_header(header) if lang != "*"]
+
+
 def available_idps(config: SPConfig, langpref=None, idp_to_check: str = None) -> dict:
+    """Return the IdPs found in the metadata, mapped to their display name.
+    langpref is a language, or a list of languages by preference, English
+    being the last resort.
+    """
     if langpref is None:
         langpref = "en"
-
-    idps = set()
+    langprefs = [langpref] if isinstance(langpref, str) else [*langpref, "en"]
 
     for metadata in config.metadata.metadata.values():
         # initiate a fetch to the selected idp when using MDQ, otherwise the MetaDataMDX is an empty database
         if isinstance(metadata, MetaDataMDX) and idp_to_check:
-            m = metadata[idp_to_check]  # noqa: F841
-        result = metadata.any("idpsso_descriptor", "single_sign_on_service")
-        if result:
-            idps.update(result.keys())
+            mdq_entity_cache.lookup(metadata, idp_to_check)
 
-    return {idp: config.metadata.name(idp, langpref) for idp in idps}
+    return dict(idp_index(config.metadata).listing(langprefs))
 
 
 def get_idp_sso_supported_bindings(
@@ -74,6 +83,10 @@ def get_idp_sso_supported_bindings(
             idp_entity_id = list(available_idps(config).keys())[0]
         except IndexError:
             raise ImproperlyConfigured("No IdP configured!")
+    if isinstance(meta, MetadataStore):
+        entry = idp_index(meta).get(idp_entity_id)
+        if entry is not None:
+            return list(entry["sso"])
     try:
         return list(
             meta.service(
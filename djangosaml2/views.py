@@ -14,7 +14,9 @@
 # limitations under the License.
 
 import base64
+import inspect
 import logging
+import time
 from functools import wraps
 from typing import Optional
 from urllib.parse import quote
@@ -22,6 +24,7 @@ from urllib.parse import quote
 from django.conf import settings
 from django.core.exceptions import PermissionDenied, SuspiciousOperation
 from django.http import (
+    Http404,
     HttpRequest,
     HttpResponse,
     HttpResponseBadRequest,
@@ -42,6 +45,8 @@ from django.contrib import auth
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.sites.shortcuts import get_current_site
 
+from asgiref.sync import sync_to_async
+
 import saml2
 from saml2.client_base import LogoutError
 from saml2.config import SPConfig
@@ -63,10 +68,23 @@ from saml2.samlp import AuthnRequest, IDPEntry, IDPList, Scoping
 from saml2.sigver import MissingKey
 from saml2.validate import ResponseLifetimeExceed, ToEarly
 
-from .cache import IdentityCache, OutstandingQueriesCache, StateCache
-from .conf import get_config
-from .exceptions import IdPConfigurationMissing
+from . import metrics
+from .cache import (
+    IdentityCache,
+    OutstandingQueriesCache,
+    StateCache,
+    get_assertion_replay_cache,
+)
+from .conf import get_config, sp_config_cache
+from .exceptions import (
+    ACSPoolUnavailable,
+    IdPConfigurationMissing,
+    SAMLResponseRejected,
+)
 from .overrides import Saml2Client
+from .pool import get_acs_pool
+from .prefilter import prefilter_saml_response
+from .timing import phase, timed
 from .utils import (
     add_idp_hinting,
     available_idps,
@@ -74,6 +92,7 @@ from .utils import (
     get_custom_setting,
     get_fallback_login_redirect_url,
     get_idp_sso_supported_bindings,
+    get_language_preferences,
     get_location,
     validate_referral_url,
 )
@@ -86,7 +105,17 @@ def saml2_csp_update(view):
 
     @wraps(view)
     def wrapper(*args, **kwargs):
-        return csp_handler(view)(*args, **kwargs)
+        response = view(*args, **kwargs)
+        if not inspect.isawaitable(response):
+            return csp_handler(lambda *args, **kwargs: response)(*args, **kwargs)
+
+        # the dispatch of async views returns a coroutine, the CSP decorators
+        # expect the response itself
+        async def async_wrapper():
+            resolved = await response
+            return csp_handler(lambda *args, **kwargs: resolved)(*args, **kwargs)
+
+        return async_wrapper()
 
     return wrapper
 
@@ -102,6 +131,22 @@ def _get_subject_id(session):
         return None
 
 
+async def _aload_session(session):
+    """Load a session from its store without blocking the event loop, its sync
+    accessors used by the pysaml2 caches then don't hit the store anymore.
+    """
+    await session.akeys()
+
+
+async def _aload_user(request):
+    """Resolve request.user without blocking the event loop."""
+    request.user = await request.auser()
+
+
+def _overrides(obj, base, name: str) -> bool:
+    return getattr(type(obj), name) is not getattr(base, name)
+
+
 def _get_next_path(request: HttpRequest) -> Optional[str]:
     if "next" in request.GET:
         next_path = request.GET["next"]
@@ -124,12 +169,37 @@ class SPConfigMixin:
         return self.config_loader_path
 
     def get_sp_config(self, request: HttpRequest) -> SPConfig:
-        return get_config(self.get_config_loader_path(request), request)
+        with phase("config"):
+            return get_config(self.get_config_loader_path(request), request)
 
-    def get_state_client(self, request: HttpRequest):
-        conf = self.get_sp_config(request)
+    async def aget_sp_config(self, request: HttpRequest) -> SPConfig:
+        """The config is served from memory by the default config loader
+        once SAML_CONFIG_CACHE_ENABLED has cached it. Otherwise, loading it
+        may parse metadata or do I/O, hence it's done in a thread.
+        """
+        if (
+            not self.get_config_loader_path(request)
+            and not get_custom_setting("SAML_CONFIG_LOADER", None)
+            and get_custom_setting("SAML_CONFIG_CACHE_ENABLED", False)
+            and sp_config_cache.holds(settings.SAML_CONFIG)
+        ):
+            return self.get_sp_config(request)
+        return await sync_to_async(self.get_sp_config)(request)
+
+    async def aget_client(self, conf: SPConfig, **kwargs) -> Saml2Client:
+        """Saml2Client.from_config(), run in a thread when the client has to
+        be built, which loads the keys.
+        """
+        if Saml2Client.has_shared_client(conf):
+            return Saml2Client.from_config(conf, **kwargs)
+        return await sync_to_async(Saml2Client.from_config, thread_sensitive=False)(
+            conf, **kwargs
+        )
+
+    def get_state_client(self, request: HttpRequest, conf: Optional[SPConfig] = None):
+        conf = conf or self.get_sp_config(request)
         state = StateCache(request.saml_session)
-        client = Saml2Client(
+        client = Saml2Client.from_config(
             conf, state_cache=state, identity_cache=IdentityCache(request.saml_session)
         )
         return state, client
@@ -196,6 +266,7 @@ class LoginView(SPConfigMixin, View):
         #    an authorization error in the first place.
         return request.user.is_authenticated
 
+    @timed("login")
     def get(self, request, *args, **kwargs):
         logger.debug("Login process started")
         next_path = _get_next_path(request)
@@ -225,7 +296,10 @@ class LoginView(SPConfigMixin, View):
             return self.unknown_idp(request, idp="unknown")
 
         # is a embedded wayf or DiscoveryService needed?
-        configured_idps = available_idps(conf)
+        with phase("metadata"):
+            configured_idps = available_idps(
+                conf, langpref=get_language_preferences(request)
+            )
         selected_idp = request.GET.get("idp", None)
 
         self.conf = conf
@@ -255,18 +329,24 @@ class LoginView(SPConfigMixin, View):
 
             elif len(configured_idps) > 1:
                 logger.debug("A discovery process trough WAYF page is needed")
-                return render(
-                    request,
-                    self.wayf_template,
-                    {
-                        "available_idps": configured_idps.items(),
-                        "came_from": next_path,
-                    },
-                )
+                with phase("render"):
+                    return render(
+                        request,
+                        self.wayf_template,
+                        {
+                            "available_idps": configured_idps.items(),
+                            "came_from": next_path,
+                        },
+                    )
 
         # when using MDQ and DS we need to initiate a check on the selected idp,
         # otherwise the available idps will be empty
-        configured_idps = available_idps(conf, idp_to_check=selected_idp)
+        try:
+            with phase("metadata"):
+                configured_idps = available_idps(conf, idp_to_check=selected_idp)
+        except KeyError:
+            # unknown to the MDQ server, or not fetched
+            return self.unknown_idp(request, selected_idp)
 
         # is the first one, otherwise next logger message will print None
         if not configured_idps:  # pragma: no cover
@@ -310,7 +390,7 @@ class LoginView(SPConfigMixin, View):
                     f"{saml2.BINDING_HTTP_POST} or {saml2.BINDING_HTTP_REDIRECT}"
                 )
 
-        client = Saml2Client(conf)
+        client = Saml2Client.from_config(conf)
 
         # SSO options
         sign_requests = getattr(conf, "_sp_authn_requests_signed", False)
@@ -375,17 +455,18 @@ class LoginView(SPConfigMixin, View):
                         "utf-8"
                     )
 
-                    http_response = render(
-                        request,
-                        self.post_binding_form_template,
-                        {
-                            "target_url": location,
-                            "params": {
-                                "SAMLRequest": saml_request,
-                                "RelayState": next_path,
+                    with phase("render"):
+                        http_response = render(
+                            request,
+                            self.post_binding_form_template,
+                            {
+                                "target_url": location,
+                                "params": {
+                                    "SAMLRequest": saml_request,
+                                    "RelayState": next_path,
+                                },
                             },
-                        },
-                    )
+                        )
                 except TemplateDoesNotExist as e:
                     logger.debug(
                         f"TemplateDoesNotExist: [{self.post_binding_form_template}] - {e}",
@@ -410,6 +491,7 @@ class LoginView(SPConfigMixin, View):
         else:
             raise UnsupportedBinding(f"Unsupported binding: {binding}")
 
+        metrics.logins_started.inc(idp=selected_idp)
         # success, so save the session ID and return our response
         oq_cache = OutstandingQueriesCache(request.saml_session)
         oq_cache.set(session_id, next_path)
@@ -456,8 +538,24 @@ class AssertionConsumerServiceView(SPConfigMixin, View):
             status=status,
         )
 
+    def _acs_failure(self, request, exception=None, status=403, **kwargs):
+        reason = type(exception).__name__ if exception is not None else "unknown"
+        metrics.acs_failures.inc(reason=reason)
+        with phase("render"):
+            return self.handle_acs_failure(
+                request, exception=exception, status=status, **kwargs
+            )
+
+    @staticmethod
+    def _count_login(session_info: dict, started: float):
+        idp = session_info["issuer"]
+        metrics.acs_successes.inc(idp=idp)
+        metrics.acs_duration.observe(time.perf_counter() - started, idp=idp)
+
+    @timed("acs")
     def post(self, request, attribute_mapping=None, create_unknown_user=None):
         """SAML Authorization Response endpoint"""
+        started = time.perf_counter()
 
         if "SAMLResponse" not in request.POST:
             logger.warning('Missing "SAMLResponse" parameter in POST data.')
@@ -474,18 +572,88 @@ class AssertionConsumerServiceView(SPConfigMixin, View):
         conf = self.get_sp_config(request)
 
         identity_cache = IdentityCache(request.saml_session)
-        client = Saml2Client(conf, identity_cache=identity_cache)
+        client = Saml2Client.from_config(conf, identity_cache=identity_cache)
         oq_cache = OutstandingQueriesCache(request.saml_session)
         oq_cache.sync()
         outstanding_queries = oq_cache.outstanding_queries()
 
-        _exception = None
+        failure = self.prefilter_response(request, conf, outstanding_queries)
+        if failure is not None:
+            return failure
+        response, failure = self.verify_response(request, client, outstanding_queries)
+        if failure is not None:
+            return failure
+
+        session_id = response.session_id()
+        oq_cache.delete(session_id)
+
+        # authenticate the remote user
+        session_info = response.session_info()
+        assertion_info = self.get_assertion_info(response)
+        if self.is_replayed(conf, session_info, assertion_info):
+            return self.handle_replayed_assertion(request, session_info, assertion_info)
+
+        if callable(attribute_mapping):
+            attribute_mapping = attribute_mapping()
+        if callable(create_unknown_user):
+            create_unknown_user = create_unknown_user()
+
         try:
-            response = client.parse_authn_request_response(
-                request.POST["SAMLResponse"],
-                saml2.BINDING_HTTP_POST,
-                outstanding_queries,
+            user = self.authenticate_user(
+                request,
+                session_info,
+                attribute_mapping,
+                create_unknown_user,
+                assertion_info,
+            )
+        except PermissionDenied as e:
+            return self._acs_failure(
+                request,
+                exception=e,
+                session_info=session_info,
             )
+
+        self._count_login(session_info, started)
+        return self.login_redirect(request, user, session_info)
+
+    def prefilter_response(self, request, conf, outstanding_queries):
+        """Cheaply reject a SAML response that can't be valid before it's
+        verified, if SAML_ACS_PREFILTER is set. Return None, or the failure
+        response to send back.
+
+        The size of the SAMLResponse is capped by SAML_ACS_MAX_RESPONSE_SIZE,
+        in characters of base64.
+        """
+        if not get_custom_setting("SAML_ACS_PREFILTER", False):
+            return None
+        try:
+            with phase("prefilter"):
+                prefilter_saml_response(
+                    request.POST["SAMLResponse"],
+                    conf,
+                    outstanding_queries,
+                    max_size=get_custom_setting("SAML_ACS_MAX_RESPONSE_SIZE", 524288),
+                )
+        except SAMLResponseRejected as e:
+            logger.warning("SAMLResponse rejected before verification: %s", e)
+            return self._acs_failure(request, exception=e, status=400)
+        except UnsolicitedResponse as e:
+            logger.warning("SAMLResponse rejected before verification: %s", e)
+            return self._acs_failure(request, exception=e)
+        return None
+
+    def verify_response(self, request, client, outstanding_queries):
+        """Parse and validate the SAML response.
+
+        Return the response and None, or the failure response to send back.
+        """
+        response = _exception = None
+        _status = 403
+        try:
+            response = self.parse_authn_response(request, client, outstanding_queries)
+        except ACSPoolUnavailable as e:
+            _exception, _status = e, 503
+            logger.warning("SAML Assertion not verified: %s", e)
         except (StatusError, ToEarly) as e:
             _exception = e
             logger.exception("Error processing SAML Assertion.")
@@ -526,10 +694,12 @@ class AssertionConsumerServiceView(SPConfigMixin, View):
             logger.exception("SAMLResponse Error")
 
         if _exception:
-            return self.handle_acs_failure(request, exception=_exception)
+            return response, self._acs_failure(
+                request, exception=_exception, status=_status
+            )
         elif response is None:
             logger.warning("Invalid SAML Assertion received (unknown error).")
-            return self.handle_acs_failure(
+            return response, self._acs_failure(
                 request,
                 status=400,
                 exception=SuspiciousOperation("Unknown SAML2 error"),
@@ -539,19 +709,17 @@ class AssertionConsumerServiceView(SPConfigMixin, View):
             self.custom_validation(response)
         except Exception as e:
             logger.warning(f"SAML Response validation error: {e}", exc_info=True)
-            return self.handle_acs_failure(
+            return response, self._acs_failure(
                 request,
                 status=400,
                 exception=SuspiciousOperation("SAML2 validation error"),
             )
 
-        session_id = response.session_id()
-        oq_cache.delete(session_id)
-
-        # authenticate the remote user
-        session_info = response.session_info()
+        return response, None
 
-        # assertion_info
+    @staticmethod
+    def get_assertion_info(response) -> dict:
+        """Return the ID and the expiry of the bearer assertion."""
         assertion = response.assertion
         assertion_info = {}
         for sc in assertion.subject.subject_confirmation:
@@ -562,27 +730,52 @@ class AssertionConsumerServiceView(SPConfigMixin, View):
                     "not_on_or_after": assertion_not_on_or_after,
                 }
                 break
+        return assertion_info
+
+    @staticmethod
+    def _replay_cache_args(conf, session_info, assertion_info):
+        return (
+            session_info.get("issuer"),
+            assertion_info["assertion_id"],
+            assertion_info["not_on_or_after"],
+            getattr(conf, "accepted_time_diff", None) or 0,
+        )
 
-        if callable(attribute_mapping):
-            attribute_mapping = attribute_mapping()
-        if callable(create_unknown_user):
-            create_unknown_user = create_unknown_user()
-
-        try:
-            user = self.authenticate_user(
-                request,
-                session_info,
-                attribute_mapping,
-                create_unknown_user,
-                assertion_info,
+    def is_replayed(self, conf, session_info: dict, assertion_info: dict) -> bool:
+        """Whether the bearer assertion has been consumed before, according
+        to the replay cache set by SAML_ASSERTION_REPLAY_CACHE.
+        """
+        replay_cache = get_assertion_replay_cache()
+        if replay_cache is None or not assertion_info:
+            return False
+        with phase("replay"):
+            return not replay_cache.add(
+                *self._replay_cache_args(conf, session_info, assertion_info)
             )
-        except PermissionDenied as e:
-            return self.handle_acs_failure(
-                request,
-                exception=e,
-                session_info=session_info,
+
+    async def ais_replayed(self, conf, session_info: dict, assertion_info: dict):
+        replay_cache = get_assertion_replay_cache()
+        if replay_cache is None or not assertion_info:
+            return False
+        with phase("replay"):
+            return not await replay_cache.aadd(
+                *self._replay_cache_args(conf, session_info, assertion_info)
             )
 
+    def handle_replayed_assertion(self, request, session_info, assertion_info):
+        logger.warning(
+            "SAML Assertion %s from %s has already been used.",
+            assertion_info["assertion_id"],
+            session_info.get("issuer"),
+        )
+        return self._acs_failure(
+            request,
+            exception=PermissionDenied("The SAML Assertion has already been used."),
+            session_info=session_info,
+        )
+
+    def login_redirect(self, request, user, session_info):
+        """Redirect the user logged in to the RelayState."""
         relay_state = self.build_relay_state()
         custom_redirect_url = self.custom_redirect(user, relay_state, session_info)
         if custom_redirect_url:
@@ -599,6 +792,46 @@ class AssertionConsumerServiceView(SPConfigMixin, View):
         logger.debug("Redirecting to the RelayState: %s", relay_state)
         return HttpResponseRedirect(relay_state)
 
+    def get_verifier_pool(self, request: HttpRequest):
+        """Return the pool of processes verifying the SAML responses, or None
+        to verify them in the request thread.
+
+        The workers of the pool configured by SAML_ACS_POOL_WORKERS load the
+        config without a request, so it is used with the default config
+        loader only. A view overriding this to return its own pool must use a
+        loader that doesn't need the request.
+        """
+        if self.get_config_loader_path(request) is not None:
+            return None
+        return get_acs_pool()
+
+    def parse_authn_response(self, request, client, outstanding_queries):
+        """Parse and verify the SAML response, in a worker process if there's
+        a verifier pool.
+        """
+        pool = self.get_verifier_pool(request)
+        if pool is None:
+            with phase("verify"):
+                return client.parse_authn_request_response(
+                    request.POST["SAMLResponse"],
+                    saml2.BINDING_HTTP_POST,
+                    outstanding_queries,
+                )
+
+        with phase("verify"):
+            response = pool.verify(
+                request.POST["SAMLResponse"],
+                saml2.BINDING_HTTP_POST,
+                outstanding_queries,
+            )
+        if response is None:
+            return None
+        remember_identity = response.remember_identity
+        response = response.authn_response(client)
+        if remember_identity:
+            client.users.add_information_about_person(response.session_info())
+        return response
+
     def authenticate_user(
         self,
         request,
@@ -624,8 +857,9 @@ class AssertionConsumerServiceView(SPConfigMixin, View):
             )
             raise PermissionDenied("No user could be authenticated.")
 
-        auth.login(self.request, user)
-        _set_subject_id(request.saml_session, session_info["name_id"])
+        with phase("session"):
+            auth.login(self.request, user)
+            _set_subject_id(request.saml_session, session_info["name_id"])
         logger.debug("User %s authenticated via SSO.", user)
 
         self.post_login_hook(request, user, session_info)
@@ -693,6 +927,7 @@ class LogoutInitView(LoginRequiredMixin, SPConfigMixin, View):
     using the pysaml2 library to create the LogoutRequest.
     """
 
+    @timed("logout")
     def get(self, request, *args, **kwargs):
         state, client = self.get_state_client(request)
 
@@ -712,7 +947,8 @@ class LogoutInitView(LoginRequiredMixin, SPConfigMixin, View):
             logger.exception(f"Error Handled - SLO - unsupported binding by IDP: {exp}")
             _error = exp
 
-        auth.logout(request)
+        with phase("session"):
+            auth.logout(request)
         state.sync()
 
         if _error:
@@ -778,11 +1014,13 @@ class LogoutView(SPConfigMixin, View):
 
     logout_error_template = "djangosaml2/logout_error.html"
 
+    @timed("logout")
     def get(self, request, *args, **kwargs):
         return self.do_logout_service(
             request, request.GET, saml2.BINDING_HTTP_REDIRECT, *args, **kwargs
         )
 
+    @timed("logout")
     def post(self, request, *args, **kwargs):
         return self.do_logout_service(
             request, request.POST, saml2.BINDING_HTTP_POST, *args, **kwargs
@@ -816,7 +1054,9 @@ class LogoutView(SPConfigMixin, View):
                     "The session does not contain the subject id for user %s. Performing local logout",
                     request.user,
                 )
-                auth.logout(request)
+                with phase("session"):
+                    auth.logout(request)
+                metrics.logouts.inc(initiator="idp", result="failure")
                 return render(request, self.logout_error_template, status=403)
 
             http_info = client.handle_logout_request(
@@ -826,72 +1066,339 @@ class LogoutView(SPConfigMixin, View):
                 relay_state=data.get("RelayState", ""),
             )
             state.sync()
-            auth.logout(request)
-            if (
-                http_info.get("method", "GET") == "POST"
-                and "data" in http_info
-                and ("Content-type", "text/html") in http_info.get("headers", [])
-            ):
-                # need to send back to the IDP a signed POST response with user session
-                # return HTML form content to browser with auto form validation
-                # to finally send request to the IDP
-                return HttpResponse(http_info["data"])
-            return HttpResponseRedirect(get_location(http_info))
+            with phase("session"):
+                auth.logout(request)
+            metrics.logouts.inc(initiator="idp", result="success")
+            return _logout_request_response(http_info)
         logger.error("No SAMLResponse or SAMLRequest parameter found")
         return HttpResponseBadRequest("No SAMLResponse or SAMLRequest parameter found")
 
 
-def finish_logout(request, response):
-    if getattr(settings, "SAML_IGNORE_LOGOUT_ERRORS", False) or (
-        response and response.status_ok()
+def _logout_request_response(http_info):
+    if (
+        http_info.get("method", "GET") == "POST"
+        and "data" in http_info
+        and ("Content-type", "text/html") in http_info.get("headers", [])
     ):
+        # need to send back to the IDP a signed POST response with user session
+        # return HTML form content to browser with auto form validation
+        # to finally send request to the IDP
+        return HttpResponse(http_info["data"])
+    return HttpResponseRedirect(get_location(http_info))
+
+
+def _logout_succeeded(response) -> bool:
+    return getattr(settings, "SAML_IGNORE_LOGOUT_ERRORS", False) or bool(
+        response and response.status_ok()
+    )
+
+
+def finish_logout(request, response):
+    if _logout_succeeded(response):
         logger.debug("Performing django logout.")
+        metrics.logouts.inc(initiator="sp", result="success")
 
-        auth.logout(request)
+        with phase("session"):
+            auth.logout(request)
+        return _logged_out_response(request)
 
-        next_path = _get_next_path(request)
-        if next_path is not None:
-            logger.debug("Redirecting to the RelayState: %s", next_path)
-            return HttpResponseRedirect(next_path)
-        elif settings.LOGOUT_REDIRECT_URL is not None:
-            fallback_url = resolve_url(settings.LOGOUT_REDIRECT_URL)
-            logger.debug(
-                "No valid RelayState found; Redirecting to " "LOGOUT_REDIRECT_URL"
-            )
-            return HttpResponseRedirect(fallback_url)
-        else:
-            current_site = get_current_site(request)
-            logger.debug(
-                "No valid RelayState or LOGOUT_REDIRECT_URL found, "
-                "rendering fallback template."
-            )
-            return render(
-                request,
-                "registration/logged_out.html",
-                {
-                    "site": current_site,
-                    "site_name": current_site.name,
-                    "title": _("Logged out"),
-                    "subtitle": None,
-                },
-            )
+    logger.error("Unknown error during the logout")
+    metrics.logouts.inc(initiator="sp", result="failure")
+    return render(request, "djangosaml2/logout_error.html", {})
+
+
+async def afinish_logout(request, response):
+    if _logout_succeeded(response):
+        logger.debug("Performing django logout.")
+        metrics.logouts.inc(initiator="sp", result="success")
+
+        with phase("session"):
+            await auth.alogout(request)
+        # the fallback page looks the current site up in the database
+        return await sync_to_async(_logged_out_response)(request)
 
     logger.error("Unknown error during the logout")
+    metrics.logouts.inc(initiator="sp", result="failure")
     return render(request, "djangosaml2/logout_error.html", {})
 
 
+def _logged_out_response(request):
+    next_path = _get_next_path(request)
+    if next_path is not None:
+        logger.debug("Redirecting to the RelayState: %s", next_path)
+        return HttpResponseRedirect(next_path)
+    elif settings.LOGOUT_REDIRECT_URL is not None:
+        fallback_url = resolve_url(settings.LOGOUT_REDIRECT_URL)
+        logger.debug("No valid RelayState found; Redirecting to " "LOGOUT_REDIRECT_URL")
+        return HttpResponseRedirect(fallback_url)
+    else:
+        current_site = get_current_site(request)
+        logger.debug(
+            "No valid RelayState or LOGOUT_REDIRECT_URL found, "
+            "rendering fallback template."
+        )
+        return render(
+            request,
+            "registration/logged_out.html",
+            {
+                "site": current_site,
+                "site_name": current_site.name,
+                "title": _("Logged out"),
+                "subtitle": None,
+            },
+        )
+
+
 class MetadataView(SPConfigMixin, View):
     """Returns an XML with the SAML 2.0 metadata for this SP as configured in the settings.py file."""
 
+    @timed("metadata")
     def get(self, request, *args, **kwargs):
         conf = self.get_sp_config(request)
-        metadata = entity_descriptor(conf)
+        with phase("render"):
+            content = str(entity_descriptor(conf)).encode("utf-8")
+        return HttpResponse(content=content, content_type="text/xml; charset=utf-8")
+
+
+class MetricsView(View):
+    """Serves the metrics of the SAML flows in the Prometheus text format,
+    when SAML_METRICS_ENABLED is set. They're those of the process serving
+    the request.
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not get_custom_setting("SAML_METRICS_ENABLED", False):
+            raise Http404("Metrics are disabled")
         return HttpResponse(
-            content=str(metadata).encode("utf-8"),
-            content_type="text/xml; charset=utf-8",
+            content=metrics.registry.expose(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
         )
 
 
+class AsyncLoginView(LoginView):
+    """LoginView for ASGI deployments, requires Django 5.0 or later.
+
+    The SAML session and the user are loaded with the async APIs, then
+    LoginView.get() runs in the thread of the sync code, where its hooks can
+    use the ORM. The AuthnRequests are thus built one at a time, as under
+    WSGI: this view offers no concurrency gain over LoginView, it only keeps
+    the login URL on the event loop along with the other async views.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        await _aload_session(request.saml_session)
+        await _aload_user(request)
+        return await sync_to_async(super().get)(request, *args, **kwargs)
+
+
+class AsyncAssertionConsumerServiceView(AssertionConsumerServiceView):
+    """AssertionConsumerServiceView for ASGI deployments, requires Django 5.0
+    or later.
+
+    The SAML response is parsed and verified in a thread off the event loop,
+    or in the verifier pool, and the user is authenticated and logged in with
+    aauthenticate and alogin. The sync hooks a subclass overrides run in a
+    thread, the others on the event loop.
+    """
+
+    @timed("acs")
+    async def post(self, request, attribute_mapping=None, create_unknown_user=None):
+        started = time.perf_counter()
+        if "SAMLResponse" not in request.POST:
+            logger.warning('Missing "SAMLResponse" parameter in POST data.')
+            return HttpResponseBadRequest(
+                'Missing "SAMLResponse" parameter in POST data.'
+            )
+
+        attribute_mapping = attribute_mapping or get_custom_setting(
+            "SAML_ATTRIBUTE_MAPPING", {"uid": ("username",)}
+        )
+        create_unknown_user = create_unknown_user or get_custom_setting(
+            "SAML_CREATE_UNKNOWN_USER", True
+        )
+        conf = await self.aget_sp_config(request)
+        await _aload_session(request.saml_session)
+
+        identity_cache = IdentityCache(request.saml_session)
+        client = await self.aget_client(conf, identity_cache=identity_cache)
+        oq_cache = OutstandingQueriesCache(request.saml_session)
+        oq_cache.sync()
+        outstanding_queries = oq_cache.outstanding_queries()
+
+        failure = await sync_to_async(self.prefilter_response, thread_sensitive=False)(
+            request, conf, outstanding_queries
+        )
+        if failure is not None:
+            return failure
+        response, failure = await sync_to_async(
+            self.verify_response, thread_sensitive=False
+        )(request, client, outstanding_queries)
+        if failure is not None:
+            return failure
+
+        oq_cache.delete(response.session_id())
+        session_info = response.session_info()
+        assertion_info = self.get_assertion_info(response)
+        if await self.ais_replayed(conf, session_info, assertion_info):
+            return await sync_to_async(self.handle_replayed_assertion)(
+                request, session_info, assertion_info
+            )
+
+        if callable(attribute_mapping):
+            attribute_mapping = attribute_mapping()
+        if callable(create_unknown_user):
+            create_unknown_user = create_unknown_user()
+
+        try:
+            user = await self.aauthenticate_user(
+                request,
+                session_info,
+                attribute_mapping,
+                create_unknown_user,
+                assertion_info,
+            )
+        except PermissionDenied as e:
+            return await sync_to_async(self._acs_failure)(
+                request,
+                exception=e,
+                session_info=session_info,
+            )
+
+        self._count_login(session_info, started)
+        # custom_redirect() may use the ORM
+        return await sync_to_async(self.login_redirect)(request, user, session_info)
+
+    async def aauthenticate_user(
+        self,
+        request,
+        session_info,
+        attribute_mapping,
+        create_unknown_user,
+        assertion_info,
+    ):
+        """Async counterpart of authenticate_user, that is run instead if a
+        subclass overrides it.
+        """
+        if _overrides(self, AssertionConsumerServiceView, "authenticate_user"):
+            return await sync_to_async(self.authenticate_user)(
+                request,
+                session_info,
+                attribute_mapping,
+                create_unknown_user,
+                assertion_info,
+            )
+
+        logger.debug("Trying to authenticate the user. Session info: %s", session_info)
+        user = await auth.aauthenticate(
+            request=request,
+            session_info=session_info,
+            attribute_mapping=attribute_mapping,
+            create_unknown_user=create_unknown_user,
+            assertion_info=assertion_info,
+        )
+        if user is None:
+            logger.warning(
+                "Could not authenticate user received in SAML Assertion. Session info: %s",
+                session_info,
+            )
+            raise PermissionDenied("No user could be authenticated.")
+
+        with phase("session"):
+            await auth.alogin(request, user)
+            _set_subject_id(request.saml_session, session_info["name_id"])
+        logger.debug("User %s authenticated via SSO.", user)
+
+        await self.apost_login_hook(request, user, session_info)
+        await self.acustomize_session(user, session_info)
+
+        return user
+
+    async def apost_login_hook(self, request, user, session_info: dict) -> None:
+        if _overrides(self, AssertionConsumerServiceView, "post_login_hook"):
+            await sync_to_async(self.post_login_hook)(request, user, session_info)
+
+    async def acustomize_session(self, user, session_info: dict):
+        if _overrides(self, AssertionConsumerServiceView, "customize_session"):
+            await sync_to_async(self.customize_session)(user, session_info)
+
+
+class AsyncLogoutView(LogoutView):
+    """LogoutView for ASGI deployments, requires Django 5.0 or later.
+
+    The logout messages are verified and signed in a thread off the event
+    loop, the user is logged out with alogout.
+    """
+
+    @timed("logout")
+    async def get(self, request, *args, **kwargs):
+        return await self.ado_logout_service(
+            request, request.GET, saml2.BINDING_HTTP_REDIRECT, *args, **kwargs
+        )
+
+    @timed("logout")
+    async def post(self, request, *args, **kwargs):
+        return await self.ado_logout_service(
+            request, request.POST, saml2.BINDING_HTTP_POST, *args, **kwargs
+        )
+
+    async def ado_logout_service(self, request, data, binding, *args, **kwargs):
+        logger.debug("Logout service started")
+
+        await _aload_session(request.saml_session)
+        await _aload_user(request)
+        conf = await self.aget_sp_config(request)
+        state = StateCache(request.saml_session)
+        client = await self.aget_client(
+            conf,
+            state_cache=state,
+            identity_cache=IdentityCache(request.saml_session),
+        )
+
+        if "SAMLResponse" in data:  # we started the logout
+            logger.debug("Receiving a logout response from the IdP")
+            try:
+                response = await sync_to_async(
+                    client.parse_logout_request_response, thread_sensitive=False
+                )(data["SAMLResponse"], binding)
+            except StatusError as e:
+                response = None
+                logger.warning(
+                    f"Error logging out from remote provider: {e}", exc_info=True
+                )
+            state.sync()
+            return await afinish_logout(request, response)
+
+        elif "SAMLRequest" in data:  # logout started by the IdP
+            logger.debug("Receiving a logout request from the IdP")
+            subject_id = _get_subject_id(request.saml_session)
+
+            if subject_id is None:
+                logger.warning(
+                    "The session does not contain the subject id for user %s. Performing local logout",
+                    request.user,
+                )
+                with phase("session"):
+                    await auth.alogout(request)
+                metrics.logouts.inc(initiator="idp", result="failure")
+                return render(request, self.logout_error_template, status=403)
+
+            http_info = await sync_to_async(
+                client.handle_logout_request, thread_sensitive=False
+            )(
+                data["SAMLRequest"],
+                subject_id,
+                binding,
+                relay_state=data.get("RelayState", ""),
+            )
+            state.sync()
+            with phase("session"):
+                await auth.alogout(request)
+            metrics.logouts.inc(initiator="idp", result="success")
+            return _logout_request_response(http_info)
+        logger.error("No SAMLResponse or SAMLRequest parameter found")
+        return HttpResponseBadRequest("No SAMLResponse or SAMLRequest parameter found")
+
+
 def get_namespace_prefixes():
     from saml2 import md, saml, samlp, xmldsig, xmlenc
 
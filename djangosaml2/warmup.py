@@ -0,0 +1,45 @@
+import logging
+from typing import Callable, Optional, Union
+
+from .conf import get_config, is_config_cached
+from .overrides import Saml2Client
+from .timing import PhaseTimer
+from .utils import available_idps
+
+logger = logging.getLogger("djangosaml2")
+
+
+def warmup(config_loader_path: Optional[Union[Callable, str]] = None) -> dict:
+    """Load the SAML config, its metadata and keys ahead of the first request.
+
+    Whatever gets cached here is inherited by the workers forked afterwards
+    (e.g. gunicorn with --preload). Returns the duration of each phase in seconds.
+
+    Nothing is kept unless the config is cached, by the default loader with
+    SAML_CONFIG_CACHE_ENABLED or by a loader using the registry, so the
+    warm-up is skipped otherwise and returns no phase.
+    """
+    if not is_config_cached(config_loader_path):
+        logger.warning(
+            "SAML warm-up skipped: the config isn't cached, set "
+            "SAML_CONFIG_CACHE_ENABLED or use registry_config_loader"
+        )
+        return {}
+
+    timer = PhaseTimer("warmup")
+    with timer.phase("config"):
+        conf = get_config(config_loader_path)
+    with timer.phase("metadata"):
+        idps = available_idps(conf)
+    with timer.phase("client"):
+        Saml2Client.from_config(conf)
+    timings = timer.phases
+
+    logger.info(
+        "SAML warm-up done for %s IdP(s): %s",
+        len(idps),
+        ", ".join(
+            f"{name}={duration * 1000:.1f}ms" for name, duration in timings.items()
+        ),
+    )
+    return timings
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Compare applying 200-attribute assertions to a user by inspecting it for
+each attribute with running the compiled attribute mapping plan.
+
+Usage: python tests/benchmarks/attribute_mapping.py [number of logins]
+"""
+
+import os
+import sys
+import time
+
+import django
+
+PROJECT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path[:0] = [os.path.dirname(PROJECT_DIR), PROJECT_DIR]
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+django.setup()
+
+from djangosaml2.backends import Saml2Backend, set_attribute  # noqa: E402
+from testprofiles.models import TestUser  # noqa: E402
+
+ATTRIBUTES = 200
+FIELDS = ("first_name", "last_name", "email", "age", "process_first_name")
+
+
+def reflective_update(user, attributes, attribute_mapping, lookup_attribute):
+    """How users were updated before the mapping was compiled."""
+    has_updated_fields = False
+    for saml_attr, django_attrs in attribute_mapping.items():
+        attr_value_list = attributes.get(saml_attr)
+        if not attr_value_list:
+            continue
+        for attr in django_attrs:
+            if attr == lookup_attribute:
+                continue
+            elif hasattr(user, attr):
+                user_attr = getattr(user, attr)
+                if callable(user_attr):
+                    modified = user_attr(attr_value_list)
+                else:
+                    modified = set_attribute(user, attr, attr_value_list[0])
+                has_updated_fields = has_updated_fields or modified
+    return has_updated_fields
+
+
+def timed(update, logins):
+    start = time.perf_counter()
+    for _ in range(logins):
+        update()
+    return (time.perf_counter() - start) / logins
+
+
+def main(logins):
+    attribute_mapping = {"uid": ("username",)}
+    attribute_mapping.update(
+        (f"urn:oid:attribute-{i}", (FIELDS[i % len(FIELDS)],))
+        for i in range(ATTRIBUTES - 1)
+    )
+    attributes = {saml_attr: ["value"] for saml_attr in attribute_mapping}
+    attributes["uid"] = ["john"]
+    # the attributes are those of the user, nothing is saved
+    user = TestUser(
+        username="john",
+        first_name="value",
+        last_name="value",
+        email="value",
+        age="value",
+    )
+
+    backend = Saml2Backend()
+    lookup_attribute = backend._user_lookup_attribute
+    reflective = timed(
+        lambda: reflective_update(
+            user, attributes, attribute_mapping, lookup_attribute
+        ),
+        logins,
+    )
+    compiled = timed(
+        lambda: backend._update_user(user, attributes, attribute_mapping), logins
+    )
+
+    print(f"logins:      {logins}")
+    print(f"attributes:  {ATTRIBUTES}")
+    print(f"reflection:  {reflective * 1e6:.1f} us")
+    print(f"plan:        {compiled * 1e6:.1f} us")
+    print(f"speedup:     {reflective / compiled:.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
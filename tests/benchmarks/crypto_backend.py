@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Compare signing and verifying with xmlsec1 and with the in-process backend.
+
+Usage: python tests/benchmarks/crypto_backend.py [number of requests]
+"""
+
+import logging
+import os
+import sys
+import time
+import warnings
+
+import django
+
+PROJECT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path[:0] = [os.path.dirname(PROJECT_DIR), PROJECT_DIR]
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+django.setup()
+
+from saml2.samlp import AuthnRequest  # noqa: E402
+from saml2.sigver import CryptoBackendXmlSec1, class_name  # noqa: E402
+
+from djangosaml2.crypto import CryptoBackendXMLSecBinding  # noqa: E402
+from djangosaml2.overrides import Saml2Client, SPConfig  # noqa: E402
+from djangosaml2.tests import conf  # noqa: E402
+
+
+def timed(client, crypto, requests):
+    client.sec.crypto = crypto
+    sign = verify = 0.0
+    for _ in range(requests):
+        start = time.perf_counter()
+        req_id, request = client.create_authn_request(
+            "https://idp.example.com/simplesaml/saml2/idp/SSOService.php", sign=True
+        )
+        signed = str(request)
+        sign += time.perf_counter() - start
+
+        start = time.perf_counter()
+        client.sec.verify_signature(
+            signed,
+            client.config.cert_file,
+            node_name=class_name(AuthnRequest()),
+            node_id=req_id,
+        )
+        verify += time.perf_counter() - start
+    return sign / requests, verify / requests
+
+
+def main(requests):
+    logging.getLogger("saml2").setLevel(logging.ERROR)
+    warnings.simplefilter("ignore")
+
+    config = SPConfig()
+    config.load(conf.create_conf(authn_requests_signed=True))
+    client = Saml2Client(config)
+
+    backends = [("in process", CryptoBackendXMLSecBinding())]
+    xmlsec1 = CryptoBackendXmlSec1(client.config.xmlsec_binary)
+    try:
+        timed(client, xmlsec1, 1)
+    except Exception:
+        print(
+            f"{client.config.xmlsec_binary} doesn't work, timing the in-process backend only"
+        )
+    else:
+        backends.insert(0, ("xmlsec1", xmlsec1))
+
+    print(f"requests: {requests}")
+    for name, crypto in backends:
+        sign, verify = timed(client, crypto, requests)
+        print(f"{name:<11} sign: {sign * 1e3:.2f} ms  verify: {verify * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Compare parsing a metadata aggregate with restoring it from a snapshot.
+
+Usage: python tests/benchmarks/metadata_snapshot.py [number of entities]
+"""
+
+import copy
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import django
+
+PROJECT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path[:0] = [os.path.dirname(PROJECT_DIR), PROJECT_DIR]
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+django.setup()
+
+from django.test import override_settings  # noqa: E402
+
+from djangosaml2.overrides import SPConfig  # noqa: E402
+from djangosaml2.tests import conf  # noqa: E402
+
+TEMPLATE = os.path.join(os.path.dirname(conf.__file__), "remote_metadata_one_idp.xml")
+
+
+def build_aggregate(path, entities):
+    with open(TEMPLATE) as fp:
+        template = fp.read()
+    start = template.index("<md:EntityDescriptor")
+    end = template.index("</md:EntitiesDescriptor>")
+    entity = template[start:end]
+    with open(path, "w") as fp:
+        fp.write(template[:start])
+        for i in range(entities):
+            fp.write(re.sub(r"idp\.example\.com", f"idp{i}.example.com", entity))
+        fp.write(template[end:])
+
+
+def timed_load(saml_config, rounds=3):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        SPConfig().load(copy.deepcopy(saml_config))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(entities):
+    workdir = tempfile.mkdtemp()
+    try:
+        metadata_file = os.path.join(workdir, "aggregate.xml")
+        build_aggregate(metadata_file, entities)
+        saml_config = conf.create_conf()
+        saml_config["metadata"] = {"local": [metadata_file]}
+
+        cold = timed_load(saml_config)
+        with override_settings(SAML_METADATA_SNAPSHOT_DIR=workdir):
+            # the first load writes the snapshot
+            SPConfig().load(copy.deepcopy(saml_config))
+            snapshot = timed_load(saml_config)
+    finally:
+        shutil.rmtree(workdir)
+
+    print(f"entities:      {entities}")
+    print(f"cold parse:    {cold * 1000:.1f} ms")
+    print(f"snapshot load: {snapshot * 1000:.1f} ms")
+    print(f"speedup:       {cold / snapshot:.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Compare building a Saml2Client per request with reusing the shared one.
+
+Usage: python tests/benchmarks/saml2_client.py [number of requests]
+"""
+
+import logging
+import os
+import sys
+import time
+import warnings
+
+import django
+
+PROJECT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path[:0] = [os.path.dirname(PROJECT_DIR), PROJECT_DIR]
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+django.setup()
+
+from djangosaml2.cache import IdentityCache, StateCache  # noqa: E402
+from djangosaml2.overrides import Saml2Client, SPConfig  # noqa: E402
+from djangosaml2.tests import conf  # noqa: E402
+
+
+def timed(build, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        session = {}
+        build(identity_cache=IdentityCache(session), state_cache=StateCache(session))
+    return (time.perf_counter() - start) / requests
+
+
+def main(requests):
+    # the test config accepts unsigned responses, pysaml2 warns on every build
+    logging.getLogger("saml2").setLevel(logging.ERROR)
+    warnings.simplefilter("ignore")
+
+    config = SPConfig()
+    config.load(conf.create_conf(metadata_file="remote_metadata_three_idps.xml"))
+
+    per_request = timed(lambda **caches: Saml2Client(config, **caches), requests)
+    # the first call builds the shared client
+    Saml2Client.from_config(config)
+    shared = timed(lambda **caches: Saml2Client.from_config(config, **caches), requests)
+
+    print(f"requests:           {requests}")
+    print(f"client per request: {per_request * 1e6:.1f} us")
+    print(f"shared client:      {shared * 1e6:.1f} us")
+    print(f"speedup:            {per_request / shared:.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -14,15 +14,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+from unittest import mock
+
 from django.conf import settings
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models.signals import post_delete, post_save
 from django.test import Client, TestCase, override_settings
 from django.urls import reverse
 
+from django.contrib import auth
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User as DjangoUserModel
 
-from djangosaml2.backends import Saml2Backend, get_saml_user_model, set_attribute
+from djangosaml2.backends import (
+    Saml2Backend,
+    compile_attribute_mapping,
+    get_saml_user_model,
+    set_attribute,
+)
+from djangosaml2.cache import (
+    get_user_fingerprint_cache,
+    invalidate_users_fingerprints,
+)
+from djangosaml2.checks import check_attribute_mapping
 from djangosaml2.utils import get_csp_handler
 from testprofiles.models import TestUser
 
@@ -155,6 +171,65 @@ class Saml2BackendTests(TestCase):
         self.backend._update_user(self.user, attributes, attribute_mapping)
         self.assertEqual(self.user.age, "22")
 
+    def test_update_user_mapping_order(self):
+        attributes = {"uid": ("john",), "cn": ("Jo",), "givenName": ("John",)}
+        # the method and the field set first_name, the last one mapped wins
+        for attribute_mapping, first_name in (
+            ({"cn": ("process_first_name",), "givenName": ("first_name",)}, "John"),
+            ({"givenName": ("first_name",), "cn": ("process_first_name",)}, "Jo"),
+        ):
+            with self.subTest(first_name):
+                self.user.first_name = ""
+                self.user.save()
+                user = self.backend._update_user(
+                    self.user, attributes, {"uid": ("username",), **attribute_mapping}
+                )
+                self.assertEqual(user.first_name, first_name)
+                user.refresh_from_db()
+                self.assertEqual(user.first_name, first_name)
+
+    def test_update_user_update_fields(self):
+        attribute_mapping = {
+            "uid": ("username",),
+            "mail": ("email",),
+            "sn": ("last_name",),
+        }
+        attributes = {"uid": ("john",), "mail": ("john@example.com",)}
+        with mock.patch.object(
+            self.backend, "save_user", wraps=self.backend.save_user
+        ) as save_user:
+            self.backend._update_user(self.user, attributes, attribute_mapping)
+            save_user.assert_called_once_with(self.user, update_fields=["email"])
+
+            # identical attributes aren't saved again
+            save_user.reset_mock()
+            self.backend._update_user(self.user, attributes, attribute_mapping)
+            save_user.assert_not_called()
+
+            with mock.patch.object(TestUser, "save") as save:
+                self.backend._update_user(
+                    self.user, {**attributes, "sn": ("Doe",)}, attribute_mapping
+                )
+            save.assert_called_once_with(update_fields=["last_name"])
+
+            # overrides of _update_user force saving what they changed
+            save_user.reset_mock()
+            self.backend._update_user(
+                self.user, attributes, attribute_mapping, force_save=True
+            )
+            save_user.assert_called_once_with(self.user)
+
+            save_user.reset_mock()
+            user = TestUser(username="jane")
+            self.backend._update_user(
+                user, {"mail": ("jane@example.com",)}, attribute_mapping
+            )
+            save_user.assert_called_once_with(user, update_fields=None)
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.email, "john@example.com")
+        self.assertIsNotNone(user.pk)
+
     def test_update_user_callable_attributes(self):
         attribute_mapping = {
             "uid": ("username",),
@@ -563,6 +638,327 @@ class CustomizedSaml2BackendTests(Saml2BackendTests):
         self.assertEqual(user.username, "john")
 
 
+class AsyncSaml2BackendTests(TestCase):
+    attribute_mapping = {
+        "uid": ("username",),
+        "mail": ("email",),
+        "cn": ("process_first_name",),
+    }
+
+    def setUp(self):
+        self.user = TestUser.objects.create(username="john")
+
+    def session_info(self, uid, **attributes):
+        attributes["uid"] = (uid,)
+        return {"ava": attributes, "issuer": "dummy_entity_id"}
+
+    async def test_aauthenticate(self):
+        backend = Saml2Backend()
+        with mock.patch("djangosaml2.backends.sync_to_async") as sync_to_async:
+            user = await backend.aauthenticate(
+                None,
+                session_info=self.session_info("john", mail=("john@example.com",)),
+                attribute_mapping={"uid": ("username",), "mail": ("email",)},
+            )
+        sync_to_async.assert_not_called()
+        self.assertEqual(user.pk, self.user.pk)
+        await self.user.arefresh_from_db()
+        self.assertEqual(self.user.email, "john@example.com")
+
+        user = await backend.aauthenticate(
+            None,
+            session_info=self.session_info("jane", cn=("Jane",)),
+            attribute_mapping=self.attribute_mapping,
+        )
+        self.assertIsNotNone(user.pk)
+        self.assertEqual(user.first_name, "Jane")
+        self.assertFalse(user.has_usable_password())
+
+        user = await backend.aauthenticate(
+            None,
+            session_info=self.session_info("jim"),
+            attribute_mapping=self.attribute_mapping,
+            create_unknown_user=False,
+        )
+        self.assertIsNone(user)
+        self.assertIsNone(await backend.aauthenticate(None))
+
+    async def test_aauthenticate_sync_hooks(self):
+        def on_event_loop():
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return False
+            return True
+
+        class SyncHooksBackend(CustomizedBackend):
+            saved = []
+            hooks_on_event_loop = set()
+
+            def clean_attributes(self, attributes, idp_entityid, **kwargs):
+                if on_event_loop():
+                    self.hooks_on_event_loop.add("clean_attributes")
+                return super().clean_attributes(attributes, idp_entityid, **kwargs)
+
+            def clean_user_main_attribute(self, main_attribute):
+                if on_event_loop():
+                    self.hooks_on_event_loop.add("clean_user_main_attribute")
+                return super().clean_user_main_attribute(main_attribute)
+
+            def user_can_authenticate(self, user):
+                if on_event_loop():
+                    self.hooks_on_event_loop.add("user_can_authenticate")
+                return super().user_can_authenticate(user)
+
+            def save_user(self, user, *args, **kwargs):
+                self.saved.append(user.username)
+                return super().save_user(user, *args, **kwargs)
+
+        backend = SyncHooksBackend()
+        user = await backend.aauthenticate(
+            None,
+            session_info=self.session_info("john", mail=("john@example.com",)),
+            attribute_mapping=self.attribute_mapping,
+            assertion_info={"assertion_id": "abcdefg12345"},
+        )
+        # not authorized by CustomizedBackend.is_authorized
+        self.assertIsNone(user)
+
+        user = await backend.aauthenticate(
+            None,
+            session_info=self.session_info(
+                "john", mail=("john@example.com",), is_staff=(True,)
+            ),
+            attribute_mapping=self.attribute_mapping,
+            assertion_info={"assertion_id": "abcdefg12345"},
+        )
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertEqual(backend.saved, ["john"])
+        # the sync hooks overridden run in a thread
+        self.assertEqual(backend.hooks_on_event_loop, set())
+
+    async def test_aupdate_user_mapping_order(self):
+        backend = Saml2Backend()
+        attributes = {"uid": ("john",), "cn": ("Jo",), "givenName": ("John",)}
+        for attribute_mapping, first_name in (
+            ({"cn": ("process_first_name",), "givenName": ("first_name",)}, "John"),
+            ({"givenName": ("first_name",), "cn": ("process_first_name",)}, "Jo"),
+        ):
+            with self.subTest(first_name):
+                self.user.first_name = ""
+                await self.user.asave()
+                user = await backend._aupdate_user(
+                    self.user, attributes, {"uid": ("username",), **attribute_mapping}
+                )
+                self.assertEqual(user.first_name, first_name)
+
+    async def test_auth_aauthenticate(self):
+        user = await auth.aauthenticate(
+            session_info=self.session_info("john"),
+            attribute_mapping=self.attribute_mapping,
+        )
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertEqual(user.backend, "djangosaml2.backends.Saml2Backend")
+
+
+class AttributeMappingPlanTests(TestCase):
+    attribute_mapping = {
+        "uid": ("username",),
+        "mail": ("email",),
+        "cn": ("process_first_name", "first_name"),
+        "givenName": ("first_name",),
+        "shoe": ("shoe_size",),
+    }
+
+    def test_plan(self):
+        plan = compile_attribute_mapping(self.attribute_mapping, TestUser, "username")
+        self.assertIs(
+            plan,
+            compile_attribute_mapping(
+                dict(self.attribute_mapping), TestUser, "username"
+            ),
+        )
+        self.assertEqual(plan.sources["first_name"], ["cn", "givenName"])
+        self.assertEqual(
+            [(saml_attr, targets) for saml_attr, _django_attrs, targets in plan.steps],
+            [
+                ("uid", []),
+                ("mail", [("email", plan.FIELD)]),
+                ("cn", [("process_first_name", plan.CALL), ("first_name", plan.FIELD)]),
+                ("givenName", [("first_name", plan.FIELD)]),
+                ("shoe", [("shoe_size", plan.RESOLVE)]),
+            ],
+        )
+        self.assertEqual(plan.unresolved, ["shoe_size"])
+
+        self.assertEqual(plan.value("first_name", {"cn": ["John"]}), "John")
+        self.assertEqual(
+            plan.value("first_name", {"cn": ["John"], "givenName": ["Johnny"]}),
+            "Johnny",
+        )
+        self.assertIsNone(plan.value("first_name", {"cn": []}))
+        self.assertIsNone(plan.value("last_name", {"cn": ["John"]}))
+
+    def test_update_user_instance_attribute(self):
+        user = TestUser(username="john")
+        user.shoe_size = "42"
+        backend = Saml2Backend()
+        backend._update_user(user, {"shoe": ["43"]}, self.attribute_mapping)
+        self.assertEqual(user.shoe_size, "43")
+
+    def test_check_attribute_mapping(self):
+        with override_settings(SAML_ATTRIBUTE_MAPPING=self.attribute_mapping):
+            messages = check_attribute_mapping(None)
+        self.assertEqual([message.id for message in messages], ["djangosaml2.W001"])
+        self.assertIn('"shoe_size"', messages[0].msg)
+
+        with override_settings(SAML_ATTRIBUTE_MAPPING={"uid": "username"}):
+            messages = check_attribute_mapping(None)
+        self.assertEqual([message.id for message in messages], ["djangosaml2.E001"])
+
+        with override_settings(
+            SAML_ATTRIBUTE_MAPPING={"uid": ("username",)},
+            SAML_USER_MODEL="testprofiles.Nope",
+        ):
+            messages = check_attribute_mapping(None)
+        self.assertEqual([message.id for message in messages], ["djangosaml2.E002"])
+
+        with override_settings(SAML_ATTRIBUTE_MAPPING={"uid": ("username",)}):
+            self.assertEqual(check_attribute_mapping(None), [])
+
+
+@override_settings(SAML_USER_FINGERPRINT_CACHE="default")
+class UserFingerprintCacheTests(TestCase):
+    attribute_mapping = {"uid": ("username",), "mail": ("email",)}
+
+    def setUp(self):
+        caches["default"].clear()
+        self.user = TestUser.objects.create(username="john")
+        self.backend = Saml2Backend()
+
+    def session_info(self, mail="john@example.com"):
+        return {
+            "ava": {"uid": ("john",), "mail": (mail,)},
+            "issuer": "https://idp.example.com",
+        }
+
+    def authenticate(self, **kwargs):
+        return self.backend.authenticate(
+            None, attribute_mapping=self.attribute_mapping, **kwargs
+        )
+
+    def test_authenticate(self):
+        user = self.authenticate(session_info=self.session_info())
+        self.assertEqual(user.email, "john@example.com")
+
+        with mock.patch.object(
+            self.backend, "_update_user", wraps=self.backend._update_user
+        ) as update_user:
+            with self.assertNumQueries(1):
+                user = self.authenticate(session_info=self.session_info())
+            update_user.assert_not_called()
+            self.assertEqual(user.pk, self.user.pk)
+
+            # other attributes
+            self.authenticate(session_info=self.session_info("j@example.com"))
+            update_user.assert_called_once()
+
+    def test_invalidation(self):
+        fingerprints = get_user_fingerprint_cache()
+        self.authenticate(session_info=self.session_info())
+        key = ("https://idp.example.com", "username", "john")
+        self.assertIsNotNone(fingerprints.get(*key))
+
+        # as done by auth.login
+        self.user.save(update_fields=["last_login"])
+        self.assertIsNotNone(fingerprints.get(*key))
+
+        self.user.save()
+        self.assertIsNone(fingerprints.get(*key))
+
+        self.authenticate(session_info=self.session_info())
+        self.assertIsNotNone(fingerprints.get(*key))
+        self.user.delete()
+        self.assertIsNone(fingerprints.get(*key))
+
+        user = self.authenticate(session_info=self.session_info())
+        self.assertNotEqual(user.pk, self.user.pk)
+
+    def test_invalidation_of_every_entry(self):
+        fingerprints = get_user_fingerprint_cache()
+        keys = [
+            ("https://idp.example.com", "username", "john"),
+            ("https://other-idp.example.com", "email", "john@example.com"),
+        ]
+        for key in keys:
+            fingerprints.set(*key, self.user, "digest")
+            self.assertEqual(fingerprints.get(*key), (self.user.pk, "digest"))
+
+        fingerprints.invalidate(TestUser._meta.label_lower, self.user.pk)
+        for key in keys:
+            self.assertIsNone(fingerprints.get(*key))
+
+    def test_bulk_invalidation(self):
+        fingerprints = get_user_fingerprint_cache()
+        self.authenticate(session_info=self.session_info())
+        key = ("https://idp.example.com", "username", "john")
+
+        users = TestUser.objects.filter(pk=self.user.pk)
+        users.update(first_name="John")
+        # no signal is sent
+        self.assertIsNotNone(fingerprints.get(*key))
+        invalidate_users_fingerprints(TestUser, users.values_list("pk", flat=True))
+        self.assertIsNone(fingerprints.get(*key))
+
+        with override_settings(SAML_USER_FINGERPRINT_CACHE=None):
+            invalidate_users_fingerprints(TestUser, [self.user.pk])
+
+    def test_receivers(self):
+        self.assertTrue(post_save.has_listeners(TestUser))
+        self.assertFalse(post_save.has_listeners(DjangoUserModel))
+        with override_settings(SAML_USER_FINGERPRINT_CACHE=None):
+            self.assertFalse(post_save.has_listeners(TestUser))
+        self.assertTrue(post_delete.has_listeners(TestUser))
+
+    def test_inactive_user(self):
+        self.authenticate(session_info=self.session_info())
+        TestUser.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertIsNone(self.authenticate(session_info=self.session_info()))
+
+    def test_customized_backend(self):
+        self.assertIsNotNone(CustomizedBackend()._user_fingerprint_cache())
+
+        class UpdateUserBackend(Saml2Backend):
+            def _update_user(self, user, *args, **kwargs):
+                return super()._update_user(user, *args, **kwargs)
+
+        # the hits would skip _update_user
+        self.assertIsNone(UpdateUserBackend()._user_fingerprint_cache())
+
+        class SaveUserBackend(Saml2Backend):
+            def save_user(self, user, *args, **kwargs):
+                return super().save_user(user, *args, **kwargs)
+
+        self.assertIsNone(SaveUserBackend()._user_fingerprint_cache())
+
+    async def test_aauthenticate(self):
+        user = await self.backend.aauthenticate(
+            None,
+            session_info=self.session_info(),
+            attribute_mapping=self.attribute_mapping,
+        )
+        self.assertEqual(user.email, "john@example.com")
+
+        with mock.patch.object(self.backend, "_aupdate_user") as aupdate_user:
+            user = await self.backend.aauthenticate(
+                None,
+                session_info=self.session_info(),
+                attribute_mapping=self.attribute_mapping,
+            )
+        aupdate_user.assert_not_called()
+        self.assertEqual(user.pk, self.user.pk)
+
+
 class CSPHandlerTests(TestCase):
     def test_get_csp_handler_none(self):
         get_csp_handler.cache_clear()
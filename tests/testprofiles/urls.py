@@ -3,13 +3,27 @@ from django.urls import include, path
 
 from django.contrib import admin
 
+from djangosaml2 import views
+
 testpatterns = (
     [path("dashboard/", lambda request: HttpResponse(""), name="dashboard")],
     "testprofiles",  # app_name
 )
 
+asyncpatterns = (
+    [
+        path("login/", views.AsyncLoginView.as_view(), name="saml2_login"),
+        path(
+            "acs/", views.AsyncAssertionConsumerServiceView.as_view(), name="saml2_acs"
+        ),
+        path("ls/", views.AsyncLogoutView.as_view(), name="saml2_ls"),
+    ],
+    "async",  # app_name
+)
+
 urlpatterns = [
     path("saml2/", include("djangosaml2.urls")),
+    path("saml2/async/", include(asyncpatterns)),
     path("admin/", admin.site.urls),
     path("", include(testpatterns)),
 ]